@@ -27,8 +27,19 @@ import codecs
 import json
 import pytz
 import tempfile
-
-from collections import OrderedDict
+import random
+import bisect
+import heapq
+import binascii
+import hashlib
+import array
+import sqlite3
+import threading
+import concurrent.futures
+import multiprocessing
+import queue
+
+from collections import OrderedDict, deque
 
 import accurev
 import git
@@ -63,6 +74,14 @@ class Config(object):
                 startTransaction = xmlElement.attrib.get('start-transaction')
                 endTransaction   = xmlElement.attrib.get('end-transaction')
                 commandCacheFilename = xmlElement.attrib.get('command-cache-filename')
+                pipelineDepth = xmlElement.attrib.get('pipeline-depth')
+                dataShards = xmlElement.attrib.get('data-shards')
+                versionStoreFilename = xmlElement.attrib.get('version-store-filename')
+                reconstructVerifyRate = xmlElement.attrib.get('reconstruct-verify-rate')
+                diffProbeThreads = xmlElement.attrib.get('diff-probe-threads')
+                commandThreads = xmlElement.attrib.get('command-threads')
+                commandLimits = xmlElement.attrib.get('command-limits')
+                prefetchDepth = xmlElement.attrib.get('prefetch-depth')
                 
                 excludeStreamTypes = None
                 streamMap = None
@@ -81,11 +100,11 @@ class Config(object):
 
                         streamMap[streamName] = branchName
                 
-                return cls(depot, username, password, startTransaction, endTransaction, streamMap, commandCacheFilename, excludeStreamTypes)
+                return cls(depot, username, password, startTransaction, endTransaction, streamMap, commandCacheFilename, excludeStreamTypes, pipelineDepth, dataShards, versionStoreFilename, reconstructVerifyRate, diffProbeThreads, commandThreads, commandLimits, prefetchDepth)
             else:
                 return None
             
-        def __init__(self, depot = None, username = None, password = None, startTransaction = None, endTransaction = None, streamMap = None, commandCacheFilename = None, excludeStreamTypes = None):
+        def __init__(self, depot = None, username = None, password = None, startTransaction = None, endTransaction = None, streamMap = None, commandCacheFilename = None, excludeStreamTypes = None, pipelineDepth = None, dataShards = None, versionStoreFilename = None, reconstructVerifyRate = None, diffProbeThreads = None, commandThreads = None, commandLimits = None, prefetchDepth = None):
             self.depot    = depot
             self.username = username
             self.password = password
@@ -94,6 +113,33 @@ class Config(object):
             self.streamMap = streamMap
             self.commandCacheFilename = commandCacheFilename
             self.excludeStreamTypes = excludeStreamTypes
+            self.versionStoreFilename = versionStoreFilename
+
+            self.pipelineDepth = Config.GetNonNegativeInteger(pipelineDepth, attribute='pipeline-depth', default=0)
+            self.dataShards = Config.GetNonNegativeInteger(dataShards, attribute='data-shards', default=0)
+            self.diffProbeThreads = Config.GetNonNegativeInteger(diffProbeThreads, attribute='diff-probe-threads', default=1)
+            self.commandThreads = Config.GetNonNegativeInteger(commandThreads, attribute='command-threads', default=0)
+            self.prefetchDepth = Config.GetNonNegativeInteger(prefetchDepth, attribute='prefetch-depth', default=0)
+
+            self.commandLimits = None
+            if commandLimits is not None:
+                # A comma separated list of <command>:<limit> pairs, e.g. "diff:4, pop:1".
+                self.commandLimits = OrderedDict()
+                for item in [x.strip() for x in commandLimits.split(',') if len(x.strip()) > 0]:
+                    command, sep, limit = item.partition(':')
+                    if len(sep) == 0 or len(command.strip()) == 0:
+                        raise Exception("Error, the command-limits attribute only accepts a comma separated list of <command>:<limit> pairs but got: {0}".format(commandLimits))
+                    self.commandLimits[command.strip()] = Config.GetNonNegativeInteger(limit.strip(), attribute='command-limits')
+
+            if reconstructVerifyRate is not None:
+                try:
+                    self.reconstructVerifyRate = float(reconstructVerifyRate)
+                except ValueError:
+                    self.reconstructVerifyRate = -1.0
+                if self.reconstructVerifyRate < 0.0 or self.reconstructVerifyRate > 1.0:
+                    raise Exception("Error, the reconstruct-verify-rate attribute only accepts a number between 0 and 1 but got: {0}".format(reconstructVerifyRate))
+            else:
+                self.reconstructVerifyRate = 0.01
     
         def __repr__(self):
             str = "Config.AccuRev(depot=" + repr(self.depot)
@@ -107,6 +153,16 @@ class Config(object):
                 str += ", commandCacheFilename=" + repr(self.commandCacheFilename)
             if self.excludeStreamTypes is not None:
                 str += ", excludeStreamTypes=" + repr(self.excludeStreamTypes)
+            if self.versionStoreFilename is not None:
+                str += ", versionStoreFilename=" + repr(self.versionStoreFilename)
+            str += ", pipelineDepth="     + repr(self.pipelineDepth)
+            str += ", dataShards="        + repr(self.dataShards)
+            str += ", reconstructVerifyRate=" + repr(self.reconstructVerifyRate)
+            str += ", diffProbeThreads="  + repr(self.diffProbeThreads)
+            str += ", commandThreads="    + repr(self.commandThreads)
+            if self.commandLimits is not None:
+                str += ", commandLimits=" + repr(self.commandLimits)
+            str += ", prefetchDepth="     + repr(self.prefetchDepth)
             str += ")"
             
             return str
@@ -125,6 +181,8 @@ class Config(object):
                 emptyChildStreamAction  = xmlElement.attrib.get('empty-child-stream-action')
                 sourceStreamFastForward = xmlElement.attrib.get('source-stream-fast-forward')
                 newBasisIsFirstParent = xmlElement.attrib.get('new-basis-is-first-parent')
+                emptyDiffCheck = xmlElement.attrib.get('empty-diff-check')
+                processThreads = xmlElement.attrib.get('process-threads')
 
                 remoteMap = OrderedDict()
                 remoteElementList = xmlElement.findall('remote')
@@ -135,11 +193,11 @@ class Config(object):
                     
                     remoteMap[remoteName] = git.GitRemoteListItem(name=remoteName, url=remoteUrl, pushUrl=remotePushUrl)
 
-                return cls(repoPath=repoPath, messageStyle=messageStyle, messageKey=messageKey, authorIsCommitter=authorIsCommitter, remoteMap=remoteMap, emptyChildStreamAction=emptyChildStreamAction, sourceStreamFastForward=sourceStreamFastForward, newBasisIsFirstParent=newBasisIsFirstParent)
+                return cls(repoPath=repoPath, messageStyle=messageStyle, messageKey=messageKey, authorIsCommitter=authorIsCommitter, remoteMap=remoteMap, emptyChildStreamAction=emptyChildStreamAction, sourceStreamFastForward=sourceStreamFastForward, newBasisIsFirstParent=newBasisIsFirstParent, emptyDiffCheck=emptyDiffCheck, processThreads=processThreads)
             else:
                 return None
             
-        def __init__(self, repoPath, messageStyle=None, messageKey=None, authorIsCommitter=None, remoteMap=None, emptyChildStreamAction=None, sourceStreamFastForward=None, newBasisIsFirstParent=None):
+        def __init__(self, repoPath, messageStyle=None, messageKey=None, authorIsCommitter=None, remoteMap=None, emptyChildStreamAction=None, sourceStreamFastForward=None, newBasisIsFirstParent=None, emptyDiffCheck=None, processThreads=None):
             self.repoPath               = repoPath
             self.messageStyle           = messageStyle
             self.messageKey             = messageKey
@@ -177,6 +235,15 @@ class Config(object):
             else:
                 self.newBasisIsFirstParent = True
 
+            if emptyDiffCheck is not None:
+                if emptyDiffCheck not in [ "auto", "tree", "diff" ]:
+                    raise Exception("Error, the empty-diff-check attribute only accepts auto, tree or diff options but got: {0}".format(emptyDiffCheck))
+                self.emptyDiffCheck = emptyDiffCheck
+            else:
+                self.emptyDiffCheck = "auto"
+
+            self.processThreads = Config.GetNonNegativeInteger(processThreads, attribute='process-threads', default=0)
+
         def __repr__(self):
             str = "Config.Git(repoPath=" + repr(self.repoPath)
             if self.messageStyle is not None:
@@ -189,6 +256,9 @@ class Config(object):
                 str += ", authorIsCommitter="    + repr(self.authorIsCommitter)
             if self.newBasisIsFirstParent is not None:
                 str += ", newBasisIsFirstParent=" + repr(self.newBasisIsFirstParent)
+            if self.emptyDiffCheck is not None:
+                str += ", emptyDiffCheck=" + repr(self.emptyDiffCheck)
+            str += ", processThreads=" + repr(self.processThreads)
             str += ")"
             
             return str
@@ -250,6 +320,18 @@ class Config(object):
 
         return value
 
+    @staticmethod
+    def GetNonNegativeInteger(value, attribute, default=None):
+        if value is None:
+            return default
+        try:
+            intValue = int(value)
+        except ValueError:
+            intValue = -1
+        if intValue < 0:
+            raise Exception("Error, the {attr} attribute only accepts a non-negative integer but got: {value}".format(attr=attribute, value=value))
+        return intValue
+
     @staticmethod
     def GetAbsoluteUsermapsFilename(filename, includedFilename):
         if includedFilename is None:
@@ -402,6 +484,734 @@ class Config(object):
         
         return str
 
+# A retry policy shared by the Try* wrappers. A failed command is retried up to \a attempts times, with a jittered exponential backoff starting at
+# \a baseSeconds, unless its error output matches one of the fatalErrorPatterns in which case retrying won't help. When \a breakerThreshold
+# commands in a row have failed the circuit breaker opens: the onTrip callback is called so that progress can be checkpointed and every caller
+# waits while the \a probe is retried every \a breakerPauseSeconds. Once the probe succeeds the breaker closes and the callers resume. If the
+# probe hasn't succeeded within \a breakerMaxPauseSeconds an exception is raised.
+# The retries and time spent waiting are counted so that they can be reported, see Summary().
+class RetryPolicy(object):
+    fatalErrorPatterns = [ re.compile(x, re.IGNORECASE) for x in [ r'not logged in', r'permission denied', r'not authorized', r'unknown (stream|depot|element|user)', r'no such (stream|depot|element|file)', r'invalid (option|argument|time ?spec)', r'usage:' ] ]
+
+    def __init__(self, attempts=3, baseSeconds=1.0, maxSeconds=60.0, breakerThreshold=10, breakerPauseSeconds=60.0, breakerMaxPauseSeconds=None, probe=None):
+        self.attempts = max(1, attempts)
+        self.baseSeconds = baseSeconds
+        self.maxSeconds = maxSeconds
+        self.breakerThreshold = breakerThreshold
+        self.breakerPauseSeconds = breakerPauseSeconds
+        self.breakerMaxPauseSeconds = breakerMaxPauseSeconds
+        self.probe = probe
+        self.onTrip = None
+
+        self.lock = threading.Lock()
+        self.closedEvent = threading.Event()
+        self.closedEvent.set()
+        self.consecutiveFailures = 0
+
+        self.retryCount = 0
+        self.retryWaitSeconds = 0.0
+        self.fatalCount = 0
+        self.breakerTrips = 0
+        self.breakerWaitSeconds = 0.0
+
+    def IsFatal(self, error):
+        if error is not None:
+            for pattern in RetryPolicy.fatalErrorPatterns:
+                if pattern.search(error) is not None:
+                    return True
+        return False
+
+    # Returns the number of seconds to wait before the given retry (0 based), the exponential backoff with up to 50% of jitter either way.
+    def GetDelay(self, retry):
+        delay = min(self.maxSeconds, self.baseSeconds * (2 ** retry))
+        return delay * random.uniform(0.5, 1.5)
+
+    # Calls \a func until \a isSuccess returns True for its result, the \a getError returns an error that is fatal or the attempts run out.
+    # If \a isExpected returns True for a failed result it is returned as is, without a retry and without counting it as a failure.
+    # Returns the result of the last call. The \a name is only used for logging.
+    def Run(self, name, func, isSuccess, getError=None, isExpected=None):
+        result = None
+        for attempt in range(0, self.attempts):
+            self.WaitUntilClosed()
+            result = func()
+            if isSuccess(result):
+                self.RecordSuccess()
+                break
+            elif isExpected is not None and isExpected(result):
+                break
+
+            error = getError(result) if getError is not None else None
+            if self.IsFatal(error):
+                with self.lock:
+                    self.fatalCount += 1
+                logger.error( "{0} failed with a non-retryable error: {1}".format(name, error.strip()) )
+                break
+
+            self.RecordFailure(name)
+            if attempt + 1 < self.attempts:
+                delay = self.GetDelay(attempt)
+                logger.warning( "{0} failed (attempt {1} of {2}), retrying in {3:.1f}s.{4}".format(name, attempt + 1, self.attempts, delay, "" if error is None or len(error.strip()) == 0 else " Error: {0}".format(error.strip())) )
+                with self.lock:
+                    self.retryCount += 1
+                    self.retryWaitSeconds += delay
+                time.sleep(delay)
+        return result
+
+    def RecordSuccess(self):
+        with self.lock:
+            self.consecutiveFailures = 0
+
+    def RecordFailure(self, name):
+        with self.lock:
+            self.consecutiveFailures += 1
+            trip = (self.breakerThreshold > 0 and self.consecutiveFailures >= self.breakerThreshold and self.closedEvent.is_set())
+            if trip:
+                self.closedEvent.clear()
+                self.breakerTrips += 1
+        if trip:
+            self.Trip(name)
+
+    def WaitUntilClosed(self):
+        if not self.closedEvent.is_set():
+            self.closedEvent.wait()
+
+    # Opens the circuit breaker, checkpoints, and waits until the probe succeeds before closing it again.
+    def Trip(self, name):
+        logger.error( "{0} consecutive command failures (last: {1}). Pausing until the server is available again.".format(self.consecutiveFailures, name) )
+        pausedSeconds = 0.0
+        try:
+            if self.onTrip is not None:
+                self.onTrip()
+
+            while True:
+                time.sleep(self.breakerPauseSeconds)
+                pausedSeconds += self.breakerPauseSeconds
+                if self.probe is None or self.probe():
+                    break
+                if self.breakerMaxPauseSeconds is not None and pausedSeconds >= self.breakerMaxPauseSeconds:
+                    raise Exception("The server has been unavailable for {0:.0f}s, giving up.".format(pausedSeconds))
+                logger.warning( "Server still unavailable after {0:.0f}s, waiting.".format(pausedSeconds) )
+            logger.info( "Server available again after {0:.0f}s, resuming.".format(pausedSeconds) )
+        finally:
+            with self.lock:
+                self.breakerWaitSeconds += pausedSeconds
+                self.consecutiveFailures = 0
+            self.closedEvent.set()
+
+    def Summary(self):
+        with self.lock:
+            return "{0} retries ({1:.1f}s waiting), {2} non-retryable failures, circuit breaker opened {3} times ({4:.1f}s paused)".format(self.retryCount, self.retryWaitSeconds, self.fatalCount, self.breakerTrips, self.breakerWaitSeconds)
+
+# An in-memory graph of the commits in the repository which answers "is commit A an ancestor of commit B" without running `git merge-base`.
+# Every commit stores its parents and its generation number (1 for a root commit, otherwise one more than the largest generation of its
+# parents) so that a search for an ancestor can stop at any commit whose generation isn't larger than the ancestor's. Commits whose parents
+# aren't in the graph have no generation and any question that reaches them is answered with None, meaning that git should be asked instead.
+class CommitGraph(object):
+    def __init__(self):
+        self.parents = {}
+        self.generations = {}
+
+    def __len__(self):
+        return len(self.parents)
+
+    # Adds a commit to the graph. Its parents should already be in the graph, see git.repo.rev_list_parents().
+    def Add(self, commitHash, parents):
+        if commitHash in self.parents:
+            return
+        generation = 1
+        for parent in parents:
+            parentGeneration = self.generations.get(parent)
+            if parentGeneration is None:
+                generation = None
+                break
+            generation = max(generation, parentGeneration + 1)
+        self.parents[commitHash] = tuple(parents)
+        self.generations[commitHash] = generation
+
+    # Returns True if \a ancestor is \a commitHash or one of its ancestors, False if it isn't and None if the graph doesn't know.
+    def IsAncestor(self, ancestor, commitHash):
+        if ancestor == commitHash:
+            return True if ancestor in self.parents else None
+        ancestorGeneration = self.generations.get(ancestor)
+        if ancestorGeneration is None or self.generations.get(commitHash) is None:
+            return None
+
+        visited = set([ commitHash ])
+        stack = [ commitHash ]
+        while len(stack) > 0:
+            for parent in self.parents[stack.pop()]:
+                if parent == ancestor:
+                    return True
+                elif parent in visited:
+                    continue
+                visited.add(parent)
+                generation = self.generations.get(parent)
+                if generation is None:
+                    return None
+                elif generation > ancestorGeneration:
+                    stack.append(parent)
+        return False
+
+# The transactions of all the tracked streams and the state and data commits that were recorded for them, as used by ProcessTransactions().
+# Each stream keeps its transaction numbers in sorted integer arrays and the commit and tree hashes as 20 byte binary values in bytearrays
+# so that even hundreds of thousands of transactions for hundreds of streams fit in memory. Items() lazily merges the streams into a single
+# sequence of (transaction, affected streams) pairs and AffectedStreamMap() turns the affected streams into the { <stream_num>: { "state_hash",
+# "data_hash", "data_tree_hash" } } dictionary that ProcessTransaction() expects.
+class TransactionsMap(object):
+    hashSize = 20
+
+    def __init__(self):
+        self.streams = OrderedDict()
+
+    # Adds the stream's transaction to state commit hash map \a stateMap and the list of (transaction, data commit hash, data tree hash) tuples \a dataList.
+    def AddStream(self, streamNumber, stateMap, dataList):
+        stateTrs, stateHashes = array.array('q'), bytearray()
+        for tr in sorted(stateMap):
+            stateTrs.append(tr)
+            stateHashes.extend(binascii.unhexlify(stateMap[tr]))
+
+        dataHashMap = {}
+        for tr, commitHash, treeHash in dataList:
+            dataHashMap[tr] = (commitHash, treeHash)
+        dataTrs, dataHashes, dataTreeHashes = array.array('q'), bytearray(), bytearray()
+        for tr in sorted(dataHashMap):
+            assert tr in stateMap, "Invariant error! The data ref should contain a subset of the state ref information, not a superset!"
+            dataTrs.append(tr)
+            dataHashes.extend(binascii.unhexlify(dataHashMap[tr][0]))
+            dataTreeHashes.extend(binascii.unhexlify(dataHashMap[tr][1]))
+
+        self.streams[streamNumber] = (stateTrs, stateHashes, dataTrs, dataHashes, dataTreeHashes)
+
+    def GetHash(self, hashes, index):
+        return binascii.hexlify(hashes[index * TransactionsMap.hashSize:(index + 1) * TransactionsMap.hashSize]).decode('ascii')
+
+    def IterStream(self, streamNumber):
+        stateTrs, stateHashes, dataTrs, dataHashes, dataTreeHashes = self.streams[streamNumber]
+        dataIndex = 0
+        for stateIndex, tr in enumerate(stateTrs):
+            if dataIndex < len(dataTrs) and dataTrs[dataIndex] == tr:
+                yield (tr, streamNumber, stateIndex, dataIndex)
+                dataIndex += 1
+            else:
+                yield (tr, streamNumber, stateIndex, None)
+
+    # Yields a (transaction, affectedStreams) tuple for every transaction in ascending order where affectedStreams should only be passed to AffectedStreamMap().
+    def Items(self):
+        trId, affectedStreams = None, []
+        for tr, streamNumber, stateIndex, dataIndex in heapq.merge(*[ self.IterStream(sn) for sn in self.streams ]):
+            if tr != trId:
+                if trId is not None:
+                    yield trId, affectedStreams
+                trId, affectedStreams = tr, []
+            affectedStreams.append( (streamNumber, stateIndex, dataIndex) )
+        if trId is not None:
+            yield trId, affectedStreams
+
+    # Returns a { "state_hash", "data_hash" } dictionary with the last state and data commits of the stream at or before transaction \a trId. Either
+    # of the values can be missing if there were no such commits.
+    def Checkpoint(self, streamNumber, trId):
+        stateTrs, stateHashes, dataTrs, dataHashes, dataTreeHashes = self.streams[streamNumber]
+        checkpoint = {}
+        stateIndex = bisect.bisect_right(stateTrs, trId) - 1
+        if stateIndex >= 0:
+            checkpoint["state_hash"] = self.GetHash(stateHashes, stateIndex)
+        dataIndex = bisect.bisect_right(dataTrs, trId) - 1
+        if dataIndex >= 0:
+            checkpoint["data_hash"] = self.GetHash(dataHashes, dataIndex)
+        return checkpoint
+
+    # Returns the info commit hash of the first of the affected streams, which is the one ProcessTransaction() reads the transaction's inputs from.
+    def FirstStateHash(self, affectedStreams):
+        streamNumber, stateIndex, dataIndex = affectedStreams[0]
+        return self.GetHash(self.streams[streamNumber][1], stateIndex)
+
+    def AffectedStreamMap(self, affectedStreams):
+        affectedStreamMap = OrderedDict()
+        for streamNumber, stateIndex, dataIndex in affectedStreams:
+            stateTrs, stateHashes, dataTrs, dataHashes, dataTreeHashes = self.streams[streamNumber]
+            streamData = { "state_hash": self.GetHash(stateHashes, stateIndex) }
+            if dataIndex is not None:
+                streamData["data_hash"] = self.GetHash(dataHashes, dataIndex)
+                streamData["data_tree_hash"] = self.GetHash(dataTreeHashes, dataIndex)
+            affectedStreamMap[streamNumber] = streamData
+        return affectedStreamMap
+
+# Parses the streams.xml and hist.xml of a transaction. A module level function so that it can run in the TransactionPrefetcher's process pool.
+def ParseTransactionInputs(streamsXml, histXml):
+    streams = accurev.obj.Show.Streams.fromxmlstring(streamsXml) if streamsXml is not None and len(streamsXml) != 0 else None
+    hist = accurev.obj.History.fromxmlstring(histXml) if histXml is not None and len(histXml) != 0 else None
+    return streams, hist
+
+# Reads the streams.xml and hist.xml of upcoming transactions (given by their info commit hashes) from git on a background thread and parses them
+# in a process pool while the current transaction is being committed. At most \a depth transactions are prefetched at a time so the memory used is
+# bounded, and Get() returns the inputs in whatever order they are asked for so the transactions are still committed strictly in order.
+# The inputs of the last few transactions that were returned are kept since a chstream transaction also needs the streams of the one before it.
+class TransactionPrefetcher(object):
+    keepRecentCount = 2
+
+    def __init__(self, gitRepoPath, depth, processCount=None):
+        self.gitRepo = git.repo(gitRepoPath) # Our own, the git.repo objects remember the result of the last command so they can't be shared between threads.
+        self.depth = depth
+        self.ioExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.parseExecutor = None
+        if processCount is None or processCount > 0:
+            try:
+                # The pool's processes are spawned rather than forked since forking a process that is running threads (the prefetch thread, the
+                # command executor, ...) can leave locks that another thread was holding locked forever in the child.
+                self.parseExecutor = concurrent.futures.ProcessPoolExecutor(max_workers=processCount, mp_context=multiprocessing.get_context('spawn'))
+            except (OSError, NotImplementedError, TypeError, ValueError) as e:
+                logger.warning("Failed to start the prefetch process pool, parsing on the prefetch thread instead. Err: {0}".format(e))
+        self.pending = OrderedDict()
+        self.recent = OrderedDict()
+
+    def Close(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.ioExecutor.shutdown(wait=True)
+        if self.parseExecutor is not None:
+            self.parseExecutor.shutdown(wait=True)
+
+    def ReadXml(self, ref, filename):
+        return self.gitRepo.raw_cmd(['git', 'show', '{hash}:{filename}'.format(hash=ref, filename=filename)])
+
+    # Runs on the prefetch thread. Reads the XML files and hands them to the process pool so that the next transaction can be read while they are parsed.
+    # Returns a (streamsXml, histXml, parseFuture) tuple where the parseFuture is None if there is no process pool.
+    def Load(self, ref):
+        streamsXml, histXml = self.ReadXml(ref, 'streams.xml'), self.ReadXml(ref, 'hist.xml')
+        parseFuture = None
+        parseExecutor = self.parseExecutor
+        if parseExecutor is not None:
+            try:
+                parseFuture = parseExecutor.submit(ParseTransactionInputs, streamsXml, histXml)
+            except RuntimeError:
+                pass # The process pool was shut down by Get(), the inputs will be parsed there instead.
+        return (streamsXml, histXml, parseFuture)
+
+    # Starts loading the inputs for the info commit \a ref unless they are already loaded or loading, or the prefetcher is full.
+    def Prefetch(self, ref):
+        if ref in self.pending or ref in self.recent or len(self.pending) >= self.depth:
+            return False
+        self.pending[ref] = self.ioExecutor.submit(self.Load, ref)
+        return True
+
+    # Returns the (streamsXml, streams, histXml, hist) tuple for the info commit \a ref or None if it wasn't prefetched.
+    def Get(self, ref):
+        result = self.recent.get(ref)
+        if result is None:
+            future = self.pending.pop(ref, None)
+            if future is None:
+                return None
+            streamsXml, histXml, parseFuture = future.result()
+            streams, hist = None, None
+            if parseFuture is not None:
+                try:
+                    streams, hist = parseFuture.result()
+                except Exception as e:
+                    # e.g. the parsed objects couldn't be pickled. Parsing in this process still works so do that from now on.
+                    logger.warning("Failed to parse the inputs for {ref} in the process pool, parsing them in this process from now on. Err: {err}".format(ref=ref, err=e))
+                    self.parseExecutor.shutdown(wait=False)
+                    self.parseExecutor = None
+                    parseFuture = None
+            if parseFuture is None:
+                streams, hist = ParseTransactionInputs(streamsXml, histXml)
+            result = (streamsXml, streams, histXml, hist)
+            self.recent[ref] = result
+            while len(self.recent) > TransactionPrefetcher.keepRecentCount:
+                self.recent.popitem(last=False)
+        return result
+
+# A transaction that ProcessTransactions() has scheduled on one of its threads, see AccuRev2Git.ScheduleTransaction(). The branch heads
+# that it changes and the commit_history entries that it logs are recorded here, instead of going straight into the branch state, so that they
+# are only saved once all of the transactions before it are done too.
+class ScheduledTransaction(object):
+    def __init__(self, trId, affectedStreamMap, prevAffectedStreamMap, streams, trHist, keys):
+        self.trId = trId
+        self.affectedStreamMap = affectedStreamMap
+        self.prevAffectedStreamMap = prevAffectedStreamMap
+        self.streams = streams
+        self.trHist = trHist
+        self.keys = keys
+        self.future = None
+        self.changedHeads = OrderedDict()
+        self.branchStates = []
+
+# The parent/child tree of all the streams in a depot. It is built once from the streams.xml of a transaction and then only updated for the
+# streams whose basis changed (see Update() and AccuRev2Git.GetStreamTree()) instead of being rebuilt for every transaction. Prune() returns the tree of only
+# the given streams, in the same form that the MergeIntoChildren() algorithm expects, by walking up from each of them to its nearest kept ancestor.
+class StreamTree(object):
+    def __init__(self, streams):
+        self.parents = {}
+        self.children = {}
+        self.streams = {}
+        self.order = {}
+        for s in streams:
+            self.streams[s.streamNumber] = s
+            self.order[s.streamNumber] = len(self.order)
+            self.children[s.streamNumber] = []
+        for s in streams:
+            self.SetBasis(s)
+
+    def __len__(self):
+        return len(self.streams)
+
+    # Adds the stream to the tree or moves it under its new basis stream.
+    def SetBasis(self, stream):
+        sn = stream.streamNumber
+        if sn not in self.streams:
+            self.order[sn] = len(self.order)
+            self.children[sn] = []
+        self.streams[sn] = stream
+
+        prevParent = self.parents.get(sn)
+        if prevParent is not None and sn in self.children.get(prevParent, []):
+            self.children[prevParent].remove(sn)
+        self.parents[sn] = stream.basisStreamNumber
+        if stream.basisStreamNumber is not None:
+            if stream.basisStreamNumber not in self.children:
+                raise Exception("Incomplete set of streams given! Stream {s} is missing from the streams list, cannot build tree!".format(s=stream.basisStreamNumber))
+            self.children[stream.basisStreamNumber].append(sn)
+
+    # Brings the tree up to date with the list of \a streams, moving the streams whose basis changed. Returns False, without changing anything, if
+    # streams were added or removed since the tree then has to be rebuilt to keep them in the order of the list.
+    def Update(self, streams):
+        if len(streams) != len(self.streams) or any(s.streamNumber not in self.streams for s in streams):
+            return False
+        for s in streams:
+            if self.parents.get(s.streamNumber) != s.basisStreamNumber:
+                self.SetBasis(s)
+            else:
+                self.streams[s.streamNumber] = s
+        return True
+
+    def Prune(self, keepList):
+        keepSet = set([ sn for sn in keepList if sn in self.streams ])
+        rv = {}
+        for sn in sorted(keepSet, key=lambda x: self.order[x]):
+            p = self.parents[sn]
+            while p is not None and p not in keepSet:
+                p = self.parents.get(p)
+            rv[sn] = { "parent": p, "children": [], "self": self.streams[sn] }
+        for sn in rv:
+            p = rv[sn]["parent"]
+            if p is not None:
+                rv[p]["children"].append(sn)
+        return rv
+
+# The (timestamp, transaction, commit) entries of a stream's commit_history ref, in the order in which they were committed, and the hash of the
+# state commit that the last entry came from (see AccuRev2Git.LogBranchState()). Find() returns the same commit as
+# `git log -1 --first-parent --before=<timestamp>` on the commit_history ref would, using a binary search over the suffix minimums of the
+# timestamps so that it stays correct even if the transaction times aren't monotonic.
+class StreamTimeline(object):
+    def __init__(self, head=None, entries=[]):
+        self.head = None
+        self.entries = []
+        self.suffixMin = []
+        self.dirty = False
+        for timestamp, trId, commitHash in entries:
+            self.Append(timestamp, trId, commitHash)
+        self.head = head
+
+    def __len__(self):
+        return len(self.entries)
+
+    def Append(self, timestamp, trId, commitHash, head=None):
+        timestamp = int(timestamp)
+        self.entries.append( (timestamp, int(trId), commitHash) )
+        self.suffixMin.append(timestamp)
+        i = len(self.suffixMin) - 2
+        while i >= 0 and self.suffixMin[i] > timestamp:
+            self.suffixMin[i] = timestamp
+            i -= 1
+        if head is not None:
+            self.head = head
+
+    # Returns the (timestamp, transaction, commit) entry of the first transaction or None if the timeline is empty.
+    def First(self):
+        return self.entries[0] if len(self.entries) > 0 else None
+
+    # Returns the latest (timestamp, transaction, commit) entry with a timestamp at or before the given \a timestamp or None if there isn't one.
+    def Find(self, timestamp):
+        i = bisect.bisect_right(self.suffixMin, int(timestamp)) - 1
+        return self.entries[i] if i >= 0 else None
+
+    def tojson(self):
+        return json.dumps({ "head": self.head, "entries": self.entries })
+
+    @classmethod
+    def fromjson(cls, jsonText):
+        data = json.loads(jsonText)
+        return cls(head=data["head"], entries=data["entries"])
+
+# A local store which maps element versions (depot, eid and real version) to the git blobs that they were committed as. Since the contents of an
+# element version never change they only need to be retrieved from Accurev once, no matter how many streams or transactions see them. Element ids
+# are only unique within a depot so the depot is part of the key.
+class ElementVersionStore(object):
+    formatVersion = 2
+    createTableQuery = '''
+CREATE TABLE IF NOT EXISTS element_versions (
+  depot   TEXT NOT NULL,
+  eid     INT NOT NULL,
+  version TEXT NOT NULL,
+  mode    TEXT NOT NULL,
+  hash    TEXT NOT NULL,
+  PRIMARY KEY (depot, eid, version)
+);
+'''
+
+    def __enter__(self):
+        self.Close()
+        self.Open()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+        return False
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.connection = None
+        self.cursor = None
+
+    def Open(self):
+        self.connection = sqlite3.connect(self.filepath)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute('PRAGMA user_version;')
+        if self.cursor.fetchone()[0] != ElementVersionStore.formatVersion:
+            # Written by a different version of the script (or empty). The old entries weren't keyed by depot so start over.
+            self.cursor.execute('DROP TABLE IF EXISTS element_versions;')
+            self.cursor.execute('PRAGMA user_version = {0};'.format(ElementVersionStore.formatVersion))
+        self.cursor.execute(ElementVersionStore.createTableQuery)
+        self.connection.commit()
+
+    def Close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    # Returns a (mode, hash) tuple for the element version in the \a depot or None if it isn't in the store.
+    def Get(self, depot, eid, version):
+        self.cursor.execute('SELECT mode, hash FROM element_versions WHERE depot = ? AND eid = ? AND version = ?;', (str(depot), int(eid), str(version)))
+        return self.cursor.fetchone()
+
+    # Adds a list of (eid, version, mode, hash) tuples for the \a depot to the store. Element versions that are already in the store are left unchanged.
+    def AddList(self, depot, entries):
+        self.cursor.executemany('INSERT OR IGNORE INTO element_versions (depot, eid, version, mode, hash) VALUES (?, ?, ?, ?, ?);', [ (str(depot), int(eid), str(version), mode, objHash) for eid, version, mode, objHash in entries ])
+        self.connection.commit()
+
+# A cache of the transaction information that stage 1 commits to the info refs (the hist.xml and streams.xml files) together with the info and
+# data commits that were made for each stream. The hist.xml is parsed once, when the transaction is added, and only the values that stage 2 uses
+# are kept while the streams.xml is kept once per distinct blob (i.e. per version of the stream list), with the names of its streams indexed,
+# so that it only needs to be parsed when it changes. The journal can always be rebuilt from the refs, see AccuRev2Git.UpdateTransactionJournal(),
+# so it is safe to delete.
+class TransactionJournal(object):
+    formatVersion = 2
+    createTablesQuery = '''
+CREATE TABLE IF NOT EXISTS transactions (
+  depot              INT NOT NULL,
+  id                 INT NOT NULL,
+  type               TEXT NOT NULL,
+  user               TEXT,
+  time               REAL,
+  comment            TEXT,
+  stream_name        TEXT,
+  stream_number      INT,
+  from_stream_name   TEXT,
+  from_stream_number INT,
+  stream             TEXT,
+  PRIMARY KEY (depot, id)
+);
+CREATE TABLE IF NOT EXISTS stream_lists (
+  hash TEXT NOT NULL PRIMARY KEY,
+  xml  TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stream_list_names (
+  name TEXT NOT NULL,
+  hash TEXT NOT NULL,
+  PRIMARY KEY (name, hash)
+);
+CREATE TABLE IF NOT EXISTS info_commits (
+  depot         INT NOT NULL,
+  stream_number INT NOT NULL,
+  tr            INT NOT NULL,
+  hash          TEXT NOT NULL,
+  streams_hash  TEXT NOT NULL,
+  PRIMARY KEY (depot, stream_number, tr)
+);
+CREATE INDEX IF NOT EXISTS info_commits_hash ON info_commits (hash);
+CREATE INDEX IF NOT EXISTS info_commits_streams_hash ON info_commits (streams_hash, depot, tr);
+CREATE TABLE IF NOT EXISTS data_commits (
+  depot         INT NOT NULL,
+  stream_number INT NOT NULL,
+  tr            INT NOT NULL,
+  hash          TEXT NOT NULL,
+  tree_hash     TEXT NOT NULL,
+  PRIMARY KEY (depot, stream_number, tr)
+);
+CREATE TABLE IF NOT EXISTS stream_heads (
+  depot         INT NOT NULL,
+  stream_number INT NOT NULL,
+  info_hash     TEXT,
+  data_hash     TEXT,
+  PRIMARY KEY (depot, stream_number)
+);
+'''
+    streamAttributes = [ 'name', 'streamNumber', 'depotName', 'Type', 'basis', 'basisStreamNumber', 'time', 'prevTime', 'prevBasis', 'prevBasisStreamNumber', 'prevName', 'startTime', 'isDynamic', 'hasDefaultGroup' ]
+
+    def __enter__(self):
+        self.Close()
+        self.Open()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+        return False
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.connection = None
+        self.cursor = None
+
+    def Open(self):
+        self.connection = sqlite3.connect(self.filepath)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute('PRAGMA user_version;')
+        userVersion = self.cursor.fetchone()[0]
+        if userVersion != TransactionJournal.formatVersion:
+            # Written by a different version of the script (or empty). It is only a cache so start over.
+            for table in [ 'transactions', 'stream_lists', 'stream_list_names', 'info_commits', 'data_commits', 'stream_heads' ]:
+                self.cursor.execute('DROP TABLE IF EXISTS {0};'.format(table))
+            self.cursor.execute('PRAGMA user_version = {0};'.format(TransactionJournal.formatVersion))
+        self.cursor.executescript(TransactionJournal.createTablesQuery)
+        self.connection.commit()
+
+    def Close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def Commit(self):
+        self.connection.commit()
+
+    def Rollback(self):
+        self.connection.rollback()
+
+    # Converts the accurev.obj.Stream of a mkstream or chstream transaction to and from the JSON text that is stored in the transactions table.
+    # Returns None for streams that can't be stored, e.g. workspaces, in which case the transaction isn't added to the journal.
+    @staticmethod
+    def StreamToJson(stream):
+        if stream is None:
+            return None
+        elif stream.workspace is not None:
+            return None
+        values = {}
+        for attribute in TransactionJournal.streamAttributes:
+            value = getattr(stream, attribute)
+            if isinstance(value, datetime):
+                value = accurev.GetTimestamp(value)
+            elif isinstance(value, accurev.obj.Bool):
+                value = repr(value)
+            values[attribute] = value
+        return json.dumps(values)
+
+    @staticmethod
+    def StreamFromJson(text):
+        if text is None:
+            return None
+        return accurev.obj.Stream(**json.loads(text))
+
+    # Returns the (info commit hash, data commit hash) tuple that the stream's refs were at when the journal was last updated or (None, None).
+    def GetStreamHeads(self, depot, streamNumber):
+        self.cursor.execute('SELECT info_hash, data_hash FROM stream_heads WHERE depot = ? AND stream_number = ?;', (int(depot), int(streamNumber)))
+        row = self.cursor.fetchone()
+        return (None, None) if row is None else row
+
+    def SetStreamHeads(self, depot, streamNumber, infoHash, dataHash):
+        self.cursor.execute('INSERT OR REPLACE INTO stream_heads (depot, stream_number, info_hash, data_hash) VALUES (?, ?, ?, ?);', (int(depot), int(streamNumber), infoHash, dataHash))
+
+    # Forgets all of the commits of the stream, used when its refs were rewritten. The transactions and stream lists are kept since they are
+    # keyed by the transaction number and blob hash which don't change.
+    def RemoveStream(self, depot, streamNumber):
+        for table in [ 'info_commits', 'data_commits', 'stream_heads' ]:
+            self.cursor.execute('DELETE FROM {0} WHERE depot = ? AND stream_number = ?;'.format(table), (int(depot), int(streamNumber)))
+
+    def HasTransaction(self, depot, trId):
+        self.cursor.execute('SELECT 1 FROM transactions WHERE depot = ? AND id = ?;', (int(depot), int(trId)))
+        return self.cursor.fetchone() is not None
+
+    def HasStreamList(self, streamsHash):
+        self.cursor.execute('SELECT 1 FROM stream_lists WHERE hash = ?;', (streamsHash,))
+        return self.cursor.fetchone() is not None
+
+    # Adds the accurev.obj.Transaction \a tr with the affected stream and source stream as worked out from the whole hist.xml.
+    def AddTransaction(self, depot, tr, toStream, fromStream, streamJson):
+        self.cursor.execute('INSERT OR REPLACE INTO transactions (depot, id, type, user, time, comment, stream_name, stream_number, from_stream_name, from_stream_number, stream) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);',
+                            (int(depot), tr.id, tr.Type, tr.user, accurev.GetTimestamp(tr.time), tr.comment, toStream[0], toStream[1], fromStream[0], fromStream[1], streamJson))
+
+    # Adds the \a streamsXml along with the names of the streams in it, so that FindStreamList() doesn't have to search the XML.
+    def AddStreamList(self, streamsHash, streamsXml, streamNames):
+        self.cursor.execute('INSERT OR IGNORE INTO stream_lists (hash, xml) VALUES (?, ?);', (streamsHash, streamsXml))
+        self.cursor.executemany('INSERT OR IGNORE INTO stream_list_names (name, hash) VALUES (?, ?);', [ (name, streamsHash) for name in set(streamNames) ])
+
+    # Adds a list of (transaction, info commit hash, streams.xml blob hash) tuples for the stream.
+    def AddInfoCommits(self, depot, streamNumber, entries):
+        self.cursor.executemany('INSERT OR REPLACE INTO info_commits (depot, stream_number, tr, hash, streams_hash) VALUES (?, ?, ?, ?, ?);', [ (int(depot), int(streamNumber), int(trId), commitHash, streamsHash) for trId, commitHash, streamsHash in entries ])
+
+    # Adds a list of (transaction, data commit hash, data tree hash) tuples for the stream.
+    def AddDataCommits(self, depot, streamNumber, entries):
+        self.cursor.executemany('INSERT OR REPLACE INTO data_commits (depot, stream_number, tr, hash, tree_hash) VALUES (?, ?, ?, ?, ?);', [ (int(depot), int(streamNumber), int(trId), commitHash, treeHash) for trId, commitHash, treeHash in entries ])
+
+    # Returns the stream's { <tr_num>: <info_commit_hash> } map for the transactions after \a afterTr (all of them if it is None).
+    def GetStateMap(self, depot, streamNumber, afterTr=None):
+        self.cursor.execute('SELECT tr, hash FROM info_commits WHERE depot = ? AND stream_number = ? AND tr > ? ORDER BY tr;', (int(depot), int(streamNumber), -1 if afterTr is None else int(afterTr)))
+        return OrderedDict(self.cursor.fetchall())
+
+    # Returns the stream's list of (transaction, data commit hash, data tree hash) tuples for the transactions after \a afterTr (all of them if it is None).
+    def GetDataList(self, depot, streamNumber, afterTr=None):
+        self.cursor.execute('SELECT tr, hash, tree_hash FROM data_commits WHERE depot = ? AND stream_number = ? AND tr > ? ORDER BY tr;', (int(depot), int(streamNumber), -1 if afterTr is None else int(afterTr)))
+        return self.cursor.fetchall()
+
+    # Returns the transaction number of the stream's info or data commit \a commitHash or None if it isn't in the journal.
+    def GetCommitTransaction(self, depot, streamNumber, commitHash, isDataCommit=False):
+        self.cursor.execute('SELECT tr FROM {0} WHERE depot = ? AND stream_number = ? AND hash = ?;'.format('data_commits' if isDataCommit else 'info_commits'), (int(depot), int(streamNumber), commitHash))
+        row = self.cursor.fetchone()
+        return None if row is None else row[0]
+
+    # Returns the streams.xml blob hash of the info commit \a commitHash or None if it isn't in the journal.
+    def GetStreamsHash(self, commitHash):
+        self.cursor.execute('SELECT streams_hash FROM info_commits WHERE hash = ? LIMIT 1;', (commitHash,))
+        row = self.cursor.fetchone()
+        return None if row is None else row[0]
+
+    def GetStreamList(self, streamsHash):
+        self.cursor.execute('SELECT xml FROM stream_lists WHERE hash = ?;', (streamsHash,))
+        row = self.cursor.fetchone()
+        return None if row is None else row[0]
+
+    # Returns the accurev.obj.Transaction recorded for the info commit \a commitHash or None if it isn't in the journal. The transaction has no
+    # versions or moves but its streamName, streamNumber, fromStreamName and fromStreamNumber are always set to the affected and source streams.
+    def GetTransaction(self, commitHash):
+        self.cursor.execute('SELECT t.id, t.type, t.user, t.time, t.comment, t.stream_name, t.stream_number, t.from_stream_name, t.from_stream_number, t.stream FROM info_commits i JOIN transactions t ON t.depot = i.depot AND t.id = i.tr WHERE i.hash = ? LIMIT 1;', (commitHash,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        trId, Type, user, time, comment, streamName, streamNumber, fromStreamName, fromStreamNumber, streamJson = row
+        return accurev.obj.Transaction(id=trId, Type=Type, time=time, user=user, comment=comment, streamName=streamName, streamNumber=streamNumber, fromStreamName=fromStreamName, fromStreamNumber=fromStreamNumber, versions=[], moves=[], stream=TransactionJournal.StreamFromJson(streamJson))
+
+    # Returns the (streams.xml blob hash, streams.xml) tuple of the earliest transaction whose stream list has a stream named \a streamName or (None, None).
+    def FindStreamList(self, depot, streamName):
+        self.cursor.execute('SELECT s.hash, s.xml FROM stream_list_names n JOIN info_commits i ON i.streams_hash = n.hash JOIN stream_lists s ON s.hash = n.hash WHERE n.name = ? AND i.depot = ? ORDER BY i.tr LIMIT 1;', (streamName, int(depot)))
+        row = self.cursor.fetchone()
+        return (None, None) if row is None else row
+
 # Prescribed recepie:
 # - Get the list of tracked streams from the config file.
 # - For each stream in the list
@@ -426,11 +1236,85 @@ class AccuRev2Git(object):
 
     commandFailureRetryCount = 3
     commandFailureSleepSeconds = 3
+    commandFailureMaxSleepSeconds = 120
+    circuitBreakerThreshold = 10       # Consecutive command failures after which everything pauses until Accurev responds again, see RetryPolicy.
+    circuitBreakerPauseSeconds = 60
+    circuitBreakerMaxPauseSeconds = 24 * 60 * 60
+    # The git errors which mean that a ref or revision doesn't exist, see IsGitMissingRefError().
+    gitMissingRefErrorPatterns = [ re.compile(x, re.IGNORECASE) for x in [ r'unknown revision', r'bad revision', r'not a valid (object name|ref)', r'needed a single revision', r'does not have any commits yet' ] ]
+
+    # Transaction types which are always probed by the diff method's prefilter, see GetDiffCandidateTransactions().
+    diffPrefilterProbeTypes = [ "chstream", "revert" ]
+
+    # The number of info commits whose files are read from git at a time while updating the transaction journal, see UpdateTransactionJournal().
+    journalBatchSize = 500
+    # The number of parsed stream lists that are kept in memory, see GetJournalStreams().
+    streamListCacheSize = 4
+    # The number of commit tree hashes that are kept in memory, see GetCachedTreeHash(). Older ones are looked up in git again when needed.
+    commitTreeHashCacheSize = 100000
+    # The number of transactions per thread that ScheduleTransaction() lets run ahead of the last one whose state was saved.
+    scheduledTransactionsPerThread = 8
+
+    # The hash of the empty blob, which is what the empty directory placeholders are committed as, see PreserveEmptyDirs().
+    emptyBlobHash = 'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391'
+
+    # The smallest number of transactions that is worth a shard of its own, see RetrieveStreamDataSharded().
+    minTransactionsPerDataShard = 50
+
+    # Parameters of the 'auto' method's per stream and transaction range choice, see ChooseStreamMethod().
+    autoMethodChunkSize = 5000          # The number of transactions in each part of the range that a method is chosen for.
+    autoMethodSampleSize = 100          # The number of most recent transactions in the range that are sampled with `accurev hist`.
+    autoMethodDiffDensity = 0.5         # The share of sampled transactions that must affect the stream for the 'diff' method to be chosen.
+    autoMethodQuietStreamDensity = 0.1  # The share of the affecting transactions below which the stream itself is considered quiet.
+    autoMethodMinServerVersion = (6, 1) # The accurev server version below which only the 'pop' method can be used.
+
+    # The git.repo of the conversion repository. The scheduler's threads each have their own, see RunScheduledTransaction(), since a git.repo
+    # remembers the result of the last command that it ran and can't be shared between threads.
+    @property
+    def gitRepo(self):
+        taskLocal = self.__dict__.get('taskLocal')
+        threadGitRepo = getattr(taskLocal, 'gitRepo', None) if taskLocal is not None else None
+        return threadGitRepo if threadGitRepo is not None else self.__dict__.get('mainGitRepo')
+
+    @gitRepo.setter
+    def gitRepo(self, value):
+        self.mainGitRepo = value
 
     def __init__(self, config):
         self.config = config
         self.cwd = None
         self.gitRepo = None
+        self.commitCacheLock = threading.Lock()
+        self.diffProbeExecutor = None
+        self.elementVersionStore = None
+        self.accurevRetryPolicy = RetryPolicy(attempts=AccuRev2Git.commandFailureRetryCount, baseSeconds=AccuRev2Git.commandFailureSleepSeconds, maxSeconds=AccuRev2Git.commandFailureMaxSleepSeconds, breakerThreshold=AccuRev2Git.circuitBreakerThreshold, breakerPauseSeconds=AccuRev2Git.circuitBreakerPauseSeconds, breakerMaxPauseSeconds=AccuRev2Git.circuitBreakerMaxPauseSeconds, probe=self.IsAccurevAvailable)
+        self.gitRetryPolicy = RetryPolicy(attempts=AccuRev2Git.commandFailureRetryCount, baseSeconds=AccuRev2Git.commandFailureSleepSeconds, maxSeconds=AccuRev2Git.commandFailureMaxSleepSeconds, breakerThreshold=0) # git is local so there is no server to wait for.
+        self.streamMethod = None
+        self.streamMethodRange = None
+        self.branchHeads = None
+        self.branchHeadsStale = False
+        self.currentBranchRef = None
+        self.commitTreeHashes = OrderedDict()
+        self.commitGraph = None
+        self.streamTimelines = None
+        self.branchStateBuffer = None
+        self.streamTree = None
+        self.streamTreeStreams = None
+        self.transactionPrefetcher = None
+        self.transactionJournal = None
+        self.streamListCache = OrderedDict()
+        self.streamKeyCache = None
+        self.transactionExecutor = None
+        self.transactionThreadCount = None
+        self.scheduledTransactions = None
+        self.scheduledKeys = None
+        self.committedBranchHeads = None
+        self.taskLocal = threading.local()
+        self.branchHeadsLock = threading.RLock()
+        self.streamTreeLock = threading.Lock()
+        self.streamTimelinesLock = threading.Lock()
+        self.notesLock = threading.Lock()
+        self.serverVersion = None
 
     # Returns True if the path was deleted, otherwise false
     def DeletePath(self, path):
@@ -494,6 +1378,64 @@ class AccuRev2Git(object):
                             deletedDirs.append(path)
         return deletedDirs
 
+    # Returns True if the directory at \a path only contains the empty .gitignore file that PreserveEmptyDirs() adds to empty directories.
+    def IsPreservedEmptyDir(self, path):
+        if os.path.islink(path) or not os.path.isdir(path) or os.listdir(path) != [ '.gitignore' ]:
+            return False
+        return os.path.getsize(os.path.join(path, '.gitignore')) == 0
+
+    # Returns the set of the directories, relative to the git repo, that contain the elements of the \a diff along with all of their parent
+    # directories, except for the root of the repo.
+    def GetDiffParentDirs(self, diff):
+        dirPaths = set()
+        for element in diff.elements:
+            for change in element.changes:
+                for elem in [ change.stream1, change.stream2 ]:
+                    path = self.DepotPathToGitPath(elem.name) if elem is not None else None
+                    while path is not None:
+                        path = path.rpartition('/')[0]
+                        if len(path) == 0:
+                            break
+                        dirPaths.add(path)
+        return dirPaths
+
+    # Returns the set of the directories from GetDiffParentDirs() that are currently preserved empty directories, see IsPreservedEmptyDir().
+    # Must be called before the elements of the \a diff are deleted and populated, see UpdateEmptyDirPlaceholders().
+    def GetPreservedDiffParentDirs(self, diff):
+        return set([ x for x in self.GetDiffParentDirs(diff) if self.IsPreservedEmptyDir(os.path.join(self.gitRepo.path, x)) ])
+
+    # When only the changed elements of the \a diff are populated the directories that contain them have to have their empty directory
+    # placeholders (see PreserveEmptyDirs()) updated the way a full populate would. The full populate first deletes the preserved empty directories
+    # (see DeleteEmptyDirs()) so a directory that gains an element loses its placeholder, while any directory that ends up empty gets one.
+    # The \a preservedDirs are the directories that were preserved empty directories before the diff was applied, see GetPreservedDiffParentDirs().
+    def UpdateEmptyDirPlaceholders(self, diff, preservedDirs):
+        for dirPath in self.GetDiffParentDirs(diff):
+            path = os.path.join(self.gitRepo.path, dirPath)
+            if os.path.islink(path) or not os.path.isdir(path):
+                continue
+            dirlist = os.listdir(path)
+            placeholderPath = os.path.join(path, '.gitignore')
+            if len(dirlist) == 0:
+                open(placeholderPath, 'w').close()
+                if not os.path.exists(placeholderPath):
+                    logger.error("Failed to preserve directory. Couldn't create '{0}'.".format(placeholderPath))
+            elif len(dirlist) > 1 and dirPath in preservedDirs and '.gitignore' in dirlist and os.path.getsize(placeholderPath) == 0:
+                if not self.DeletePath(placeholderPath):
+                    logger.error("Failed to delete the empty directory placeholder '{0}'.".format(placeholderPath))
+                    raise Exception("Failed to delete '{0}'".format(placeholderPath))
+
+    # Runs the \a func, which updates the worktree around a populate, and returns a (success, result) tuple. The \a description says what
+    # was being done, for the error message.
+    def TryUpdateWorktree(self, description, func):
+        try:
+            return (True, func())
+        except:
+            logger.error("Error trying to {0}. Fatal, aborting!".format(description))
+            # This might be ok only in the case when the files/directories were changed but not in the case when there
+            # was a deletion that occurred. Abort and be safe!
+            # TODO: This must be solved somehow since this could hinder this script from continuing at all!
+            return (False, None)
+
     def GetGitUserFromAccuRevUser(self, accurevUsername):
         if accurevUsername is not None:
             for usermap in self.config.usermaps:
@@ -588,23 +1530,109 @@ class AccuRev2Git(object):
         return hist, histXml
 
     def TryGitCommand(self, cmd, allowEmptyString=False, retry=True):
-        rv = None
-        for i in range(0, AccuRev2Git.commandFailureRetryCount):
+        if not retry:
+            return self.gitRepo.raw_cmd(cmd)
+
+        def run():
             rv = self.gitRepo.raw_cmd(cmd)
-            if not retry:
-                break
             if rv is not None:
                 rv = rv.strip()
                 if not allowEmptyString and len(rv) == 0:
                     rv = None
-                else:
-                    break
-            time.sleep(AccuRev2Git.commandFailureSleepSeconds)
-        return rv
+            return rv
+        return self.gitRetryPolicy.Run(name="'{0}'".format(' '.join(cmd)), func=run, isSuccess=lambda rv: rv is not None, getError=lambda rv: self.gitRepo.lastStderr, isExpected=lambda rv: self.IsGitMissingRefError())
+
+    # Returns True if the last git command failed because the ref or revision that it was given doesn't exist, e.g. `git show-ref` of a missing ref.
+    # That is an answer rather than a failure so it isn't retried.
+    def IsGitMissingRefError(self):
+        if self.gitRepo.lastReturnCode == 0:
+            return False
+        error = self.gitRepo.lastStderr
+        if error is None or len(error.strip()) == 0:
+            return self.gitRepo.lastReturnCode == 1 # `git show-ref` exits with 1, without any output, for a missing ref.
+        for pattern in AccuRev2Git.gitMissingRefErrorPatterns:
+            if pattern.search(error) is not None:
+                return True
+        return False
+
+    # Returns True if the Accurev server responds to an `accurev info` command. Used by the retry policy to find out when to resume after too many
+    # commands have failed in a row.
+    def IsAccurevAvailable(self):
+        accurev.raw.info()
+        return accurev.raw._getLastCommand() is not None and accurev.raw._getLastCommand().returncode == 0
+
+    # The branch head table maps the refs under refs/heads and refs/tags to the commits that they point to so that ProcessTransactions() doesn't
+    # have to ask git for them. It is loaded with a single `git for-each-ref`, kept up to date by UpdateAndCheckoutRef() and TagTransaction() and
+    # reloaded when HEAD is updated directly. The refs themselves are still written to git as they change.
+    def EnableBranchHeads(self):
+        self.branchHeads = {}
+        self.branchHeadsStale = True
+
+    def DisableBranchHeads(self):
+        self.branchHeads = None
+        self.currentBranchRef = None
+
+    def LoadBranchHeads(self):
+        with self.branchHeadsLock:
+            refs = self.gitRepo.for_each_ref(patterns=[ u'refs/heads', u'refs/tags' ])
+            if refs is None:
+                raise Exception("Failed to load the branch heads. Err: {err}".format(err=self.gitRepo.lastStderr))
+            self.branchHeads = {}
+            for refname, objHash, peeledHash in refs:
+                self.branchHeads[refname] = peeledHash if peeledHash is not None else objHash # Tags resolve to the commit they point to, like `git log` does.
+            self.currentBranchRef = self.gitRepo.symbolic_ref(u'HEAD')
+            self.branchHeadsStale = False
+
+    # Returns the commit that the branch or tag points to according to the branch head table or None if it isn't in the table. Short names are
+    # resolved in the same order that git uses (tags before branches).
+    def GetBranchHead(self, branchName):
+        if self.branchHeads is None:
+            return None
+        with self.branchHeadsLock:
+            if self.branchHeadsStale:
+                self.LoadBranchHeads()
+            if branchName.startswith('refs/'):
+                candidates = [ branchName ]
+            else:
+                candidates = [ 'refs/{0}'.format(branchName), 'refs/tags/{0}'.format(branchName), 'refs/heads/{0}'.format(branchName) ]
+            for ref in candidates:
+                commitHash = self.branchHeads.get(ref)
+                if commitHash is not None:
+                    return commitHash
+        return None
+
+    def SetBranchHead(self, ref, commitHash):
+        task = getattr(self.taskLocal, 'task', None)
+        if task is not None:
+            task.changedHeads[ref] = commitHash
+        if self.branchHeads is None:
+            return
+        with self.branchHeadsLock:
+            if ref.startswith('refs/heads/') or ref.startswith('refs/tags/'):
+                self.branchHeads[ref] = commitHash
+            elif ref == 'HEAD':
+                self.branchHeadsStale = True # We don't know which branch, if any, HEAD points to without asking git.
+
+    # Returns the list of (branchName, commitHash, isCurrent) tuples for the \a branchNames that exist, from the branch head table.
+    def GetBranchHeadList(self, branchNames):
+        if self.branchHeadsStale:
+            self.LoadBranchHeads()
+        branchHeadList = []
+        for branchName in sorted(branchNames):
+            ref = 'refs/heads/{0}'.format(branchName)
+            commitHash = self.branchHeads.get(ref)
+            if commitHash is not None:
+                branchHeadList.append( (branchName, commitHash, ref == self.currentBranchRef) )
+        return branchHeadList
 
     def GetLastCommitHash(self, branchName=None, ref=None, retry=True):
         cmd = []
         commitHash = None
+        if ref is None and branchName is not None and self.branchHeads is not None:
+            commitHash = self.GetBranchHead(branchName)
+            if commitHash is not None:
+                return commitHash
+
         if ref is not None:
             cmd = [ u'git', u'show-ref', u'--hash', ref ]
         else:
@@ -640,9 +1668,12 @@ class AccuRev2Git(object):
             if self.gitRepo.raw_cmd([ u'git', u'update-ref', ref, commitHash ]) is None:
                 logger.error( "Failed to update ref {ref} to commit {hash}".format(ref=ref, hash=commitHash) )
                 return False
-            if checkout and ref != 'HEAD' and self.gitRepo.checkout(branchName=ref) is None: # no point in checking out HEAD if that's what we've updated!
-                logger.error( "Failed to checkout ref {ref} to commit {hash}".format(ref=ref, hash=commitHash) )
-                return False
+            self.SetBranchHead(ref=ref, commitHash=commitHash)
+            if checkout and ref != 'HEAD':
+                self.branchHeadsStale = (self.branchHeads is not None) # HEAD now points somewhere else.
+                if self.gitRepo.checkout(branchName=ref) is None: # no point in checking out HEAD if that's what we've updated!
+                    logger.error( "Failed to checkout ref {ref} to commit {hash}".format(ref=ref, hash=commitHash) )
+                    return False
 
             return True
 
@@ -757,6 +1788,7 @@ class AccuRev2Git(object):
                     logger.error( "Failed to commit tree {0}{1}. Error:\n{2}".format(treeHash, forTrMessage, self.gitRepo.lastStderr) )
                 else:
                     commitHash = commitHash.strip()
+                    self.AddCommitToCaches(commitHash=commitHash, treeHash=treeHash, parents=parents)
             else:
                 logger.error( "Failed to write tree{0}. Error:\n{1}".format(forTrMessage, self.gitRepo.lastStderr) )
         else:
@@ -809,46 +1841,248 @@ class AccuRev2Git(object):
 
         return streamMap
 
-    def FindNextChangeTransaction(self, streamName, startTrNumber, endTrNumber, deepHist=None):
-        # Iterate over transactions in order using accurev diff -a -i -v streamName -V streamName -t <lastProcessed>-<current iterator>
-        if self.config.method == "diff":
-            nextTr = startTrNumber + 1
-            diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=startTrNumber, secondTrNumber=nextTr)
-            if diff is None:
+    # Returns the stream numbers of the given stream and all of its ancestors (basis, basis' basis, ...) as a set.
+    def GetStreamAncestry(self, streams, streamNumber):
+        ancestry = set()
+        stream = streams.getStream(streamNumber)
+        while stream is not None and stream.streamNumber not in ancestry:
+            ancestry.add(stream.streamNumber)
+            stream = streams.getStream(stream.basisStreamNumber) if stream.basisStreamNumber is not None else None
+        return ancestry
+
+    # Classifies the transactions after \a startTrNumber, up to and including \a endTrNumber, using a single ranged `accurev hist` and returns the sorted
+    # list of the ones that could have affected the stream. A transaction is kept if it was performed on the stream or one of its ancestors, given the
+    # stream structure at that time, or if it is a chstream or revert which are always probed. Transactions in workspaces and sibling streams are dropped.
+    # Since the classification can miss a change, FindNextChangeTransaction() checks that the transactions before a matching candidate didn't change
+    # the stream. That check is a single diff so a missed change which is reverted before the candidate isn't seen, the stream's history then goes
+    # straight from the state before the change to the one after the revert. Returns None if the transactions couldn't be classified.
+    def GetDiffCandidateTransactions(self, depot, streamNumber, startTrNumber, endTrNumber):
+        if endTrNumber <= startTrNumber:
+            return []
+
+        hist, histXml = self.TryHist(depot=depot, timeSpec="{0}-{1}".format(endTrNumber, startTrNumber + 1), headerOnly=True)
+        if hist is None or hist.transactions is None:
+            logger.warning( "Failed to get the history for transactions {0} - {1}, can't prefilter them.".format(startTrNumber + 1, endTrNumber) )
+            return None
+
+        streams, streamsXml = self.TryStreams(depot=depot, timeSpec=startTrNumber)
+        if streams is None:
+            return None
+        ancestry = self.GetStreamAncestry(streams=streams, streamNumber=streamNumber)
+
+        candidates = []
+        for tr in sorted(hist.transactions, key=lambda x: x.id):
+            if tr.Type in ignored_transaction_types:
+                continue
+            elif tr.Type in AccuRev2Git.diffPrefilterProbeTypes:
+                candidates.append(tr.id)
+                if tr.Type == "chstream":
+                    # The stream structure may have changed so update our ancestry.
+                    streams, streamsXml = self.TryStreams(depot=depot, timeSpec=tr.id)
+                    if streams is None:
+                        return None
+                    ancestry = self.GetStreamAncestry(streams=streams, streamNumber=streamNumber)
+            else:
+                trStreamName, trStreamNumber = tr.affectedStream()
+                if trStreamNumber is None or trStreamNumber in ancestry:
+                    candidates.append(tr.id)
+
+        logger.info( "Prefilter kept {0} of {1} transactions in range {2} - {3} for stream #{4}.".format(len(candidates), len(hist.transactions), startTrNumber + 1, endTrNumber, streamNumber) )
+        return candidates
+
+    # Probes `accurev diff -t <startTrNumber>-<candidate>` for each of the \a candidates, in order, and returns a (trId, diff, success) tuple for the
+    # first candidate whose diff isn't empty. If all the diffs are empty trId and diff are None, if any of them fails success is False.
+    # When accurev.diffProbeThreads is greater than 1 that many candidates are probed concurrently ahead of the one being checked. The results are
+    # still consumed in order so they are identical to probing one at a time. Once a change is found the probes that haven't started yet are
+    # cancelled and the ones that are already running are left to finish in the background but their results are discarded.
+    def FindFirstChangedDiff(self, streamName, startTrNumber, candidates):
+        threadCount = self.config.accurev.diffProbeThreads
+        if threadCount <= 1:
+            for trId in candidates:
+                diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=startTrNumber, secondTrNumber=trId)
+                if diff is None:
+                    return (None, None, False)
+                elif len(diff.elements) > 0:
+                    return (trId, diff, True)
+            return (None, None, True)
+
+        if self.diffProbeExecutor is None:
+            self.diffProbeExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=threadCount)
+
+        # A probe that was queued before the change was found, and which the executor didn't manage to cancel, checks this before it starts.
+        stopEvent = threading.Event()
+        def probe(trId):
+            if stopEvent.is_set():
                 return (None, None)
-    
+            return self.TryDiff(streamName=streamName, firstTrNumber=startTrNumber, secondTrNumber=trId)
+
+        candidates = list(candidates)
+        futures = []
+        try:
+            for i in range(0, len(candidates)):
+                while len(futures) < len(candidates) and len(futures) < i + threadCount:
+                    futures.append(self.diffProbeExecutor.submit(probe, candidates[len(futures)]))
+                diff, diffXml = futures[i].result()
+                if diff is None:
+                    return (None, None, False)
+                elif len(diff.elements) > 0:
+                    return (candidates[i], diff, True)
+            return (None, None, True)
+        finally:
+            stopEvent.set()
+            for future in futures:
+                future.cancel()
+
+    # Returns the method that is used to retrieve the current stream. When the configured method is 'auto' this is the method that was chosen for the
+    # part of the stream's transaction range that is being retrieved by ChooseStreamMethod(), otherwise it is the configured method.
+    def GetRetrievalMethod(self):
+        if self.streamMethod is not None:
+            return self.streamMethod
+        return self.config.method
+
+    # Returns the accurev server version as a tuple of integers (e.g. (6, 2, 1)) or None if it couldn't be determined. The `accurev info` command is
+    # only run once.
+    def GetServerVersion(self):
+        if self.serverVersion is None:
+            acInfo = accurev.info()
+            if acInfo is not None and acInfo.serverVer is not None:
+                versionMatch = re.match(r'^\s*(\d+(?:\.\d+)*)', acInfo.serverVer)
+                if versionMatch is not None:
+                    self.serverVersion = tuple(int(x) for x in versionMatch.group(1).split('.'))
+            if self.serverVersion is None:
+                logger.warning( "Failed to determine the accurev server version." )
+        return self.serverVersion
+
+    # Picks the retrieval method for the \a stream over the transaction range \a startTrNumber - \a endTrNumber. Servers older than
+    # autoMethodMinServerVersion only support the 'pop' method. Otherwise the last autoMethodSampleSize transactions of the range are classified
+    # with a single `accurev hist` and the 'diff' method is chosen if most of them could have affected the stream, the stream itself isn't quiet and
+    # all of its ancestors are in \a trackedStreams (so their diffs are cached and reused). In all other cases 'deep-hist' is chosen since it
+    # only visits the transactions that could have affected the stream.
+    def ChooseStreamMethod(self, depot, stream, startTrNumber, endTrNumber, trackedStreams=None):
+        serverVersion = self.GetServerVersion()
+        if serverVersion is not None and serverVersion < AccuRev2Git.autoMethodMinServerVersion:
+            logger.info( "auto method: server version {0} is older than {1}, using 'pop' for stream {2}.".format('.'.join(str(x) for x in serverVersion), '.'.join(str(x) for x in AccuRev2Git.autoMethodMinServerVersion), stream.name) )
+            return "pop"
+
+        endTrNumber = int(endTrNumber)
+        sampleStartTrNumber = max(int(startTrNumber) + 1, endTrNumber - AccuRev2Git.autoMethodSampleSize + 1)
+        if sampleStartTrNumber > endTrNumber:
+            return "diff"
+
+        hist, histXml = self.TryHist(depot=depot, timeSpec="{0}-{1}".format(endTrNumber, sampleStartTrNumber), headerOnly=True)
+        streams, streamsXml = self.TryStreams(depot=depot, timeSpec=endTrNumber)
+        if hist is None or hist.transactions is None or streams is None:
+            logger.warning( "auto method: failed to sample transactions {0} - {1}, using 'deep-hist' for stream {2}.".format(sampleStartTrNumber, endTrNumber, stream.name) )
+            return "deep-hist"
+
+        ancestry = self.GetStreamAncestry(streams=streams, streamNumber=stream.streamNumber)
+        ownCount, ancestorCount, sampleCount = 0, 0, 0
+        for tr in hist.transactions:
+            if tr.Type in ignored_transaction_types:
+                continue
+            sampleCount += 1
+            trStreamName, trStreamNumber = tr.affectedStream()
+            if trStreamNumber == stream.streamNumber:
+                ownCount += 1
+            elif trStreamNumber is None or trStreamNumber in ancestry:
+                ancestorCount += 1
+
+        allAncestorsTracked = True
+        if trackedStreams is not None:
+            for streamNumber in ancestry:
+                ancestor = streams.getStream(streamNumber)
+                if ancestor is not None and ancestor.name not in trackedStreams:
+                    allAncestorsTracked = False
+                    break
+
+        affectingCount = ownCount + ancestorCount
+        density = (affectingCount / sampleCount) if sampleCount > 0 else 0.0
+        isQuiet = (affectingCount == 0) or (ownCount / affectingCount) < AccuRev2Git.autoMethodQuietStreamDensity
+
+        if allAncestorsTracked and not isQuiet and density >= AccuRev2Git.autoMethodDiffDensity:
+            method = "diff"
+        else:
+            method = "deep-hist"
+        logger.info( "auto method: using '{0}' for stream {1}. Sampled {2} transactions ({3} - {4}): {5} on the stream, {6} on its ancestors, all ancestors tracked: {7}.".format(method, stream.name, sampleCount, sampleStartTrNumber, endTrNumber, ownCount, ancestorCount, allAncestorsTracked) )
+        return method
+
+    # Returns the metadata that is stored in the hwm ref for the given high-water-mark. For the 'auto' method the chosen method and the transaction
+    # range it was chosen for are recorded as well so that an interrupted retrieval is resumed with the same method.
+    def GetHwmMetadata(self, hwm):
+        metadata = { "high-water-mark": hwm }
+        if self.streamMethod is not None:
+            metadata["method"] = self.streamMethod
+            metadata["method-range"] = self.streamMethodRange
+        return metadata
+
+    def FindNextChangeTransaction(self, streamName, startTrNumber, endTrNumber, deepHist=None, candidateTransactions=None):
+        # Iterate over transactions in order using accurev diff -a -i -v streamName -V streamName -t <lastProcessed>-<current iterator>
+        if self.GetRetrievalMethod() == "diff":
+            probeEndTrNumber = endTrNumber
+            if candidateTransactions is not None:
+                # Only probe the transactions that could have affected the stream, see GetDiffCandidateTransactions().
+                trId, diff, success = self.FindFirstChangedDiff(streamName=streamName, startTrNumber=startTrNumber, candidates=[ x for x in candidateTransactions if x > startTrNumber and x <= endTrNumber ])
+                if not success:
+                    return (None, None)
+                elif trId is not None:
+                    # A change that the prefilter missed before the candidate would show up in its diff and be attributed to it. Make sure that
+                    # the transactions before the candidate didn't change anything.
+                    if trId - 1 <= startTrNumber:
+                        gapDiff = None
+                    else:
+                        gapDiff, gapDiffXml = self.TryDiff(streamName=streamName, firstTrNumber=startTrNumber, secondTrNumber=trId - 1)
+                        if gapDiff is None:
+                            return (None, None)
+                    if gapDiff is None or len(gapDiff.elements) == 0:
+                        logger.debug("FindNextChangeTransaction diff (prefiltered): {0}".format(trId))
+                        return (trId, diff)
+                    probeEndTrNumber = trId - 1
+                else:
+                    # Make sure that the prefilter didn't miss anything before declaring that we are done.
+                    diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=startTrNumber, secondTrNumber=endTrNumber)
+                    if diff is None:
+                        return (None, None)
+                    elif len(diff.elements) == 0:
+                        return (endTrNumber + 1, diff) # The end transaction number is inclusive. We need to return the one after it.
+                logger.warning( "The prefilter missed a change to {0} in transactions {1} - {2}. Probing every transaction instead.".format(streamName, startTrNumber + 1, probeEndTrNumber) )
+
             # Note: This is likely to be a hot path. However, it cannot be optimized since a revert of a transaction would not show up in the diff even though the
             #       state of the stream was changed during that period in time. Hence to be correct we must iterate over the transactions one by one unless we have
             #       explicit knowlege of all the transactions which could affect us via some sort of deep history option...
-            while nextTr <= endTrNumber and len(diff.elements) == 0:
-                nextTr += 1
+            #       The prefilter above is such an option and it accepts this limitation for the transactions that it classified as not affecting the stream.
+            nextTr, diff, success = self.FindFirstChangedDiff(streamName=streamName, startTrNumber=startTrNumber, candidates=range(startTrNumber + 1, probeEndTrNumber + 1))
+            if not success:
+                return (None, None)
+            elif nextTr is None:
+                nextTr = probeEndTrNumber + 1
                 diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=startTrNumber, secondTrNumber=nextTr)
                 if diff is None:
                     return (None, None)
         
             logger.debug("FindNextChangeTransaction diff: {0}".format(nextTr))
             return (nextTr, diff)
-        elif self.config.method == "deep-hist":
+        elif self.GetRetrievalMethod() == "deep-hist":
             if deepHist is None:
                 raise Exception("Script error! deepHist argument cannot be none when running a deep-hist method.")
             # Find the next transaction
+            candidates = []
             for tr in deepHist:
                 if tr.id > startTrNumber:
                     if tr.Type in ignored_transaction_types:
                         logger.debug("Ignoring transaction #{id} - {Type} (transaction type is in ignored_transaction_types list)".format(id=tr.id, Type=tr.Type))
                     else:
-                        diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=startTrNumber, secondTrNumber=tr.id)
-                        if diff is None:
-                            return (None, None)
-                        elif len(diff.elements) > 0:
-                            logger.debug("FindNextChangeTransaction deep-hist: {0}".format(tr.id))
-                            return (tr.id, diff)
-                        else:
-                            logger.debug("FindNextChangeTransaction deep-hist skipping: {0}, diff was empty...".format(tr.id))
+                        candidates.append(tr.id)
+
+            trId, diff, success = self.FindFirstChangedDiff(streamName=streamName, startTrNumber=startTrNumber, candidates=candidates)
+            if not success:
+                return (None, None)
+            elif trId is not None:
+                logger.debug("FindNextChangeTransaction deep-hist: {0}".format(trId))
+                return (trId, diff)
 
             diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=startTrNumber, secondTrNumber=endTrNumber)
             return (endTrNumber + 1, diff) # The end transaction number is inclusive. We need to return the one after it.
-        elif self.config.method == "pop":
+        elif self.GetRetrievalMethod() == "pop":
             logger.debug("FindNextChangeTransaction pop: {0}".format(startTrNumber + 1))
             return (startTrNumber + 1, None)
         else:
@@ -897,61 +2131,257 @@ class AccuRev2Git(object):
 
         return deletedPathList
 
-    def TryDiff(self, streamName, firstTrNumber, secondTrNumber):
-        for i in range(0, AccuRev2Git.commandFailureRetryCount):
-            diffXml = accurev.raw.diff(all=True, informationOnly=True, verSpec1=streamName, verSpec2=streamName, transactionRange="{0}-{1}".format(firstTrNumber, secondTrNumber), isXmlOutput=True, useCache=self.config.accurev.UseCommandCache())
+    # Runs an accurev command, with the \a func, under the retry policy. The \a func returns an (obj, xml) tuple and is retried until obj isn't None.
+    def TryAccurevCommand(self, name, func):
+        return self.accurevRetryPolicy.Run(name=name, func=func, isSuccess=lambda result: result[0] is not None, getError=lambda result: accurev.raw._getLastError())
+
+    # Diffs the \a streamName against the \a otherStreamName, which defaults to the same stream, over the given transaction range. If the
+    # \a secondTrNumber is None both streams are compared at the \a firstTrNumber.
+    def TryDiff(self, streamName, firstTrNumber, secondTrNumber, otherStreamName=None):
+        if otherStreamName is None:
+            otherStreamName = streamName
+        transactionRange = "{0}-{1}".format(firstTrNumber, secondTrNumber) if secondTrNumber is not None else "{0}".format(firstTrNumber)
+        def run():
+            diff, diffXml = None, accurev.raw.diff(all=True, informationOnly=True, verSpec1=streamName, verSpec2=otherStreamName, transactionRange=transactionRange, isXmlOutput=True, useCache=self.config.accurev.UseCommandCache())
             if diffXml is not None:
                 diff = accurev.obj.Diff.fromxmlstring(diffXml)
-                if diff is not None:
-                    break
+            return diff, diffXml
+        diff, diffXml = self.TryAccurevCommand(name="accurev diff -v {0} -V {1} -t {2}".format(streamName, otherStreamName, transactionRange), func=run)
         if diff is None:
-            logger.error( "accurev diff failed! stream: {0} time-spec: {1}-{2}".format(streamName, firstTrNumber, secondTrNumber) )
+            logger.error( "accurev diff failed! stream: {0} other stream: {1} time-spec: {2}".format(streamName, otherStreamName, transactionRange) )
         return diff, diffXml
 
-    def TryHist(self, depot, timeSpec, streamName=None, transactionKind=None):
-        trHist = None
-        for i in range(0, AccuRev2Git.commandFailureRetryCount):
-            trHistXml = accurev.raw.hist(depot=depot, stream=streamName, timeSpec=timeSpec, transactionKind=transactionKind, useCache=self.config.accurev.UseCommandCache(), isXmlOutput=True, expandedMode=True, verboseMode=True)
+    # If \a headerOnly is set the version and move elements of the transactions aren't parsed, see accurev.obj.History.fromxmlstringheaders().
+    def TryHist(self, depot, timeSpec, streamName=None, transactionKind=None, headerOnly=False):
+        def run():
+            trHist, trHistXml = None, accurev.raw.hist(depot=depot, stream=streamName, timeSpec=timeSpec, transactionKind=transactionKind, useCache=self.config.accurev.UseCommandCache(), isXmlOutput=True, expandedMode=True, verboseMode=True)
             if trHistXml is not None:
-                trHist = accurev.obj.History.fromxmlstring(trHistXml)
-                if trHist is not None:
-                    break
+                trHist = accurev.obj.History.fromxmlstring(trHistXml, headerOnly=headerOnly)
+            return trHist, trHistXml
+        trHist, trHistXml = self.TryAccurevCommand(name="accurev hist -p {0} -t {1}".format(depot, timeSpec), func=run)
+        if trHist is not None:
+            accurev.ext.index_transactions(depot=depot, history=trHist)
         return trHist, trHistXml
 
-    def TryPop(self, streamName, transaction, overwrite=False):
-        for i in range(0, AccuRev2Git.commandFailureRetryCount):
-            popResult = accurev.pop(verSpec=streamName, location=self.gitRepo.path, isRecursive=True, isOverride=overwrite, timeSpec=transaction.id, elementList='.')
-            if popResult:
-                break
+    # Populates the stream at the given transaction into the git repo. If \a elementList is given only those elements (depot relative paths) are
+    # populated, via a list file, otherwise the whole stream is populated.
+    def TryPop(self, streamName, transaction, overwrite=False, elementList=None):
+        listFilePath = None
+        if elementList is not None:
+            with tempfile.NamedTemporaryFile(mode='w', prefix='ac2git_pop_', suffix='.txt', encoding='utf-8', delete=False) as listFile:
+                listFilePath = listFile.name
+                listFile.write('\n'.join(elementList))
+                listFile.write('\n')
+
+        def run():
+            if listFilePath is not None:
+                popResult = accurev.pop(verSpec=streamName, location=self.gitRepo.path, isRecursive=True, isOverride=overwrite, timeSpec=transaction.id, listFile=listFilePath)
             else:
+                popResult = accurev.pop(verSpec=streamName, location=self.gitRepo.path, isRecursive=True, isOverride=overwrite, timeSpec=transaction.id, elementList='.')
+            if not popResult:
                 logger.error("accurev pop failed:")
-                for message in popResult.messages:
+                for message in (popResult.messages if popResult is not None and popResult.messages is not None else []):
                     if message.error is not None and message.error:
                         logger.error("  {0}".format(message.text))
                     else:
                         logger.info("  {0}".format(message.text))
+            return popResult
+
+        def getPopError(popResult):
+            if popResult is None or popResult.messages is None:
+                return accurev.raw._getLastError()
+            return '\n'.join(message.text for message in popResult.messages if message.error and message.text is not None)
+
+        try:
+            popResult = self.accurevRetryPolicy.Run(name="accurev pop -v {0} -t {1}".format(streamName, transaction.id), func=run, isSuccess=lambda popResult: bool(popResult), getError=getPopError)
+        finally:
+            if listFilePath is not None:
+                os.remove(listFilePath)
         
         return popResult
 
+    # Converts a depot relative element path (e.g. /./dir/file) into a path relative to the root of the git repo (e.g. dir/file).
+    # Returns None if the element path isn't depot relative.
+    def DepotPathToGitPath(self, name):
+        if name is None or not (name.startswith('\\.\\') or name.startswith('/./')):
+            return None
+        return ToUnixPath(name[3:])
+
+    # Returns the element version store, which is opened on first use and kept open until CloseElementVersionStore() is called. The sqlite connection
+    # can only be used by the thread that opened it, which is why every retrieval worker has its own.
+    def GetElementVersionStore(self):
+        if self.elementVersionStore is None:
+            self.elementVersionStore = ElementVersionStore(self.config.accurev.versionStoreFilename)
+            self.elementVersionStore.Open()
+        return self.elementVersionStore
+
+    def CloseElementVersionStore(self):
+        if self.elementVersionStore is not None:
+            self.elementVersionStore.Close()
+            self.elementVersionStore = None
+
+    # Looks up the element versions from the \a diff, which are to be populated, in the element version store and writes the ones that are found
+    # straight from git into the index and worktree. Returns the \a popElementList without the elements that were written.
+    def WriteStoredElementVersions(self, depot, diff, popElementList):
+        if self.config.accurev.versionStoreFilename is None or diff is None or popElementList is None or len(popElementList) == 0:
+            return popElementList
+
+        indexInfo = []
+        writtenNames = set()
+        store = self.GetElementVersionStore()
+        for element in diff.elements:
+            for change in element.changes:
+                elem = change.stream1
+                if elem is None or elem.isDir or elem.eid is None or elem.version is None or elem.name not in popElementList:
+                    continue
+                path = self.DepotPathToGitPath(elem.name)
+                stored = store.Get(depot=depot, eid=elem.eid, version=elem.version)
+                if path is not None and stored is not None:
+                    mode, blobHash = stored
+                    indexInfo.append((mode, blobHash, path))
+                    writtenNames.add(elem.name)
+
+        if len(indexInfo) == 0:
+            return popElementList
+
+        if self.gitRepo.update_index(indexInfo=indexInfo) is None or self.gitRepo.checkout_index(fileList=[ x[2] for x in indexInfo ], force=True) is None:
+            logger.warning( "Failed to write {0} stored element versions from git, populating them instead. Error:\n{1}".format(len(indexInfo), self.gitRepo.lastStderr) )
+            return popElementList
+
+        logger.debug( "Wrote {0} of {1} changed elements from the element version store.".format(len(indexInfo), len(popElementList)) )
+        return [ x for x in popElementList if x not in writtenNames ]
+
+    # Records the blobs that the element versions from the \a diff were committed as, in \a commitHash, in the element version store.
+    def StoreElementVersions(self, depot, diff, commitHash):
+        if self.config.accurev.versionStoreFilename is None or diff is None or commitHash is None:
+            return
+
+        elementVersions = {}
+        for element in diff.elements:
+            for change in element.changes:
+                elem = change.stream1
+                if elem is None or elem.isDir or elem.eid is None or elem.version is None:
+                    continue
+                path = self.DepotPathToGitPath(elem.name)
+                if path is not None:
+                    elementVersions[path] = (elem.eid, elem.version)
+
+        if len(elementVersions) == 0:
+            return
+
+        treeEntries = self.gitRepo.ls_tree(treeish=commitHash, paths=list(elementVersions.keys()))
+        if treeEntries is None:
+            logger.warning( "Failed to list the changed elements in {0}, they won't be added to the element version store.".format(self.ShortHash(commitHash)) )
+            return
+
+        entries = []
+        for mode, objType, objHash, path in treeEntries:
+            if objType == 'blob' and path in elementVersions:
+                eid, version = elementVersions[path]
+                entries.append((eid, version, mode, objHash))
+
+        self.GetElementVersionStore().AddList(depot=depot, entries=entries)
+
+    # Builds the tree for the newer transaction of the \a diff from the tree of \a parentHash, using only git and the element version store, and returns
+    # its hash. This is only possible when every change in the diff is a file whose new version is in the store and which didn't move. Removals are
+    # left to the worktree since they may leave behind an empty directory that needs preserving. The placeholders of the preserved empty directories
+    # that gain a file are removed, like UpdateEmptyDirPlaceholders() does, so that the tree matches a populated one. Returns None if the tree can't
+    # be reconstructed.
+    def ReconstructDataTree(self, depot, diff, parentHash):
+        if self.config.accurev.versionStoreFilename is None or diff is None or parentHash is None:
+            return None
+
+        indexInfo = []
+        store = self.GetElementVersionStore()
+        for element in diff.elements:
+            for change in element.changes:
+                newElem, oldElem = change.stream1, change.stream2
+                if newElem is None or newElem.name is None or newElem.isDir or newElem.eid is None or newElem.version is None:
+                    return None
+                if oldElem is not None and (oldElem.isDir or oldElem.name != newElem.name):
+                    return None
+                path = self.DepotPathToGitPath(newElem.name)
+                stored = store.Get(depot=depot, eid=newElem.eid, version=newElem.version)
+                if path is None or stored is None:
+                    return None
+                mode, blobHash = stored
+                indexInfo.append((mode, blobHash, path))
+
+        # The directories that only contained an empty .gitignore in the parent tree were preserved empty directories, unless the .gitignore is one of the changed elements.
+        changedPaths = set([ x[2] for x in indexInfo ])
+        parentDirs = sorted(self.GetDiffParentDirs(diff))
+        if len(parentDirs) > 0:
+            parentEntries = self.gitRepo.ls_tree(treeish=parentHash, paths=[ '{0}/'.format(x) for x in parentDirs ])
+            if parentEntries is None:
+                logger.warning( "Failed to list the changed directories in {0}. Error:\n{1}".format(self.ShortHash(parentHash), self.gitRepo.lastStderr) )
+                return None
+            dirEntries = {}
+            for mode, objType, objHash, name in parentEntries:
+                dirEntries.setdefault(name.rpartition('/')[0], []).append((objType, objHash, name))
+            for dirPath in parentDirs:
+                placeholderPath = '{0}/.gitignore'.format(dirPath)
+                if dirEntries.get(dirPath) == [ ('blob', AccuRev2Git.emptyBlobHash, placeholderPath) ] and placeholderPath not in changedPaths:
+                    indexInfo.append((0, '0' * 40, placeholderPath))
+
+        treeHash = None
+        indexFd, indexPath = tempfile.mkstemp(prefix='ac2git_index_')
+        os.close(indexFd)
+        os.remove(indexPath) # git won't read an empty file as an index, let read-tree create it.
+        try:
+            if self.gitRepo.read_tree(treeish=parentHash, indexFile=indexPath) is None:
+                logger.warning( "Failed to read the tree of {0} into a temporary index. Error:\n{1}".format(self.ShortHash(parentHash), self.gitRepo.lastStderr) )
+            elif len(indexInfo) > 0 and self.gitRepo.update_index(indexInfo=indexInfo, indexFile=indexPath) is None:
+                logger.warning( "Failed to update the temporary index. Error:\n{0}".format(self.gitRepo.lastStderr) )
+            else:
+                treeHash = self.gitRepo.write_tree(indexFile=indexPath)
+                if treeHash is not None:
+                    treeHash = treeHash.strip()
+        finally:
+            if os.path.exists(indexPath):
+                os.remove(indexPath)
+
+        return treeHash
+
+    # Returns the list of depot relative element paths that need to be populated in order to bring the git repo, from which the diff items have already
+    # been deleted (see DeleteDiffItemsFromRepo()), up to date with the newer transaction of the \a diff. The directories are populated recursively so
+    # directory moves bring their contents with them. Elements which no longer exist (defuncts) need no populate since they were already deleted.
+    # Returns None if the list can't be determined and the whole stream needs to be populated instead.
+    def GetDiffPopList(self, diff, deletedPathList=None):
+        if diff is None:
+            return None
+        if deletedPathList is not None and self.gitRepo.path in deletedPathList:
+            return None # The worktree was cleared so everything needs to be populated.
+
+        popList = []
+        for element in diff.elements:
+            for change in element.changes:
+                # The diff is taken as `accurev diff -v <stream> -V <stream> -t <tr>-<tr - 1>` so stream1 holds the newer state of the element.
+                if change.stream1 is None or change.stream1.name is None:
+                    continue
+                name = change.stream1.name
+                if not (name.startswith('\\.\\') or name.startswith('/./')):
+                    logger.debug( "Can't populate element {0} on its own, populating the whole stream.".format(name) )
+                    return None
+                if name not in popList:
+                    popList.append(name)
+
+        return popList
+
     def TryStreams(self, depot, timeSpec, stream=None):
-        streams = None
-        for i in range(0, AccuRev2Git.commandFailureRetryCount):
-            streamsXml = accurev.raw.show.streams(depot=depot, timeSpec=timeSpec, stream=stream, isXmlOutput=True, includeDeactivatedItems=True, includeHasDefaultGroupAttribute=True, useCache=self.config.accurev.UseCommandCache())
+        def run():
+            streams, streamsXml = None, accurev.raw.show.streams(depot=depot, timeSpec=timeSpec, stream=stream, isXmlOutput=True, includeDeactivatedItems=True, includeHasDefaultGroupAttribute=True, useCache=self.config.accurev.UseCommandCache())
             if streamsXml is not None:
                 streams = accurev.obj.Show.Streams.fromxmlstring(streamsXml)
-                if streams is not None:
-                    break
-        return streams, streamsXml
+            return streams, streamsXml
+        return self.TryAccurevCommand(name="accurev show streams -p {0} -t {1}".format(depot, timeSpec), func=run)
 
     def TryDepots(self):
-        depots = None
-        for i in range(0, AccuRev2Git.commandFailureRetryCount):
-            depotsXml = accurev.raw.show.depots(isXmlOutput=True, includeDeactivatedItems=True)
+        def run():
+            depots, depotsXml = None, accurev.raw.show.depots(isXmlOutput=True, includeDeactivatedItems=True)
             if depotsXml is not None:
                 depots = accurev.obj.Show.Depots.fromxmlstring(depotsXml)
-                if depots is not None:
-                    break
-        return depots, depotsXml
+            return depots, depotsXml
+        return self.TryAccurevCommand(name="accurev show depots", func=run)
 
     def NormalizeAccurevXml(self, xml):
         xmlNormalized = re.sub('TaskId="[0-9]+"', 'TaskId="0"', xml)
@@ -969,14 +2399,14 @@ class AccuRev2Git(object):
         if streams is None or streamsXml is None:
             streams, streamsXml = self.TryStreams(depot=depot, timeSpec=transaction)
             if streams is None or streamsXml is None:
-                return (None, None, None)
+                return False
 
         if histXml is not None:
             hist = accurev.obj.History.fromxmlstring(histXml)
         if hist is None or histXml is None:
             hist, histXml = self.TryHist(depot=depot, timeSpec=transaction)
             if hist is None or histXml is None:
-                return (None, None)
+                return False
 
         tr = hist.transactions[0]
         if tr.id > 1 and tr.Type != "mkstream":
@@ -987,11 +2417,11 @@ class AccuRev2Git(object):
                 if streamName is not None:
                     diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=tr.id, secondTrNumber=(tr.id - 1))
                     if diff is None or diffXml is None:
-                        return (None, None)
+                        return False
                 else:
-                    return (None, None)
+                    return False
 
-            diffFilePath = os.path.join(self.gitRepo.path, 'diff.xml')
+            diffFilePath = os.path.join(path, 'diff.xml')
             with codecs.open(diffFilePath, mode='w', encoding='utf-8') as f:
                 f.write(self.NormalizeAccurevXml(diffXml))
 
@@ -1003,6 +2433,27 @@ class AccuRev2Git(object):
         with codecs.open(histFilePath, mode='w', encoding='utf-8') as f:
             f.write(self.NormalizeAccurevXml(histXml))
 
+        return True
+
+    # Writes the info files for the given transaction straight into the git object database and returns the hash of the resulting tree.
+    # Neither the worktree nor the index are touched so that the info ref can be committed to while the data ref is being populated.
+    def WriteInfoTree(self, depot, transaction, streamName=None, useCommandCache=False):
+        treeHash = None
+        infoDirPath = tempfile.mkdtemp(prefix='ac2git_info_')
+        try:
+            if self.WriteInfoFiles(path=infoDirPath, depot=depot, streamName=streamName, transaction=transaction, useCommandCache=useCommandCache):
+                filenames = sorted(os.listdir(infoDirPath))
+                blobHashes = self.gitRepo.hash_object(fileList=[os.path.join(infoDirPath, x) for x in filenames], write=True)
+                if blobHashes is None or len(blobHashes) != len(filenames):
+                    logger.error( "Failed to write the info files for tr. {trId} to git. Error:\n{err}".format(trId=transaction, err=self.gitRepo.lastStderr) )
+                else:
+                    treeHash = self.gitRepo.mktree(entries=[ ('100644', 'blob', h, n) for h, n in zip(blobHashes, filenames) ])
+                    if treeHash is None:
+                        logger.error( "Failed to write the info tree for tr. {trId}. Error:\n{err}".format(trId=transaction, err=self.gitRepo.lastStderr) )
+        finally:
+            shutil.rmtree(infoDirPath, ignore_errors=True)
+        return treeHash
+
     # GetDepotRefsNamespace
     # When depot is None it returns the git ref namespace where all depots are under.
     # When depot is not None it queries the stored depots for the depot name or number and returns the git ref namespace for that depot.
@@ -1157,8 +2608,155 @@ class AccuRev2Git(object):
             raise Exception("Command failed! git show {hash}:diff.xml".format(hash=ref))
         return (diffXml, diff)
 
+    # Returns the path of the transaction journal inside the .git/ directory of the conversion repository or None if it can't be found.
+    def GetTransactionJournalFilename(self):
+        gitDir = self.gitRepo.rev_parse(args=[ '--git-dir' ])
+        if gitDir is None or len(gitDir.strip()) == 0:
+            return None
+        gitDir = gitDir.strip()
+        if not os.path.isabs(gitDir):
+            gitDir = os.path.join(self.gitRepo.path, gitDir)
+        return os.path.join(gitDir, 'ac2git', 'journal.sqlite3')
+
+    # Opens a TransactionJournal for the conversion repository or returns None if it couldn't be opened. The journal is only a cache so failing to
+    # open it isn't an error, everything is read from the refs instead.
+    def OpenTransactionJournal(self):
+        filename = self.GetTransactionJournalFilename()
+        if filename is None:
+            logger.warning("Failed to find the .git/ directory, not using the transaction journal.")
+            return None
+        journal = TransactionJournal(filename)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            journal.Open()
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Failed to open the transaction journal {f}, not using it. Err: {err}".format(f=filename, err=e))
+            journal.Close()
+            return None
+        return journal
+
+    def EnableTransactionJournal(self):
+        self.transactionJournal = self.OpenTransactionJournal()
+        self.streamListCache = OrderedDict()
+
+    def DisableTransactionJournal(self):
+        if self.transactionJournal is not None:
+            self.transactionJournal.Close()
+            self.transactionJournal = None
+        self.streamListCache = OrderedDict()
+
+    # Adds the info and data commits that were made to the stream's refs since the journal was last updated along with the transactions and the
+    # stream lists that they reference. If the refs were rewritten since then the stream's commits are added again from scratch. Returns True if
+    # the \a journal is up to date with the refs and False if it couldn't be updated, in which case the refs have to be read instead.
+    def UpdateTransactionJournal(self, journal, depot, streamNumber):
+        stateRef, dataRef, hwmRef = self.GetStreamRefs(depot=depot, streamNumber=streamNumber)
+        infoHead, dataHead = journal.GetStreamHeads(depot=depot, streamNumber=streamNumber)
+        if (infoHead is not None and not self.gitRepo.merge_base(commits=[ infoHead, stateRef ], is_ancestor=True)) or (dataHead is not None and not self.gitRepo.merge_base(commits=[ dataHead, dataRef ], is_ancestor=True)):
+            logger.warning("The refs for stream number {s} were rewritten, adding all of their commits to the transaction journal again.".format(s=streamNumber))
+            journal.RemoveStream(depot=depot, streamNumber=streamNumber)
+            infoHead, dataHead = None, None
+
+        infoHashList = self.GetGitLogList(ref=stateRef, afterCommitHash=infoHead, gitLogFormat='%H %s')
+        dataHashList = self.GetGitLogList(ref=dataRef, afterCommitHash=dataHead, gitLogFormat='%H %s %T')
+        if infoHashList is None or dataHashList is None:
+            journal.Rollback()
+            return False
+        if len(infoHashList) == 0 and len(dataHashList) == 0:
+            return True
+        logger.info("Adding {i} info and {d} data commits for stream number {s} to the transaction journal.".format(i=len(infoHashList), d=len(dataHashList), s=streamNumber))
+
+        infoList = [ line.split(' ') for line in reversed(infoHashList) ]
+        for i in range(0, len(infoList), AccuRev2Git.journalBatchSize):
+            batch = infoList[i:i + AccuRev2Git.journalBatchSize]
+            streamsObjects = self.gitRepo.cat_file_batch_check(objects=[ '{0}:streams.xml'.format(columns[0]) for columns in batch ])
+            if streamsObjects is None or None in streamsObjects:
+                logger.warning("Failed to find the streams.xml files of the info commits for stream number {s}, not using the transaction journal for it.".format(s=streamNumber))
+                journal.Rollback()
+                return False
+
+            # Only the stream lists and transactions that aren't in the journal yet are read, the transactions are shared by all of the streams that
+            # they affect and the stream lists by all of the transactions until the next mkstream, chstream, etc.
+            newStreamsHashes = []
+            for streamsHash, objType in streamsObjects:
+                if streamsHash not in newStreamsHashes and not journal.HasStreamList(streamsHash):
+                    newStreamsHashes.append(streamsHash)
+            newTrBatch = [ columns for columns in batch if not journal.HasTransaction(depot=depot, trId=int(columns[2])) ]
+            contents = self.gitRepo.cat_file_batch(objects=newStreamsHashes + [ '{0}:hist.xml'.format(columns[0]) for columns in newTrBatch ])
+            if contents is None or None in contents[:len(newStreamsHashes)]:
+                logger.warning("Failed to read the info files for stream number {s}, not using the transaction journal for it.".format(s=streamNumber))
+                journal.Rollback()
+                return False
+
+            for streamsHash, streamsXml in zip(newStreamsHashes, contents):
+                streams = accurev.obj.Show.Streams.fromxmlstring(streamsXml)
+                journal.AddStreamList(streamsHash=streamsHash, streamsXml=streamsXml, streamNames=[ x.name for x in streams.streams ] if streams is not None else [])
+            for columns, histXml in zip(newTrBatch, contents[len(newStreamsHashes):]):
+                self.AddJournalTransaction(journal=journal, depot=depot, histXml=histXml)
+            journal.AddInfoCommits(depot=depot, streamNumber=streamNumber, entries=[ (int(columns[2]), columns[0], streamsObject[0]) for columns, streamsObject in zip(batch, streamsObjects) ])
+
+        dataList = [ line.split(' ') for line in dataHashList ]
+        journal.AddDataCommits(depot=depot, streamNumber=streamNumber, entries=[ (int(columns[2]), columns[0], columns[3]) for columns in dataList ])
+
+        if len(infoHashList) > 0:
+            infoHead = infoHashList[0].split(' ')[0]
+        if len(dataHashList) > 0:
+            dataHead = dataHashList[0].split(' ')[0]
+        journal.SetStreamHeads(depot=depot, streamNumber=streamNumber, infoHash=infoHead, dataHash=dataHead)
+        journal.Commit()
+        return True
+
+    # Parses the \a histXml of an info commit and adds its transaction to the \a journal. Transactions whose affected or source stream can only
+    # be worked out from the whole hist.xml, e.g. the pre 6.1 promotes, or whose stream can't be stored aren't added and are read from the
+    # hist.xml when they are needed.
+    def AddJournalTransaction(self, journal, depot, histXml):
+        hist = accurev.obj.History.fromxmlstring(histXml, headerOnly=True) if histXml is not None and len(histXml) != 0 else None
+        if hist is None or hist.transactions is None or len(hist.transactions) != 1:
+            return False
+        tr = hist.transactions[0]
+        try:
+            if hist.toStream() != tr.affectedStream() or hist.fromStream() != tr.fromStream():
+                return False
+        except Exception:
+            return False
+        streamJson = TransactionJournal.StreamToJson(tr.stream)
+        if tr.stream is not None and streamJson is None:
+            return False
+        journal.AddTransaction(depot=depot, tr=tr, toStream=tr.affectedStream(), fromStream=tr.fromStream(), streamJson=streamJson)
+        return True
+
+    # Gets the streams.xml contents and parsed accurev.obj.Show.Streams object for the streams.xml blob \a streamsHash from the transaction journal.
+    # The last few stream lists are kept parsed since consecutive transactions mostly share the same one.
+    def GetJournalStreams(self, streamsHash):
+        result = self.streamListCache.get(streamsHash)
+        if result is None:
+            streamsXml = self.transactionJournal.GetStreamList(streamsHash)
+            if streamsXml is None:
+                return None
+            result = (streamsXml, accurev.obj.Show.Streams.fromxmlstring(streamsXml))
+            self.streamListCache[streamsHash] = result
+            while len(self.streamListCache) > AccuRev2Git.streamListCacheSize:
+                self.streamListCache.popitem(last=False)
+        return result
+
+    # Returns True if both the transaction and the stream list of the info commit \a ref can be read from the transaction journal.
+    def IsInTransactionJournal(self, ref):
+        if self.transactionJournal is None:
+            return False
+        return self.transactionJournal.GetTransaction(ref) is not None and self.transactionJournal.GetStreamsHash(ref) is not None
+
     # Gets the hist.xml contents and parsed accurev.obj.History object from the given \a ref (git ref or hash).
+    # If the transaction is in the transaction journal the hist.xml isn't read and None is returned for its contents.
     def GetHistInfo(self, ref):
+        if self.transactionJournal is not None:
+            tr = self.transactionJournal.GetTransaction(ref)
+            if tr is not None:
+                return (None, accurev.obj.History(transactions=[ tr ], streams=[]))
+
+        if self.transactionPrefetcher is not None:
+            prefetched = self.transactionPrefetcher.Get(ref)
+            if prefetched is not None and prefetched[3] is not None:
+                return (prefetched[2], prefetched[3])
+
         # Get the hist information.
         hist = None
         histXml = self.gitRepo.raw_cmd(['git', 'show', '{hash}:hist.xml'.format(hash=ref)])
@@ -1170,6 +2768,18 @@ class AccuRev2Git(object):
 
     # Gets the streams.xml contents and parsed accurev.obj.Show.Streams object from the given \a ref (git ref or hash).
     def GetStreamsInfo(self, ref):
+        if self.transactionJournal is not None:
+            streamsHash = self.transactionJournal.GetStreamsHash(ref)
+            if streamsHash is not None:
+                result = self.GetJournalStreams(streamsHash)
+                if result is not None:
+                    return result
+
+        if self.transactionPrefetcher is not None:
+            prefetched = self.transactionPrefetcher.Get(ref)
+            if prefetched is not None and prefetched[1] is not None:
+                return (prefetched[0], prefetched[1])
+
         # Get the stream information.
         streams = None
         streamsXml = self.gitRepo.raw_cmd(['git', 'show', '{hash}:streams.xml'.format(hash=ref)])
@@ -1190,20 +2800,21 @@ class AccuRev2Git(object):
             raise Exception("Command failed! git show {hash}:depots.xml".format(hash=ref))
         return (depotsXml, depots)
 
-    def RetrieveStreamInfo(self, depot, stream, stateRef, startTransaction, endTransaction):
+    # Retrieves the Accurev information for each transaction that affects the stream and commits it to the \a stateRef. The commits are made without
+    # touching the worktree. If \a onCommit is provided it is called with the transaction and commit hash after each commit and the retrieval stops
+    # early if it returns False.
+    def RetrieveStreamInfo(self, depot, stream, stateRef, startTransaction, endTransaction, onCommit=None):
         logger.info( "Processing Accurev state for {0} : {1} - {2}".format(stream.name, startTransaction, endTransaction) )
 
         # Check if the ref exists!
         stateRefObj = self.gitRepo.raw_cmd(['git', 'show-ref', stateRef])
         assert stateRefObj is None or len(stateRefObj) != 0, "Invariant error! Expected non-empty string returned by git show-ref, but got '{s}'".format(s=stateRefObj)
 
-        # Either checkout last state or make the initial commit for a new stateRef.
+        # Either load the last state or make the initial commit for a new stateRef.
         tr = None
         commitHash = None
-        doInitialCheckout = False
         if stateRefObj is not None:
-            # This means that the ref already exists so we should switch to it.
-            doInitialCheckout = True
+            # This means that the ref already exists so we should continue from its last transaction.
             histXml, hist = self.GetHistInfo(ref=stateRef)
             tr = hist.transactions[0]
         else:
@@ -1217,18 +2828,20 @@ class AccuRev2Git(object):
                 except:
                     destStream = None
 
-                # Delete everything in the index and working directory.
-                self.gitRepo.rm(fileList=['.'], force=True, recursive=True)
-                self.ClearGitRepo()
-
-                self.WriteInfoFiles(path=self.gitRepo.path, depot=depot, streamName=stream.name, transaction=tr.id, useCommandCache=self.config.accurev.UseCommandCache())
+                treeHash = self.WriteInfoTree(depot=depot, streamName=stream.name, transaction=tr.id, useCommandCache=self.config.accurev.UseCommandCache())
+                if treeHash is None:
+                    logger.debug( "{0} failed to write the info for the first transaction {1}. Aborting!".format(stream.name, tr.id) )
+                    return (None, None)
 
-                commitHash = self.Commit(transaction=tr, messageOverride="transaction {trId}".format(trId=tr.id), parents=[], ref=stateRef, authorIsCommitter=True)
+                commitHash = self.Commit(transaction=tr, messageOverride="transaction {trId}".format(trId=tr.id), parents=[], treeHash=treeHash, ref=stateRef, checkout=False, authorIsCommitter=True)
                 if commitHash is None:
                     logger.debug( "{0} first commit has failed. Is it an empty commit? Aborting!".format(stream.name) )
                     return (None, None)
                 else:
                     logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref}".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=stateRef) )
+                    if onCommit is not None and not onCommit(tr, commitHash):
+                        logger.info( "stream {streamName}: info retrieval stopped after tr. #{trId}.".format(streamName=stream.name, trId=tr.id) )
+                        return (tr, commitHash)
             else:
                 logger.info( "Failed to get the first transaction for {0} from accurev. Won't retrieve any further.".format(stream.name) )
                 return (None, None)
@@ -1247,7 +2860,7 @@ class AccuRev2Git(object):
 
         # Iterate over all of the transactions that affect the stream we are interested in and maybe the "chstream" transactions (which affect the streams.xml).
         deepHist = None
-        if self.config.method == "deep-hist":
+        if self.GetRetrievalMethod() == "deep-hist":
             ignoreTimelocks=False # The code for the timelocks is not tested fully yet. Once tested setting this to false should make the resulting set of transactions smaller
                                  # at the cost of slightly larger number of upfront accurev commands called.
             logger.debug("accurev.ext.deep_hist(depot={0}, stream={1}, timeSpec='{2}-{3}', ignoreTimelocks={4})".format(depot, stream.name, tr.id, endTr.id, ignoreTimelocks))
@@ -1257,27 +2870,20 @@ class AccuRev2Git(object):
                 raise Exception("accurev.ext.deep_hist() failed to return a result!")
             elif len(deepHist) == 0:
                 return (None, None)
+        diffCandidates = None
+        if self.GetRetrievalMethod() == "diff":
+            diffCandidates = self.GetDiffCandidateTransactions(depot=depot, streamNumber=stream.streamNumber, startTrNumber=tr.id, endTrNumber=endTr.id)
         while True:
-            nextTr, diff = self.FindNextChangeTransaction(streamName=stream.name, startTrNumber=tr.id, endTrNumber=endTr.id, deepHist=deepHist)
+            nextTr, diff = self.FindNextChangeTransaction(streamName=stream.name, startTrNumber=tr.id, endTrNumber=endTr.id, deepHist=deepHist, candidateTransactions=diffCandidates)
             if nextTr is None:
                 logger.debug( "FindNextChangeTransaction(streamName='{0}', startTrNumber={1}, endTrNumber={2}, deepHist={3}) failed!".format(stream.name, tr.id, endTr.id, deepHist) )
                 return (None, None)
 
             logger.debug( "{0}: next transaction {1} (end tr. {2})".format(stream.name, nextTr, endTr.id) )
             if nextTr <= endTr.id:
-                if doInitialCheckout:
-                    # A postponed initialization of state. If there's nothing to do we should skip this checkout because
-                    # it can be expensive. So only do it once and only when we will need to use it.
-                    self.SafeCheckout(ref=stateRef, doReset=True, doClean=True)
-                    doInitialCheckout = False
-
                 # Right now nextTr is an integer representation of our next transaction.
-                # Delete all of the files which are even mentioned in the diff so that we can do a quick populate (wouth the overwrite option)
-                if self.config.method == "pop":
-                    self.ClearGitRepo()
-                else:
-                    if diff is None:
-                        return (None, None)
+                if self.GetRetrievalMethod() != "pop" and diff is None:
+                    return (None, None)
 
                 # The accurev hist command here must be used with the depot option since the transaction that has affected us may not
                 # be a promotion into the stream we are looking at but into one of its parent streams. Hence we must query the history
@@ -1289,19 +2895,26 @@ class AccuRev2Git(object):
                 tr = hist.transactions[0]
                 stream = accurev.show.streams(depot=depot, stream=stream.streamNumber, timeSpec=tr.id, useCache=self.config.accurev.UseCommandCache()).streams[0]
 
-                self.WriteInfoFiles(path=self.gitRepo.path, depot=depot, streamName=stream.name, transaction=tr.id, useCommandCache=self.config.accurev.UseCommandCache())
+                treeHash = self.WriteInfoTree(depot=depot, streamName=stream.name, transaction=tr.id, useCommandCache=self.config.accurev.UseCommandCache())
+                if treeHash is None:
+                    break # Early return from processing this stream. Restarting should clean everything up.
                     
                 # Commit
-                commitHash = self.Commit(transaction=tr, messageOverride="transaction {trId}".format(trId=tr.id), ref=stateRef, authorIsCommitter=True)
+                prevTreeHash = self.GetCachedTreeHash(commitHash) if commitHash is not None else None
+                if prevTreeHash is None:
+                    prevTreeHash = self.GetTreeFromRef(ref=stateRef)
+                if treeHash == prevTreeHash:
+                    # Like `git commit` used to report "nothing to commit" for these.
+                    logger.info("stream {streamName}: tr. #{trId} is a no-op. Potential but unlikely error. Continuing.".format(streamName=stream.name, trId=tr.id))
+                    continue
+                commitHash = self.Commit(transaction=tr, messageOverride="transaction {trId}".format(trId=tr.id), treeHash=treeHash, ref=stateRef, checkout=False, authorIsCommitter=True)
                 if commitHash is None:
-                    if "nothing to commit" in self.gitRepo.lastStdout:
-                        logger.info("stream {streamName}: tr. #{trId} is a no-op. Potential but unlikely error. Continuing.".format(streamName=stream.name, trId=tr.id))
-                    else:
-                        break # Early return from processing this stream. Restarting should clean everything up.
+                    break # Early return from processing this stream. Restarting should clean everything up.
                 else:
-                    if self.UpdateAndCheckoutRef(ref=stateRef, commitHash=commitHash) != True:
-                        return (None, None)
                     logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref}".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=stateRef) )
+                    if onCommit is not None and not onCommit(tr, commitHash):
+                        logger.info( "stream {streamName}: info retrieval stopped after tr. #{trId}.".format(streamName=stream.name, trId=tr.id) )
+                        break
             else:
                 logger.info( "Reached end transaction #{trId} for {streamName} -> {ref}".format(trId=endTr.id, streamName=stream.name, ref=stateRef) )
                 break
@@ -1363,6 +2976,7 @@ class AccuRev2Git(object):
         # Either checkout last state or make the initial commit for a new dataRef.
         lastTrId = None
         stateHashList = None
+        tr, commitHash = None, None
         if dataRefObj is not None:
             # Find the last transaction number that we processed on the dataRef.
             lastTrId = self.GetTransactionForRef(ref=dataRef)
@@ -1409,44 +3023,135 @@ class AccuRev2Git(object):
 
             logger.info( "No {dr} found. Processing {h} on {sr} first.".format(dr=dataRef, h=self.ShortHash(stateHash), sr=stateRef) )
 
-            # Get the first transaction that we are about to process.
-            trHistXml, trHist = self.GetHistInfo(ref=stateHash)
-            tr = trHist.transactions[0]
-
+            tr, commitHash = self.RetrieveFirstStreamData(stream=stream, dataRef=dataRef, stateHash=stateHash, seedFromBasis=True)
+            if tr is None:
+                return (None, None)
             lastTrId = tr.id
 
-            # Delete everything in the index and working directory.
-            self.gitRepo.rm(fileList=['.'], force=True, recursive=True)
-            self.ClearGitRepo()
+        # Find the last transaction number that we processed on the dataRef.
+        lastStateTrId = self.GetTransactionForRef(ref=stateRef)
+        if lastStateTrId is None:
+            logger.error( "Failed to get last transaction processed on the {ref}.".format(ref=stateRef) )
+            return (None, None)
+        # Notify the user what we are processing.
+        logger.info( "Processing stream data for {0} : {1} - {2}".format(stream.name, lastTrId, lastStateTrId) )
+
+        shardCount = self.config.accurev.dataShards
+        if shardCount > 1 and len(stateHashList) >= shardCount * AccuRev2Git.minTransactionsPerDataShard:
+            return self.RetrieveStreamDataSharded(stream=stream, dataRef=dataRef, stateHashList=stateHashList, shardCount=shardCount, endTrId=lastStateTrId, tr=tr, commitHash=commitHash)
+
+        # Process all the hashes in the list
+        return self.RetrieveStreamDataRange(stream=stream, dataRef=dataRef, stateHashList=stateHashList, endTrId=lastStateTrId, tr=tr, commitHash=commitHash)
+
+    # Finds the commit on the basis stream's data ref which holds the basis contents at transaction \a trId, i.e. the last data commit at or before
+    # \a trId, provided that the basis stream has already been retrieved past \a trId. Returns None if there is no such commit.
+    def GetBasisDataHash(self, streamAtTr, trId):
+        if streamAtTr is None or streamAtTr.basisStreamNumber is None:
+            return None
+
+        basisStateRef, basisDataRef, basisHwmRef = self.GetStreamRefs(depot=streamAtTr.depotName, streamNumber=streamAtTr.basisStreamNumber)
+        if basisDataRef is None or basisHwmRef is None:
+            return None
+
+        basisHwmText = self.ReadFileRef(ref=basisHwmRef)
+        if basisHwmText is None or len(basisHwmText) == 0:
+            return None
+        basisHwm = json.loads(basisHwmText).get("high-water-mark")
+        if basisHwm is None or basisHwm < trId:
+            logger.debug( "Basis stream {0} has only been retrieved up to tr. {1}, can't use it for tr. {2}.".format(streamAtTr.basis, basisHwm, trId) )
+            return None
+
+        basisLog = self.GetGitLogList(ref=basisDataRef, gitLogFormat='%H %s')
+        if basisLog is None:
+            return None
+        for line in basisLog:
+            basisHash, basisSubject = line.split(' ', 1)
+            basisTrMatch = re.match(r'^transaction ([0-9]+)$', basisSubject)
+            if basisTrMatch is not None and int(basisTrMatch.group(1)) <= trId:
+                return basisHash
+        return None
+
+    # Seeds the worktree with the basis stream's data tree at the transaction \a tr and then applies the differences between the stream and its basis
+    # at that transaction, so that the contents of a new stream don't have to be populated in full. Returns True on success, in which case the worktree
+    # holds the contents of the stream at \a tr. On failure the worktree is left in an undefined state and should be cleared.
+    def SeedStreamDataFromBasis(self, stream, stateHash, tr):
+        streamsXml, streams = self.GetStreamsInfo(ref=stateHash)
+        streamAtTr = streams.getStream(stream.streamNumber)
+        basisHash = self.GetBasisDataHash(streamAtTr=streamAtTr, trId=tr.id)
+        if basisHash is None:
+            return False
+
+        logger.info( "Seeding {0} at tr. {1} from basis stream {2} data commit {3}.".format(stream.name, tr.id, streamAtTr.basis, self.ShortHash(basisHash)) )
+        if self.gitRepo.raw_cmd(['git', 'read-tree', '--reset', '-u', basisHash]) is None:
+            logger.error( "Failed to read the basis tree {0}. Error:\n{1}".format(basisHash, self.gitRepo.lastStderr) )
+            return False
+
+        diff, diffXml = self.TryDiff(streamName=stream.name, firstTrNumber=tr.id, secondTrNumber=None, otherStreamName=streamAtTr.basis)
+        if diff is None:
+            return False
+
+        # The diff is taken with the stream as -v, so stream1 holds the elements as they should be in the stream.
+        preservedDirs = self.GetPreservedDiffParentDirs(diff=diff)
+        success, deletedPathList = self.TryUpdateWorktree(description="delete the elements that differ between {0} and its basis {1}".format(stream.name, streamAtTr.basis), func=lambda: self.DeleteDiffItemsFromRepo(diff=diff))
+        if not success:
+            return False
+
+        popElementList = self.GetDiffPopList(diff=diff, deletedPathList=deletedPathList)
+        if popElementList is None:
+            return False
+        elif len(popElementList) > 0:
+            popResult = self.TryPop(streamName=stream.name, transaction=tr, elementList=popElementList)
+            if not popResult:
+                return False
+
+        # The basis' preserved empty directories that gained elements mustn't keep their placeholders.
+        success, result = self.TryUpdateWorktree(description="update the empty directory placeholders", func=lambda: self.UpdateEmptyDirPlaceholders(diff=diff, preservedDirs=preservedDirs))
+        return success
+
+    # Populates the full contents of the stream at the transaction recorded in the \a stateHash and commits it as a root commit on the \a dataRef.
+    # If \a seedFromBasis is set the contents are seeded from the basis stream's data ref when possible (see SeedStreamDataFromBasis()).
+    def RetrieveFirstStreamData(self, stream, dataRef, stateHash, seedFromBasis=False):
+        # Get the first transaction that we are about to process.
+        trHistXml, trHist = self.GetHistInfo(ref=stateHash)
+        tr = trHist.transactions[0]
+
+        # Delete everything in the index and working directory.
+        self.gitRepo.rm(fileList=['.'], force=True, recursive=True)
+        self.ClearGitRepo()
+
+        isSeeded = False
+        if seedFromBasis:
+            isSeeded = self.SeedStreamDataFromBasis(stream=stream, stateHash=stateHash, tr=tr)
+            if not isSeeded:
+                logger.debug( "{0} couldn't be seeded from its basis stream, populating it in full.".format(stream.name) )
+                self.gitRepo.rm(fileList=['.'], force=True, recursive=True)
+                self.ClearGitRepo()
 
-            # Populate the stream contents from accurev
+        # Populate the stream contents from accurev
+        if not isSeeded:
             popResult = self.TryPop(streamName=stream.name, transaction=tr, overwrite=True)
             if not popResult:
                 logger.error( "accurev pop failed for {trId} on {dataRef}".format(trId=tr.id, dataRef=dataRef) )
                 return (None, None)
 
-            # Make first commit.
-            commitHash = self.Commit(transaction=tr, allowEmptyCommit=True, messageOverride="transaction {trId}".format(trId=tr.id), parents=[], ref=dataRef, authorIsCommitter=True)
-            if commitHash is None:
-                # The first streams mkstream transaction will be empty so we may end up with an empty commit.
-                logger.debug( "{0} first commit has failed.".format(stream.name) )
+        # Make first commit.
+        commitHash = self.Commit(transaction=tr, allowEmptyCommit=True, messageOverride="transaction {trId}".format(trId=tr.id), parents=[], ref=dataRef, authorIsCommitter=True)
+        if commitHash is None:
+            # The first streams mkstream transaction will be empty so we may end up with an empty commit.
+            logger.debug( "{0} first commit has failed.".format(stream.name) )
+            return (None, None)
+        else:
+            if self.gitRepo.checkout(branchName=dataRef) is None:
+                logger.debug( "{0} failed to checkout data ref {1}. Aborting!".format(stream.name, dataRef) )
                 return (None, None)
-            else:
-                if self.gitRepo.checkout(branchName=dataRef) is None:
-                    logger.debug( "{0} failed to checkout data ref {1}. Aborting!".format(stream.name, dataRef) )
-                    return (None, None)
 
-                logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref}".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=dataRef) )
+            logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref}".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=dataRef) )
 
-        # Find the last transaction number that we processed on the dataRef.
-        lastStateTrId = self.GetTransactionForRef(ref=stateRef)
-        if lastStateTrId is None:
-            logger.error( "Failed to get last transaction processed on the {ref}.".format(ref=stateRef) )
-            return (None, None)
-        # Notify the user what we are processing.
-        logger.info( "Processing stream data for {0} : {1} - {2}".format(stream.name, lastTrId, lastStateTrId) )
+        return (tr, commitHash)
 
-        # Process all the hashes in the list
+    # Incrementally populates the stream for each hash in the \a stateHashList (ordered newest first, as returned by git log) and commits the result to
+    # the \a dataRef, which must already be checked out. Returns the last transaction and commit hash, or the given \a tr and \a commitHash if the list is empty.
+    def RetrieveStreamDataRange(self, stream, dataRef, stateHashList, endTrId, tr=None, commitHash=None):
         for stateHash in reversed(stateHashList):
             assert stateHash is not None, "Invariant error! Hashes in the stateHashList cannot be none here!"
             assert len(stateHash) != 0, "Invariant error! Excess new lines returned by `git log`? Probably safe to skip but shouldn't happen."
@@ -1460,36 +3165,6 @@ class AccuRev2Git(object):
             # Get the stream information.
             streamsXml, streams = self.GetStreamsInfo(ref=stateHash)
 
-            popOverwrite = (self.config.method == "pop")
-            deletedPathList = None
-            if self.config.method == "pop":
-                self.ClearGitRepo()
-            else:
-                if diff is None:
-                    logger.error( "No diff available for {trId} on {dataRef}".format(trId=tr.id, dataRef=dataRef) )
-                    return (None, None)
- 
-                try:
-                    deletedPathList = self.DeleteDiffItemsFromRepo(diff=diff)
-                except:
-                    popOverwrite = True
-                    logger.info("Error trying to delete changed elements. Fatal, aborting!")
-                    # This might be ok only in the case when the files/directories were changed but not in the case when there
-                    # was a deletion that occurred. Abort and be safe!
-                    # TODO: This must be solved somehow since this could hinder this script from continuing at all!
-                    return (None, None)
-
-                # Remove all the empty directories (this includes directories which contain an empty .gitignore file since that's what we is done to preserve them)
-                try:
-                    self.DeleteEmptyDirs()
-                except:
-                    popOverwrite = True
-                    logger.info("Error trying to delete empty directories. Fatal, aborting!")
-                    # This might be ok only in the case when the files/directories were changed but not in the case when there
-                    # was a deletion that occurred. Abort and be safe!
-                    # TODO: This must be solved somehow since this could hinder this script from continuing at all!
-                    return (None, None)
-
             tr = hist.transactions[0]
             streamAtTr = streams.getStream(stream.streamNumber)
             if streamAtTr is None:
@@ -1515,9 +3190,63 @@ class AccuRev2Git(object):
             except:
                 srcStreamName, srcStreamNumber = None, None
 
+            # If the versions of all the changed elements are already known the new tree can be built from the previous one purely in git.
+            reconstructedTreeHash = None
+            if self.GetRetrievalMethod() != "pop":
+                reconstructedTreeHash = self.ReconstructDataTree(depot=stream.depotName, diff=diff, parentHash=(commitHash if commitHash is not None else self.GetLastCommitHash(ref=dataRef)))
+            if reconstructedTreeHash is not None and random.random() >= self.config.accurev.reconstructVerifyRate:
+                commitHash = self.Commit(transaction=tr, allowEmptyCommit=True, messageOverride="transaction {trId}".format(trId=tr.id), treeHash=reconstructedTreeHash, ref=dataRef, authorIsCommitter=True)
+                if commitHash is None:
+                    logger.error( "Commit failed for {trId} on {dataRef}".format(trId=tr.id, dataRef=dataRef) )
+                    return (None, None)
+                logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref} (end tr. {endTrId}, reconstructed)".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=dataRef, endTrId=endTrId) )
+                continue
+
+            popOverwrite = (self.GetRetrievalMethod() == "pop")
+            deletedPathList = None
+            popElementList = None
+            if self.GetRetrievalMethod() == "pop" or reconstructedTreeHash is not None:
+                # A reconstructed tree that was sampled for verification is compared against the tree of a full populate.
+                popOverwrite = True
+                self.ClearGitRepo()
+            else:
+                if diff is None:
+                    logger.error( "No diff available for {h} on {dataRef}".format(h=self.ShortHash(stateHash), dataRef=dataRef) )
+                    return (None, None)
+
+                preservedDirs = self.GetPreservedDiffParentDirs(diff=diff)
+                success, deletedPathList = self.TryUpdateWorktree(description="delete changed elements", func=lambda: self.DeleteDiffItemsFromRepo(diff=diff))
+                if not success:
+                    return (None, None)
+
+                # Only populate the elements mentioned in the diff instead of walking the whole stream.
+                popElementList = self.GetDiffPopList(diff=diff, deletedPathList=deletedPathList)
+                # and of those only the element versions that we haven't already committed before.
+                popElementList = self.WriteStoredElementVersions(depot=stream.depotName, diff=diff, popElementList=popElementList)
+
             # Populate
             logger.debug( "{0} pop: {1} {2}{3}".format(stream.name, tr.Type, tr.id, " to {0}".format(destStreamName) if destStreamName is not None else "") )
-            popResult = self.TryPop(streamName=stream.name, transaction=tr, overwrite=popOverwrite)
+            popResult = None
+            if popElementList is not None:
+                if len(popElementList) == 0:
+                    logger.debug( "{0} pop: nothing to populate for {1}".format(stream.name, tr.id) )
+                    popResult = True
+                else:
+                    popResult = self.TryPop(streamName=stream.name, transaction=tr, overwrite=popOverwrite, elementList=popElementList)
+                    if not popResult:
+                        logger.info( "accurev pop of the {count} changed elements failed for {trId} on {dataRef}, populating the whole stream instead.".format(count=len(popElementList), trId=tr.id, dataRef=dataRef) )
+                if popResult:
+                    success, result = self.TryUpdateWorktree(description="update the empty directory placeholders", func=lambda: self.UpdateEmptyDirPlaceholders(diff=diff, preservedDirs=preservedDirs))
+                    if not success:
+                        return (None, None)
+            if not popResult:
+                if self.GetRetrievalMethod() != "pop":
+                    # Remove all the empty directories (this includes directories which contain an empty .gitignore file since that's what we is done to preserve them)
+                    # but only if the whole stream is going to be populated. Populating just the changed elements wouldn't recreate the empty directories.
+                    success, deletedDirs = self.TryUpdateWorktree(description="delete empty directories", func=self.DeleteEmptyDirs)
+                    if not success:
+                        return (None, None)
+                popResult = self.TryPop(streamName=stream.name, transaction=tr, overwrite=popOverwrite)
             if not popResult:
                 logger.error( "accurev pop failed for {trId} on {dataRef}".format(trId=tr.id, dataRef=dataRef) )
                 return (None, None)
@@ -1529,18 +3258,245 @@ class AccuRev2Git(object):
                 logger.error( "Commit failed for {trId} on {dataRef}".format(trId=tr.id, dataRef=dataRef) )
                 return (None, None)
             else:
-                logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref} (end tr. {endTrId})".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=dataRef, endTrId=lastStateTrId) )
+                logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref} (end tr. {endTrId})".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=dataRef, endTrId=endTrId) )
+                if reconstructedTreeHash is not None:
+                    # This transaction was sampled for verification, compare the reconstructed tree against the populated one.
+                    populatedTreeHash = self.GetTreeFromRef(ref=commitHash)
+                    if populatedTreeHash != reconstructedTreeHash:
+                        logger.error( "stream {streamName}: tr. #{trId} reconstructed tree {rTree} doesn't match the populated tree {pTree}. Keeping the populated tree.".format(streamName=stream.name, trId=tr.id, rTree=reconstructedTreeHash, pTree=populatedTreeHash) )
+                    else:
+                        logger.debug( "stream {streamName}: tr. #{trId} reconstructed tree verified.".format(streamName=stream.name, trId=tr.id) )
+                self.StoreElementVersions(depot=stream.depotName, diff=diff, commitHash=commitHash)
 
         return (tr, commitHash)
 
+    # Rewrites the commit \a commitHash so that it has the given \a parents, keeping its tree, author, committer and message unchanged, and returns the hash
+    # of the new commit. The commit object is read and written as raw bytes so that it is byte-for-byte identical apart from the parent lines.
+    def ReparentCommit(self, commitHash, parents):
+        commitObj = self.gitRepo.cat_file(obj=commitHash, objType='commit')
+        if commitObj is None:
+            logger.error( "Failed to read commit {h}. Error:\n{err}".format(h=commitHash, err=self.gitRepo.lastStderr) )
+            return None
+
+        header, separator, message = commitObj.partition(b'\n\n')
+        headerLines = [ x for x in header.split(b'\n') if not x.startswith(b'parent ') ]
+        headerLines[1:1] = [ 'parent {0}'.format(x).encode('ascii') for x in parents ] # The tree line is always first.
+        commitObj = b'\n'.join(headerLines) + separator + message
+
+        newHash = self.gitRepo.hash_object(objType='commit', write=True, input=commitObj)
+        if newHash is None or len(newHash) != 1:
+            logger.error( "Failed to rewrite commit {h}. Error:\n{err}".format(h=commitHash, err=self.gitRepo.lastStderr) )
+            return None
+        return newHash[0]
+
+    # Returns a new AccuRev2Git for retrieving part of a stream on another thread using the \a gitRepo, e.g. one shard of its data, see
+    # RetrieveStreamDataSharded(), or its info, see RetrieveStreamPipelined(). It only shares the configuration and the stream method with this
+    # object. Its git.repo, caches, commit graph and retry policy are its own so that the threads don't read each other's command results, and
+    # its retry policy has no onTrip callback since only the thread that owns the data ref checkpoints it.
+    def CreateRetrievalWorker(self, gitRepo):
+        worker = AccuRev2Git(self.config)
+        worker.cwd = self.cwd
+        worker.gitRepo = gitRepo
+        worker.serverVersion = self.serverVersion
+        worker.streamMethod = self.streamMethod
+        worker.streamMethodRange = list(self.streamMethodRange) if self.streamMethodRange is not None else None
+        return worker
+
+    def CloseRetrievalWorker(self):
+        if self.diffProbeExecutor is not None:
+            self.diffProbeExecutor.shutdown(wait=True)
+            self.diffProbeExecutor = None
+        self.CloseElementVersionStore()
+        logger.debug( "Accurev retrieval retries in {path}: {summary}".format(path=self.gitRepo.path, summary=self.accurevRetryPolicy.Summary()) )
+
+    # Splits the \a stateHashList (ordered newest first, as returned by git log) into \a shardCount consecutive transaction ranges which are populated
+    # concurrently. Each shard gets its own scratch worktree and shard ref, starts with a full pop at its first transaction and then continues incrementally.
+    # Once all the shards are done their commits are stitched, in order, onto the \a dataRef by only rewriting the parent pointers since the trees are
+    # unchanged. If a shard fails the shards before it are stitched and the rest of the transactions are retrieved serially from there, starting
+    # from the given \a tr and \a commitHash (the last ones on the data ref) if no shard could be stitched.
+    def RetrieveStreamDataSharded(self, stream, dataRef, stateHashList, shardCount, endTrId, tr=None, commitHash=None):
+        stateHashList = list(reversed(stateHashList))
+        shardSize = (len(stateHashList) + shardCount - 1) // shardCount
+        shards = [ stateHashList[i:i + shardSize] for i in range(0, len(stateHashList), shardSize) ]
+
+        logger.info( "Processing stream data for {0} in {1} shards of up to {2} transactions.".format(stream.name, len(shards), shardSize) )
+
+        shardsPath = tempfile.mkdtemp(prefix='ac2git_shards_')
+        shardRefs = [ '{ns}shards/{streamNumber}/{index}'.format(ns=AccuRev2Git.gitRefsNamespace, streamNumber=stream.streamNumber, index=i) for i in range(0, len(shards)) ]
+        shardPaths = [ os.path.join(shardsPath, str(i)) for i in range(0, len(shards)) ]
+        shardResults = [ None ] * len(shards)
+        baseHash = self.GetLastCommitHash(ref=dataRef)
+
+        # Runs on the shard's own thread and only uses the git.repo of the shard's worktree.
+        def shardWorker(index):
+            try:
+                shard = self.CreateRetrievalWorker(gitRepo=git.open(shardPaths[index]))
+                try:
+                    tr, commitHash = shard.RetrieveFirstStreamData(stream=stream, dataRef=shardRefs[index], stateHash=shards[index][0])
+                    if tr is not None:
+                        tr, commitHash = shard.RetrieveStreamDataRange(stream=stream, dataRef=shardRefs[index], stateHashList=list(reversed(shards[index][1:])), endTrId=endTrId, tr=tr, commitHash=commitHash)
+                    shardResults[index] = (tr, commitHash)
+                finally:
+                    shard.CloseRetrievalWorker()
+            except Exception as e:
+                logger.error( "Stream {0} data shard {1} failed. {2}".format(stream.name, index, e) )
+
+        try:
+            # The worktrees are added here, one at a time, since the git.repo of this one can't be used by several threads.
+            for shardPath in shardPaths:
+                if self.gitRepo.worktree_add(path=shardPath, commitish=baseHash, detach=True, noCheckout=True) is None:
+                    raise Exception("Failed to create worktree {path}. Error:\n{err}".format(path=shardPath, err=self.gitRepo.lastStderr))
+
+            threads = [ threading.Thread(target=shardWorker, args=(i,), name="ac2git-shard-{0}".format(i)) for i in range(0, len(shards)) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            # Stitch the shards together in order.
+            parentHash = baseHash
+            stitchedCount = 0
+            for index, result in enumerate(shardResults):
+                if result is None or result[0] is None:
+                    break
+
+                shardCommits = self.GetGitLogList(ref=shardRefs[index], gitLogFormat='%H')
+                if shardCommits is None:
+                    raise Exception("Failed to list the commits of the stream {0} data shard {1} ({2}).".format(stream.name, index, shardRefs[index]))
+                for shardCommit in reversed(shardCommits):
+                    parentHash = self.ReparentCommit(commitHash=shardCommit, parents=[ parentHash ])
+                    if parentHash is None:
+                        raise Exception("Failed to stitch commit {0} of the stream {1} data shard {2} onto {3}.".format(shardCommit, stream.name, index, dataRef))
+
+                if self.UpdateAndCheckoutRef(ref=dataRef, commitHash=parentHash, checkout=False) != True:
+                    raise Exception("Failed to update {0} to the stitched stream {1} data shard {2}.".format(dataRef, stream.name, index))
+                tr, commitHash = result[0], parentHash
+                stitchedCount += 1
+                logger.info( "stream {streamName}: shard {index} stitched, tr. #{trId} -> commit {hash} on {ref} (end tr. {endTrId})".format(streamName=stream.name, index=index, trId=tr.id, hash=self.ShortHash(commitHash), ref=dataRef, endTrId=endTrId) )
+        finally:
+            for shardRef in shardRefs:
+                self.gitRepo.raw_cmd(['git', 'update-ref', '-d', shardRef])
+            shutil.rmtree(shardsPath, ignore_errors=True)
+            self.gitRepo.worktree_prune()
+
+        if stitchedCount < len(shards):
+            # Retrieve the transactions of the failed shard, and of the ones after it, serially. The worktree has to match the data ref for that.
+            remainingHashList = [ stateHash for shard in shards[stitchedCount:] for stateHash in shard ]
+            logger.warning( "Stream {0} data shard {1} failed, retrieving the remaining {2} transactions serially.".format(stream.name, stitchedCount, len(remainingHashList)) )
+            self.SafeCheckout(ref=dataRef, doReset=True, doClean=True)
+            return self.RetrieveStreamDataRange(stream=stream, dataRef=dataRef, stateHashList=list(reversed(remainingHashList)), endTrId=endTrId, tr=tr, commitHash=commitHash)
+
+        return (tr, commitHash)
+
+    # Runs the info and data retrieval for a stream concurrently. The info retrieval runs on a background thread, with its own git.repo, and only uses
+    # git plumbing commands so that it doesn't touch the worktree, while the data retrieval runs on the calling thread and consumes the info commits as they are made.
+    # At most accurev.pipelineDepth info commits are allowed to be ahead of the data ref at any time. The high-water-mark is advanced after each
+    # batch of data commits so that an interrupted retrieval can resume from where it left off.
+    # Returns a tuple of (stateTr, stateHash, dataTr, dataHash) where the state pair is the result of RetrieveStreamInfo and the data pair is the
+    # result of the last RetrieveStreamData call.
+    def RetrieveStreamPipelined(self, depot, stream, dataRef, stateRef, hwmRef, prevHwm, startTransaction, endTransaction):
+        infoQueue = queue.Queue(maxsize=self.config.accurev.pipelineDepth)
+        stopEvent = threading.Event()
+        infoResult = {}
+
+        def onInfoCommit(tr, commitHash):
+            while not stopEvent.is_set():
+                try:
+                    infoQueue.put((tr, commitHash), timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def infoWorker():
+            infoRetriever = self.CreateRetrievalWorker(gitRepo=git.repo(self.gitRepo.path))
+            try:
+                infoResult['result'] = infoRetriever.RetrieveStreamInfo(depot=depot, stream=stream, stateRef=stateRef, startTransaction=startTransaction, endTransaction=endTransaction, onCommit=onInfoCommit)
+            except BaseException as e:
+                infoResult['error'] = e
+            finally:
+                infoRetriever.CloseRetrievalWorker()
+                # Signal the consumer that we are done. If the consumer has stopped it may no longer be draining the queue so don't wait on it.
+                while True:
+                    try:
+                        infoQueue.put(None, timeout=1)
+                        break
+                    except queue.Full:
+                        if stopEvent.is_set():
+                            break
+
+        logger.info( "Retrieving stream {0} info and data from Accurev for transaction range : {1} - {2} (pipeline depth {3})".format(stream.name, startTransaction, endTransaction, self.config.accurev.pipelineDepth) )
+        infoThread = threading.Thread(target=infoWorker, name="ac2git-info-{0}".format(stream.streamNumber))
+        infoThread.start()
+
+        dataTr, dataHash = None, None
+        dataFailed = False
+        infoDone = False
+        try:
+            while not infoDone:
+                # Block until at least one info commit is available and then take everything else that is ready so that the data is retrieved in batches.
+                batch = [ infoQueue.get() ]
+                while True:
+                    try:
+                        batch.append(infoQueue.get_nowait())
+                    except queue.Empty:
+                        break
+                infoDone = (batch[-1] is None)
+                if infoDone and len(batch) == 1 and dataTr is not None:
+                    continue # Nothing new was committed to the state ref since the last batch.
+
+                # Note: In case the last retrieval was interrupted, the first call will retrieve those transactions first.
+                batchTr, batchHash = self.RetrieveStreamData(stream=stream, dataRef=dataRef, stateRef=stateRef)
+                if batchTr is None:
+                    logger.error( "Stream {0} data retrieval failed. Stopping the info retrieval.".format(stream.name) )
+                    dataFailed = True
+                    break
+                dataTr, dataHash = batchTr, batchHash
+
+                # Checkpoint the progress so far.
+                if hwmRef is not None and not infoDone:
+                    metadata = self.GetHwmMetadata(CallOnNonNoneArgs(max, dataTr.id, prevHwm))
+                    if self.WriteFileRef(ref=hwmRef, text=json.dumps(metadata)) != True:
+                        logger.error( "Failed to write the high-water-mark to ref {ref}".format(ref=hwmRef) )
+        finally:
+            stopEvent.set()
+            infoThread.join()
+
+        if 'error' in infoResult:
+            raise infoResult['error']
+
+        stateTr, stateHash = infoResult.get('result', (None, None))
+        if dataFailed:
+            dataTr, dataHash = None, None
+        return stateTr, stateHash, dataTr, dataHash
+
+    # Writes the high-water-mark of the stream data retrieved so far. Called by the Accurev retry policy before it pauses the retrieval so that a
+    # run which is stopped while paused resumes from where it was. Note: The git commands don't go through the Accurev retry policy, which is
+    # holding every other caller.
+    def CheckpointStream(self, dataRef, hwmRef, prevHwm):
+        if hwmRef is None:
+            return
+        try:
+            dataTrId = self.GetTransactionForRef(ref=dataRef)
+        except Exception:
+            return # Nothing has been retrieved yet.
+        hwm = CallOnNonNoneArgs(max, dataTrId, prevHwm)
+        if self.WriteFileRef(ref=hwmRef, text=json.dumps(self.GetHwmMetadata(hwm))) != True:
+            logger.error( "Failed to checkpoint the high-water-mark to ref {ref}".format(ref=hwmRef) )
+        else:
+            logger.info( "Checkpointed the high-water-mark to ref {ref} as {trId}".format(ref=hwmRef, trId=hwm) )
+
     # Retrieves all of the stream information from accurev, needed for later processing, and stores it in git using the \a dataRef and \a stateRef.
     # The retrieval and processing of the accurev information is separated in order to optimize processing of subsets of streams in a depot. For example,
     # if we have processed 7 streams in a depot and now wish to add an 8th we would have to start processing from the beginning because the merge points
     # between branches will now most likely need to be reconsidered. If the retrieval of information from accurev is a part of the processing step then we
     # have to redo a lot of the work that we have already done for the 7 streams. Instead we have the two steps decoupled so that all we need to do is
     # download the 8th stream information from accurev (which we don't yet have) and do the reprocessing by only looking for information already in git.
-    def RetrieveStream(self, depot, stream, dataRef, stateRef, hwmRef, startTransaction, endTransaction):
+    # When the configured method is 'auto' the transaction range is split into parts of autoMethodChunkSize transactions and the method is chosen
+    # for each part, see ChooseStreamMethod(), where \a trackedStreams are the names of the streams that are being retrieved.
+    def RetrieveStream(self, depot, stream, dataRef, stateRef, hwmRef, startTransaction, endTransaction, trackedStreams=None):
         prevHwm = None
+        prevHwmMetadata = {}
         if hwmRef is not None:
             hwmRefText = self.ReadFileRef(ref=hwmRef)
             if hwmRefText is not None and len(hwmRefText) > 0:
@@ -1548,10 +3504,46 @@ class AccuRev2Git(object):
                 prevHwm = prevHwmMetadata.get("high-water-mark")
                 startTransaction = CallOnNonNoneArgs(max, int(startTransaction), prevHwm) # make sure we start from the transaction we last processed.
 
-        logger.info( "Retrieving stream {0} info from Accurev for transaction range : {1} - {2}".format(stream.name, startTransaction, endTransaction) )
-        stateTr, stateHash = self.RetrieveStreamInfo(depot=depot, stream=stream, stateRef=stateRef, startTransaction=startTransaction, endTransaction=endTransaction)
-        logger.info( "Retrieving stream {0} data from Accurev for transaction range : {1} - {2}".format(stream.name, startTransaction if prevHwm is None else prevHwm, endTransaction) )
-        dataTr,  dataHash  = self.RetrieveStreamData(stream=stream, dataRef=dataRef, stateRef=stateRef) # Note: In case the last retrieval was interrupted, we will retrieve those transactions first.
+        self.streamMethod, self.streamMethodRange = None, None
+        if self.config.method != "auto":
+            return self.RetrieveStreamRange(depot=depot, stream=stream, dataRef=dataRef, stateRef=stateRef, hwmRef=hwmRef, prevHwm=prevHwm, startTransaction=startTransaction, endTransaction=endTransaction)[:2]
+
+        dataTr, dataHash = None, None
+        chunkStart, endTransaction = int(startTransaction), int(endTransaction)
+        prevMethod, prevMethodRange = prevHwmMetadata.get("method"), prevHwmMetadata.get("method-range")
+        while True:
+            if prevMethod is not None and prevMethodRange is not None and prevHwm is not None and prevHwm < prevMethodRange[1]:
+                # The last retrieval didn't reach the end of the range it chose the method for. Finish it with the same method.
+                logger.info( "auto method: resuming stream {0} with the recorded '{1}' method for transaction range {2} - {3}.".format(stream.name, prevMethod, prevMethodRange[0], prevMethodRange[1]) )
+                self.streamMethod, self.streamMethodRange = prevMethod, prevMethodRange
+                chunkEnd = min(int(prevMethodRange[1]), endTransaction)
+            else:
+                chunkEnd = min(chunkStart + AccuRev2Git.autoMethodChunkSize, endTransaction)
+                self.streamMethod = self.ChooseStreamMethod(depot=depot, stream=stream, startTrNumber=chunkStart, endTrNumber=chunkEnd, trackedStreams=trackedStreams)
+                self.streamMethodRange = [ chunkStart, chunkEnd ]
+            prevMethod, prevMethodRange = None, None
+
+            dataTr, dataHash, success = self.RetrieveStreamRange(depot=depot, stream=stream, dataRef=dataRef, stateRef=stateRef, hwmRef=hwmRef, prevHwm=prevHwm, startTransaction=chunkStart, endTransaction=chunkEnd)
+            if not success or chunkEnd >= endTransaction:
+                break
+            chunkStart, prevHwm = chunkEnd, CallOnNonNoneArgs(max, chunkEnd, prevHwm)
+
+        return dataTr, dataHash
+
+    # Retrieves the stream information and data for the transaction range \a startTransaction - \a endTransaction, with the current method, and
+    # updates the high-water-mark in the \a hwmRef. Returns a (dataTr, dataHash, success) tuple where success is False if the state and data refs
+    # didn't both reach the \a endTransaction.
+    def RetrieveStreamRange(self, depot, stream, dataRef, stateRef, hwmRef, prevHwm, startTransaction, endTransaction):
+        self.accurevRetryPolicy.onTrip = lambda: self.CheckpointStream(dataRef=dataRef, hwmRef=hwmRef, prevHwm=prevHwm)
+
+        success = False
+        if self.config.accurev.pipelineDepth > 0:
+            stateTr, stateHash, dataTr, dataHash = self.RetrieveStreamPipelined(depot=depot, stream=stream, dataRef=dataRef, stateRef=stateRef, hwmRef=hwmRef, prevHwm=prevHwm, startTransaction=startTransaction, endTransaction=endTransaction)
+        else:
+            logger.info( "Retrieving stream {0} info from Accurev for transaction range : {1} - {2}".format(stream.name, startTransaction, endTransaction) )
+            stateTr, stateHash = self.RetrieveStreamInfo(depot=depot, stream=stream, stateRef=stateRef, startTransaction=startTransaction, endTransaction=endTransaction)
+            logger.info( "Retrieving stream {0} data from Accurev for transaction range : {1} - {2}".format(stream.name, startTransaction if prevHwm is None else prevHwm, endTransaction) )
+            dataTr,  dataHash  = self.RetrieveStreamData(stream=stream, dataRef=dataRef, stateRef=stateRef) # Note: In case the last retrieval was interrupted, we will retrieve those transactions first.
 
         if stateTr is not None and dataTr is not None:
             newHwm = CallOnNonNoneArgs(max, dataTr.id, prevHwm)
@@ -1559,10 +3551,11 @@ class AccuRev2Git(object):
                 logger.error( "Missmatch while retrieving stream {streamName} (id: streamId), the data ref ({dataRef}) is on tr. {dataTr} while the state ref ({stateRef}) is on tr. {stateTr}.".format(streamName=stream.name, streamId=stream.streamNumber, dataTr=dataTr.id, stateTr=stateTr.id, dataRef=dataRef, stateRef=stateRef) )
             else:
                 newHwm = CallOnNonNoneArgs(max, int(endTransaction), newHwm)
+                success = True
 
             # Success! Update the high water mark for the stream.
             if hwmRef is not None:
-                metadata = { "high-water-mark": newHwm }
+                metadata = self.GetHwmMetadata(newHwm)
                 if self.WriteFileRef(ref=hwmRef, text=json.dumps(metadata)) != True:
                     logger.error( "Failed to write the high-water-mark to ref {ref}".format(ref=hwmRef) )
                 else:
@@ -1572,16 +3565,20 @@ class AccuRev2Git(object):
         elif stateTr is None:
             logger.error( "While retrieving stream {streamName} (id: streamId), the state ref ({stateRef}) failed.".format(streamName=stream.name, streamId=stream.streamNumber, dataRef=dataRef, stateRef=stateRef) )
 
-        return dataTr, dataHash
+        self.accurevRetryPolicy.onTrip = None
+        return dataTr, dataHash, success
 
     def RetrieveStreams(self):
         if self.config.accurev.commandCacheFilename is not None:
             accurev.ext.enable_command_cache(self.config.accurev.commandCacheFilename)
+        accurev.ext.reset_timespec_index() # Resolve the highest/now keywords afresh for this retrieval.
+        if self.config.accurev.commandThreads > 0:
+            accurev.ext.enable_command_executor(maxWorkers=self.config.accurev.commandThreads, commandLimits=self.config.accurev.commandLimits)
         
         streamMap = self.GetStreamMap()
 
         depot  = self.config.accurev.depot
-        endTrHist = accurev.hist(depot=depot, timeSpec=self.config.accurev.endTransaction)
+        endTrHist = accurev.hist(depot=depot, timeSpec=self.config.accurev.endTransaction, headerOnly=True)
         if endTrHist is None or endTrHist.transactions is None or len(endTrHist.transactions) == 0:
             logger.error( "Failed to get end transaction for depot {0}. `accurev hist -p {0} -t {1}` returned no transactions. Please make sure the depot name is spelled correctly and that the transaction number/keyword is valid.".format(depot, self.config.accurev.endTransaction) )
             return
@@ -1604,7 +3601,15 @@ class AccuRev2Git(object):
 
             stateRef, dataRef, hwmRef  = self.GetStreamRefs(depot=depot, streamNumber=streamInfo.streamNumber)
             assert stateRef is not None and dataRef is not None and len(stateRef) != 0 and len(dataRef) != 0, "Invariant error! The state ({sr}) and data ({dr}) refs must not be None!".format(sr=stateRef, dr=dataRef)
-            tr, commitHash = self.RetrieveStream(depot=depot, stream=streamInfo, dataRef=dataRef, stateRef=stateRef, hwmRef=hwmRef, startTransaction=self.config.accurev.startTransaction, endTransaction=endTr.id)
+            tr, commitHash = self.RetrieveStream(depot=depot, stream=streamInfo, dataRef=dataRef, stateRef=stateRef, hwmRef=hwmRef, startTransaction=self.config.accurev.startTransaction, endTransaction=endTr.id, trackedStreams=streamMap)
+
+            # Record what was just retrieved in the transaction journal so that stage 2 doesn't have to parse it again.
+            journal = self.OpenTransactionJournal()
+            if journal is not None:
+                try:
+                    self.UpdateTransactionJournal(journal=journal, depot=self.GetDepot(depot).number, streamNumber=streamInfo.streamNumber)
+                finally:
+                    journal.Close()
 
             if self.config.git.remoteMap is not None:
                 refspec = "{dataRef}:{dataRef} {stateRef}:{stateRef}".format(dataRef=dataRef, stateRef=stateRef)
@@ -1621,6 +3626,15 @@ class AccuRev2Git(object):
                         logger.error("'{cmd}', returned {returncode} and failed with:".format(cmd="' '".join(e.cmd), returncode=e.returncode))
                         logger.error("{output}".format(output=e.output.decode('utf-8')))
         
+        self.streamMethod, self.streamMethodRange = None, None
+        logger.info( "Accurev retrieval retries: {0}".format(self.accurevRetryPolicy.Summary()) )
+        logger.info( "Git retries: {0}".format(self.gitRetryPolicy.Summary()) )
+        if self.diffProbeExecutor is not None:
+            self.diffProbeExecutor.shutdown(wait=True)
+            self.diffProbeExecutor = None
+        self.CloseElementVersionStore()
+        accurev.ext.disable_command_executor()
+
         if self.config.accurev.commandCacheFilename is not None:
             accurev.ext.disable_command_cache()
 
@@ -1678,6 +3692,16 @@ class AccuRev2Git(object):
 
         logger.debug("Searching for stream '{name}' by name.".format(name=streamName))
 
+        if self.transactionJournal is not None:
+            # The journal has every version of the stream list so there is no need to search the history.
+            streamsHash, streamsXml = self.transactionJournal.FindStreamList(depot=depot.number, streamName=streamName)
+            if streamsHash is not None:
+                streamsXml, streams = self.GetJournalStreams(streamsHash)
+                s = streams.getStream(streamName)
+                if s is not None:
+                    logger.debug("Found stream '{name}' in the transaction journal.".format(name=streamName))
+                    return s
+
         refsPrefix = self.GetStreamRefsNamespace(depot.number)
 
         refList = self.GetAllKnownStreamRefs(depot.number)
@@ -1732,6 +3756,8 @@ class AccuRev2Git(object):
             cmdResult = cmdResult.strip()
             if len(cmdResult) > 0:
                 strList = cmdResult.split('\n')
+            elif afterCommitHash is not None:
+                return OrderedDict() # Nothing was committed after the afterCommitHash.
             else:
                 logger.debug("GetRefMap(ref={ref}, mapType={t}) - command result is empty. Cmd: {cmd}".format(ref=ref, t=mapType, cmd=' '.join(cmd)))
                 return None
@@ -1770,7 +3796,8 @@ class AccuRev2Git(object):
             committerDate, committerTimezone = self.GetGitDatetime(accurevUsername=transaction.user, accurevDatetime=transaction.time)
 
         if notesFilePath is not None:
-            rv = self.gitRepo.notes.add(messageFile=notesFilePath, obj=commitHash, ref=ref, force=True, committerName=committerName, committerEmail=committerEmail, committerDate=committerDate, committerTimezone=committerTimezone, authorName=committerName, authorEmail=committerEmail, authorDate=committerDate, authorTimezone=committerTimezone)
+            with self.notesLock: # All of the notes are committed to the same notes ref.
+                rv = self.gitRepo.notes.add(messageFile=notesFilePath, obj=commitHash, ref=ref, force=True, committerName=committerName, committerEmail=committerEmail, committerDate=committerDate, committerTimezone=committerTimezone, authorName=committerName, authorEmail=committerEmail, authorDate=committerDate, authorTimezone=committerTimezone)
             os.remove(notesFilePath)
 
             if rv is not None:
@@ -1897,50 +3924,58 @@ class AccuRev2Git(object):
         return None
 
     def ProcessStreams(self, orderByStreamNumber=False):
-        depot  = self.config.accurev.depot
-
-        # Get the stream information for the configured streams from accurev (this is because stream names can change and accurev doesn't care about this while we do).
-        processingList = []
-        streamMap = self.GetStreamMap()
-        for stream in streamMap:
-            streamInfo = self.GetStreamByName(depot=depot, streamName=stream)
-            if depot is None or len(depot) == 0:
-                depot = streamInfo.depotName
-            elif depot != streamInfo.depotName:
-                logger.info("Stream {name} (id: {id}) is in depot {streamDepot} which is different than the configured depot {depot}. Ignoring...".format(name=streamInfo.name, id=streamInfo.streamNumber, streamDepot=streamInfo.depotName, depot=depot))
-
-            processingList.append( (streamInfo.streamNumber, streamInfo, streamMap[stream]) )
-
-        if orderByStreamNumber:
-            processingList.sort()
-
-        for streamNumber, stream, branchName in processingList:
-            oldCommitHash = self.GetLastCommitHash(branchName=branchName, retry=False)
-
-            self.ProcessStream(stream=stream, branchName=branchName)
-
-            newCommitHash = self.GetLastCommitHash(branchName=branchName)
+        # The transaction journal is used for the stream lookups below as well as for reading the transactions of each stream. It stays open until we are done.
+        self.EnableTransactionJournal()
+        try:
+            depot  = self.config.accurev.depot
+
+            # Get the stream information for the configured streams from accurev (this is because stream names can change and accurev doesn't care about this while we do).
+            processingList = []
+            streamMap = self.GetStreamMap()
+            for stream in streamMap:
+                streamInfo = self.GetStreamByName(depot=depot, streamName=stream)
+                if depot is None or len(depot) == 0:
+                    depot = streamInfo.depotName
+                elif depot != streamInfo.depotName:
+                    logger.info("Stream {name} (id: {id}) is in depot {streamDepot} which is different than the configured depot {depot}. Ignoring...".format(name=streamInfo.name, id=streamInfo.streamNumber, streamDepot=streamInfo.depotName, depot=depot))
+
+                processingList.append( (streamInfo.streamNumber, streamInfo, streamMap[stream]) )
+
+            if orderByStreamNumber:
+                processingList.sort()
+
+            for streamNumber, stream, branchName in processingList:
+                oldCommitHash = self.GetLastCommitHash(branchName=branchName, retry=False)
+
+                if self.transactionJournal is not None:
+                    self.UpdateTransactionJournal(journal=self.transactionJournal, depot=self.GetDepot(stream.depotName).number, streamNumber=streamNumber)
+
+                self.ProcessStream(stream=stream, branchName=branchName)
+
+                newCommitHash = self.GetLastCommitHash(branchName=branchName)
+
+                # If a remote is configured and we have made a commit on this branch then do a push.
+                if self.config.git.remoteMap is not None and oldCommitHash != newCommitHash:
+                    formatOptions = { "accurevNotes": AccuRev2Git.gitNotesRef_accurevInfo, "ac2gitNotes": AccuRev2Git.gitNotesRef_state, "branchName": branchName }
+                    refspec = "{branchName}".format(**formatOptions)
+                    if self.gitRepo.raw_cmd(['git', 'show-ref', '--hash', 'refs/notes/{accurevNotes}'.format(**formatOptions)]) is not None:
+                        refspec += " refs/notes/{accurevNotes}:refs/notes/{accurevNotes}".format(**formatOptions)
+                    if self.gitRepo.raw_cmd(['git', 'show-ref', '--hash', 'refs/notes/{ac2gitNotes}'.format(**formatOptions)]) is not None:
+                        refspec += " refs/notes/{ac2gitNotes}:refs/notes/{ac2gitNotes}".format(**formatOptions)
+                    for remoteName in self.config.git.remoteMap:
+                        pushOutput = None
+                        try:
+                            pushCmd = "git push {remote} {refspec}".format(remote=remoteName, refspec=refspec)
+                            pushOutput = subprocess.check_output(pushCmd.split(), stderr=subprocess.STDOUT).decode('utf-8')
+                            logger.info("Push to '{remote}' succeeded:".format(remote=remoteName))
+                            logger.info(pushOutput)
+                        except subprocess.CalledProcessError as e:
+                            logger.error("Push to '{remote}' failed!".format(remote=remoteName))
+                            logger.debug("'{cmd}', returned {returncode} and failed with:".format(cmd="' '".join(e.cmd), returncode=e.returncode))
+                            logger.debug("{output}".format(output=e.output.decode('utf-8')))
+        finally:
+            self.DisableTransactionJournal()
 
-            # If a remote is configured and we have made a commit on this branch then do a push.
-            if self.config.git.remoteMap is not None and oldCommitHash != newCommitHash:
-                formatOptions = { "accurevNotes": AccuRev2Git.gitNotesRef_accurevInfo, "ac2gitNotes": AccuRev2Git.gitNotesRef_state, "branchName": branchName }
-                refspec = "{branchName}".format(**formatOptions)
-                if self.gitRepo.raw_cmd(['git', 'show-ref', '--hash', 'refs/notes/{accurevNotes}'.format(**formatOptions)]) is not None:
-                    refspec += " refs/notes/{accurevNotes}:refs/notes/{accurevNotes}".format(**formatOptions)
-                if self.gitRepo.raw_cmd(['git', 'show-ref', '--hash', 'refs/notes/{ac2gitNotes}'.format(**formatOptions)]) is not None:
-                    refspec += " refs/notes/{ac2gitNotes}:refs/notes/{ac2gitNotes}".format(**formatOptions)
-                for remoteName in self.config.git.remoteMap:
-                    pushOutput = None
-                    try:
-                        pushCmd = "git push {remote} {refspec}".format(remote=remoteName, refspec=refspec)
-                        pushOutput = subprocess.check_output(pushCmd.split(), stderr=subprocess.STDOUT).decode('utf-8')
-                        logger.info("Push to '{remote}' succeeded:".format(remote=remoteName))
-                        logger.info(pushOutput)
-                    except subprocess.CalledProcessError as e:
-                        logger.error("Push to '{remote}' failed!".format(remote=remoteName))
-                        logger.debug("'{cmd}', returned {returncode} and failed with:".format(cmd="' '".join(e.cmd), returncode=e.returncode))
-                        logger.debug("{output}".format(output=e.output.decode('utf-8')))
-        
     def AppendCommitMessageSuffixStreamInfo(self, suffixList, linePrefix, stream):
         if stream is not None:
             suffixList.append( ('{linePrefix}:'.format(linePrefix=linePrefix), '{name} (id: {id}; type: {Type})'.format(id=stream.streamNumber, name=stream.name, Type=stream.Type)) )
@@ -2095,51 +4130,17 @@ class AccuRev2Git(object):
             return sanitized
         return sanitized[len("refs/heads/"):]
 
-    def BuildStreamTree(self, streams):
-        rv = {}
-        for s in streams:
-            rv[s.streamNumber] = { "parent": s.basisStreamNumber, "children": [], "self": s }
-        for s in streams:
-            if s.basisStreamNumber is None:
-                continue
-            if s.basisStreamNumber not in rv:
-                raise Exception("Incomplete set of streams given! Stream {s} is missing from the streams list, cannot build tree!".format(s=s.basisStreamNumber))
-            rv[s.basisStreamNumber]["children"].append(s.streamNumber)
-        return rv
-
-    def PruneStreamTree(self, streamTree, keepList):
-        rv = None
-        if streamTree is not None:
-            if keepList is None:
-                return streamTree
-            elif len(keepList) == 1:
-                return { keepList[0]: { "parent": None, "children": [], "self": streamTree[keepList[0]]["self"] } }
-            rv = streamTree.copy()
-            # Remove all the streams that are not in the keepList and take their children and add them to the parent stream.
-            for s in streamTree:
-                if s not in keepList:
-                    # Find the next parent that we are keeping.
-                    p = streamTree[s]["parent"]
-                    while p is not None and p not in keepList:
-                        p = streamTree[p]["parent"]
-                    # If we found the parent then append our children to his/hers.
-                    if p is not None:
-                        c = streamTree[s]["children"]
-                        rv[p]["children"].extend(c)
-                    del rv[s]
-                    # Set the parent for all the children to either None or the actual parent.
-                    for c in streamTree[s]["children"]:
-                        if c in rv:
-                            rv[c]["parent"] = p
-            # Remove all the streams that are not in the keepList from each streams children list.
-            for s in rv:
-                children = []
-                for c in rv[s]["children"]:
-                    if c in keepList:
-                        children.append(c)  # subset of children
-                rv[s]["children"] = children
-
-        return rv
+    # Returns the StreamTree for the \a streams of transaction \a tr. The tree is kept between transactions and only the stream whose basis was changed by
+    # a chstream transaction is updated. It is rebuilt when the number of streams changes (e.g. mkstream, mkws) or when there is no tree yet.
+    # Returns the tree of the streams in the \a keepList, see StreamTree.Prune(), for the stream list \a streams. The tree of all the streams is
+    # brought up to date whenever a different stream list is given since any transaction, even one that we don't process, can change a basis.
+    def GetStreamTree(self, streams, keepList):
+        with self.streamTreeLock:
+            if self.streamTreeStreams is not streams:
+                if self.streamTree is None or not self.streamTree.Update(streams.streams):
+                    self.streamTree = StreamTree(streams.streams)
+                self.streamTreeStreams = streams
+            return self.streamTree.Prune(keepList=keepList)
 
     def GetStreamCommitHistoryRef(self, depot, streamNumber):
         depotObj = self.GetDepot(depot)
@@ -2150,6 +4151,134 @@ class AccuRev2Git(object):
             return u'{refsNS}state/depots/{depotNumber}/streams/{streamNumber}/commit_history'.format(refsNS=AccuRev2Git.gitRefsNamespace, depotNumber=depot.number, streamNumber=streamNumber)
         return None
 
+    def GetStreamCommitTimelineRef(self, depot, streamNumber):
+        historyRef = self.GetStreamCommitHistoryRef(depot, streamNumber)
+        if historyRef is None:
+            return None
+        return u'{0}_timeline'.format(historyRef)
+
+    # The stream timelines index the commit_history refs so that GetBasisCommitHash() can find the commit of a stream at a given time with a binary
+    # search instead of walking the history with `git log`. Each timeline is loaded when first needed from its commit_timeline ref, which is brought
+    # up to date with the commit_history commits made since it was last written, kept up to date by LogBranchState() and written back by
+    # SaveStreamTimelines().
+    def EnableStreamTimelines(self):
+        self.streamTimelines = {}
+
+    def DisableStreamTimelines(self):
+        self.streamTimelines = None
+
+    def GetStreamTimeline(self, depot, streamNumber):
+        # The timelines are loaded by the scheduler's threads too, see ScheduleTransaction().
+        with self.streamTimelinesLock:
+            historyRef = self.GetStreamCommitHistoryRef(depot, streamNumber)
+            timeline = self.streamTimelines.get(historyRef)
+            if timeline is not None:
+                return timeline
+
+            timelineRef = self.GetStreamCommitTimelineRef(depot, streamNumber)
+            timelineJson = self.ReadFileRef(ref=timelineRef)
+            timeline = StreamTimeline.fromjson(timelineJson) if timelineJson is not None else StreamTimeline()
+
+            historyHead = self.gitRepo.raw_cmd([ u'git', u'show-ref', u'--hash', historyRef ])
+            historyHead = historyHead.strip() if historyHead is not None else None
+            if historyHead is None or len(historyHead) == 0:
+                timeline = StreamTimeline()
+            elif timeline.head != historyHead:
+                afterCommitHash = None
+                if timeline.head is not None and self.gitRepo.merge_base(commits=[ timeline.head, historyHead ], is_ancestor=True):
+                    afterCommitHash = timeline.head
+                else:
+                    timeline = StreamTimeline() # The commit_history ref was rewritten, rebuild the timeline from scratch.
+                cmd = [ u'git', u'log', u'--first-parent', u'--reverse', u'--min-parents=2', u'--format=%ct %s %P', historyRef ]
+                if afterCommitHash is not None:
+                    cmd.append(u'^{0}'.format(afterCommitHash))
+                logOutput = self.TryGitCommand(cmd=cmd)
+                if logOutput is None:
+                    raise Exception("Failed to read the commit history from {ref}.".format(ref=historyRef))
+                for line in logOutput.split('\n'):
+                    if len(line.strip()) == 0:
+                        continue
+                    timestamp, trKeyword, trId, parents = line.split(' ', 3)
+                    timeline.Append(timestamp, trId, parents.split()[1])
+                timeline.head = historyHead
+                timeline.dirty = True
+
+            self.streamTimelines[historyRef] = timeline
+            return timeline
+
+    # Writes the timelines that changed since they were loaded to their commit_timeline refs.
+    def SaveStreamTimelines(self):
+        if self.streamTimelines is None:
+            return
+        with self.streamTimelinesLock:
+            timelines = list(self.streamTimelines.items())
+        for historyRef, timeline in timelines:
+            if timeline.dirty:
+                if self.WriteFileRef(ref=u'{0}_timeline'.format(historyRef), text=timeline.tojson()) != True:
+                    raise Exception("Failed to write the timeline for {ref}.".format(ref=historyRef))
+                timeline.dirty = False
+
+    # While the branch state buffer is enabled LogBranchState() only records the commit_history entries in memory and FlushBranchStates() writes
+    # them all with a single `git fast-import` instead of running five git commands for every entry. ProcessTransactions() flushes the buffer
+    # before it writes its state so that the commit_history refs are always up to date with the last transaction recorded in the state.
+    def EnableBranchStateBuffer(self):
+        self.branchStateBuffer = []
+
+    def DisableBranchStateBuffer(self):
+        if self.branchStateBuffer is not None and len(self.branchStateBuffer) > 0:
+            logger.warning("Discarding {n} unflushed stream state entries.".format(n=len(self.branchStateBuffer)))
+        self.branchStateBuffer = None
+
+    def FlushBranchStates(self):
+        if self.branchStateBuffer is None or len(self.branchStateBuffer) == 0:
+            return
+
+        refs = list(OrderedDict.fromkeys([ ref for ref, tr, commitHash in self.branchStateBuffer ]))
+        existingRefs = self.gitRepo.for_each_ref(patterns=refs)
+        if existingRefs is None:
+            raise Exception("Failed to get the commit_history refs. Err: {err}".format(err=self.gitRepo.lastStderr))
+        lastStateCommits = { refname: objHash for refname, objHash, peeledHash in existingRefs }
+
+        stream = []
+        mark = 0
+        refMarks = {}
+        for ref, tr, commitHash in self.branchStateBuffer:
+            name, email = self.GetGitUserFromAccuRevUser(tr.user)
+            date, tz = self.GetGitDatetime(accurevUsername=tr.user, accurevDatetime=tr.time)
+            ident = u'{name} <{email}> {timestamp} {tz:+05}'.format(name=name, email=email if email is not None else '', timestamp=int(accurev.GetTimestamp(tr.time)), tz=tz)
+            message = u'transaction {trId}'.format(trId=tr.id)
+
+            parent = refMarks.get(ref, lastStateCommits.get(ref))
+            if parent is None:
+                # Since we will use git log --first-parent a lot we need to make sure we have a parentless commit to start off with.
+                mark += 1
+                stream.append(u'commit {ref}\nmark :{mark}\nauthor {ident}\ncommitter {ident}\ndata {size}\n{message}\n'.format(ref=ref, mark=mark, ident=ident, size=len(message.encode('utf-8')), message=message))
+                parent = u':{0}'.format(mark)
+            mark += 1
+            stream.append(u'commit {ref}\nmark :{mark}\nauthor {ident}\ncommitter {ident}\ndata {size}\n{message}\nfrom {parent}\nmerge {h}\n'.format(ref=ref, mark=mark, ident=ident, size=len(message.encode('utf-8')), message=message, parent=parent, h=commitHash))
+            refMarks[ref] = u':{0}'.format(mark)
+
+        marksFilePath = None
+        with tempfile.NamedTemporaryFile(mode='w+', prefix='ac2git_marks_', encoding='utf-8', delete=False) as marksFile:
+            marksFilePath = marksFile.name
+        try:
+            if self.gitRepo.fast_import(stream=u''.join(stream), exportMarksFile=marksFilePath) is None:
+                raise Exception("Failed to write {n} stream state entries to the commit_history refs. Err: {err}".format(n=len(self.branchStateBuffer), err=self.gitRepo.lastStderr))
+            with codecs.open(marksFilePath, 'r', 'utf-8') as f:
+                marks = dict(line.split() for line in f if len(line.strip()) > 0)
+        finally:
+            os.remove(marksFilePath)
+
+        if self.streamTimelines is not None:
+            for ref in refMarks:
+                with self.streamTimelinesLock:
+                    timeline = self.streamTimelines.get(ref)
+                if timeline is not None:
+                    timeline.head = marks[refMarks[ref]]
+                    timeline.dirty = True
+        logger.debug("Flushed {n} stream state entries to {r} commit_history refs.".format(n=len(self.branchStateBuffer), r=len(refMarks)))
+        self.branchStateBuffer = []
+
     def LogBranchState(self, stream, tr, commitHash):
         assert stream is not None and commitHash is not None and tr is not None, "LogBranchState(stream={s}, tr={t}, commitHash={h}) does not accept None arguments.".format(s=stream, t=tr, h=commitHash)
 
@@ -2158,6 +4287,17 @@ class AccuRev2Git(object):
         if streamStateRefspec is None:
             raise Exception("Failed to get hidden ref for stream {streamName} (id: {streamNumber}) depot {depotName}".format(streamName=stream.name, streamNumber=stream.streamNumber, depotName=stream.depotName))
 
+        if self.branchStateBuffer is not None:
+            if self.streamTimelines is not None:
+                self.GetStreamTimeline(stream.depotName, stream.streamNumber).Append(accurev.GetTimestamp(tr.time), tr.id, commitHash) # The head is set by FlushBranchStates().
+            task = getattr(self.taskLocal, 'task', None)
+            if task is not None:
+                task.branchStates.append( (streamStateRefspec, tr, commitHash) ) # Added to the buffer once the transactions before it are done.
+            else:
+                self.branchStateBuffer.append( (streamStateRefspec, tr, commitHash) )
+            logger.debug("Buffered stream state for {streamName} to {ref} - tr. {trType} {trId} - commit {h}".format(trType=tr.Type, trId=tr.id, streamName=stream.name, ref=streamStateRefspec, h=self.ShortHash(commitHash)))
+            return
+
         # Write the empty tree to the git repository to ensure there is one.
         emptyTree = self.gitRepo.empty_tree(write=True)
         if emptyTree is None or len(emptyTree) == 0:
@@ -2174,6 +4314,10 @@ class AccuRev2Git(object):
         stateCommitHash = self.Commit(transaction=tr, allowEmptyCommit=True, messageOverride='transaction {trId}'.format(trId=tr.id), parents=[ lastStateCommitHash, commitHash ], treeHash=emptyTree, ref=streamStateRefspec, checkout=False, authorIsCommitter=True)
         if stateCommitHash is None:
             raise Exception("Failed to commit {Type} {tr} to hidden state ref {ref} with commit {h}".format(Type=tr.Type, tr=tr.id, ref=streamStateRefspec, h=self.ShortHash(commitHash)))
+        if self.streamTimelines is not None and streamStateRefspec in self.streamTimelines:
+            timeline = self.streamTimelines[streamStateRefspec]
+            timeline.Append(accurev.GetTimestamp(tr.time), tr.id, commitHash, head=stateCommitHash)
+            timeline.dirty = True
         logger.debug("Committed stream state for {streamName} to {ref} - tr. {trType} {trId} - commit {h}".format(trType=tr.Type, trId=tr.id, streamName=stream.name, ref=streamStateRefspec, h=self.ShortHash(stateCommitHash)))
 
     def TagTransaction(self, tagName, objHash, tr, stream, title=None, friendlyMessage=None, force=False):
@@ -2216,7 +4360,11 @@ class AccuRev2Git(object):
         rv = self.gitRepo.create_tag(name=tagName, obj=objHash, annotated=True, force=force, message_file=messageFilePath, tagger_name=taggerName, tagger_email=taggerEmail, tagger_date=taggerDate, tagger_tz=taggerTimezone, cleanup='whitespace')
         os.remove(messageFilePath)
         
-        if rv is None:
+        if rv is not None:
+            self.SetBranchHead(ref="refs/tags/{0}".format(tagName), commitHash=objHash)
+        else:
+            if self.branchHeads is not None:
+                self.branchHeadsStale = True # We don't know what happened to the tag so ask git.
             # Depending on the version of Git we can't trust the return value of the `git tag` command.
             # Hence we use `git log refs/tags/<tag name>` instead of peeling back the tag to ensure that
             # it was correctly created.
@@ -2267,8 +4415,88 @@ class AccuRev2Git(object):
             raise Exception("Failed to diff {r1} to {r2}! Cmd: {cmd}, Err: {err}".format(r1=ref1, r2=ref2, cmd=' '.join(cmd), err=self.gitRepo.lastStderr))
         return diff.strip()
     
+    # Returns a dictionary mapping each of the \a commitHashes to its tree hash. Trees that we already know about (because we committed them or
+    # because they were looked up before) are taken from self.commitTreeHashes while the rest are looked up with a single `git cat-file --batch-check`.
+    def GetCommitTreeHashes(self, commitHashes):
+        treeHashes = {}
+        for commitHash in commitHashes:
+            treeHash = self.GetCachedTreeHash(commitHash)
+            if treeHash is not None:
+                treeHashes[commitHash] = treeHash
+        unknown = [ x for x in OrderedDict.fromkeys(commitHashes) if x not in treeHashes ]
+        if len(unknown) > 0:
+            results = self.gitRepo.cat_file_batch_check(objects=[ '{0}^{{tree}}'.format(x) for x in unknown ])
+            if results is None:
+                raise Exception("Failed to get the tree hashes for commits {c}. Err: {err}".format(c=unknown, err=self.gitRepo.lastStderr))
+            for commitHash, result in zip(unknown, results):
+                if result is None:
+                    raise Exception("Failed to get the tree hash for commit {c}. It doesn't exist or isn't a commit.".format(c=commitHash))
+                treeHashes[commitHash] = result[0]
+                self.AddCommitToCaches(commitHash=commitHash, treeHash=result[0])
+        return treeHashes
+
+    # The tree hashes of the commits that we made or looked up, see GetCommitTreeHashes(), and the commit graph are shared by the scheduler's
+    # threads so they are only used under the commitCacheLock. Only the most recently used tree hashes are kept, see commitTreeHashCacheSize.
+    def GetCachedTreeHash(self, commitHash):
+        with self.commitCacheLock:
+            treeHash = self.commitTreeHashes.get(commitHash)
+            if treeHash is not None:
+                self.commitTreeHashes.move_to_end(commitHash)
+            return treeHash
+
+    # Records the \a treeHash of the commit and, if the \a parents are given, adds it to the commit graph.
+    def AddCommitToCaches(self, commitHash, treeHash, parents=None):
+        with self.commitCacheLock:
+            self.commitTreeHashes[commitHash] = treeHash
+            self.commitTreeHashes.move_to_end(commitHash)
+            while len(self.commitTreeHashes) > AccuRev2Git.commitTreeHashCacheSize:
+                self.commitTreeHashes.popitem(last=False)
+            if parents is not None and self.commitGraph is not None:
+                self.commitGraph.Add(commitHash, parents)
+
+    # Returns the empty-diff-check option that is in effect. The "auto" option is "diff" if the repo has a .git/info/attributes file, since the diff
+    # attributes in it could make commits with different trees the same, and "tree" otherwise.
+    def GetEmptyDiffCheck(self):
+        if self.config.git.emptyDiffCheck == "auto":
+            return "diff" if os.path.isfile(os.path.join(self.gitRepo.path, '.git', 'info', 'attributes')) else "tree"
+        return self.config.git.emptyDiffCheck
+
+    # Returns True if the two commits have the same contents. Both commits are data commits or branch heads whose trees are usually already known so,
+    # unless there are diff attributes to respect, this is a tree hash comparison. When the empty-diff-check option is "diff" a `git diff` is used
+    # instead so that the diff attributes in .git/info/attributes (e.g. to ignore some files) are respected, see GetEmptyDiffCheck(). The \a treeHash1
+    # and \a treeHash2 can be given if they are known.
+    def HaveSameContents(self, commitHash1, commitHash2, treeHash1=None, treeHash2=None):
+        if self.GetEmptyDiffCheck() == "diff":
+            return len(self.GitDiff(commitHash1, commitHash2)) == 0
+
+        if treeHash1 is not None:
+            self.AddCommitToCaches(commitHash=commitHash1, treeHash=treeHash1)
+        if treeHash2 is not None:
+            self.AddCommitToCaches(commitHash=commitHash2, treeHash=treeHash2)
+        treeHashes = self.GetCommitTreeHashes([ commitHash1, commitHash2 ])
+        return treeHashes[commitHash1] == treeHashes[commitHash2]
+
+    # Loads the commit graph for all of the branches and tags with a single `git rev-list`. While it is loaded the commits that we make are added
+    # to it and GitMergeBase(isAncestor=True) uses it instead of running `git merge-base --is-ancestor`.
+    def LoadCommitGraph(self):
+        commits = self.gitRepo.rev_list_parents(revs=[ u'--branches', u'--tags' ])
+        if commits is None:
+            raise Exception("Failed to load the commit graph. Err: {err}".format(err=self.gitRepo.lastStderr))
+        self.commitGraph = CommitGraph()
+        for commitHash, parents in commits:
+            self.commitGraph.Add(commitHash, parents)
+        logger.debug("Loaded {n} commits into the commit graph.".format(n=len(self.commitGraph)))
+
+    def UnloadCommitGraph(self):
+        self.commitGraph = None
+
     def GitMergeBase(self, refs=[], isAncestor=False):
         assert None not in refs, "None is not an accepted value for a ref. Given refs are {refs}".format(refs=refs)
+        if isAncestor and self.commitGraph is not None and len(refs) == 2:
+            with self.commitCacheLock:
+                isAncestorResult = self.commitGraph.IsAncestor(refs[0], refs[1])
+            if isAncestorResult is not None:
+                return isAncestorResult
         hashes = []
         for ref in refs:
             hashes.append(self.GitRevParse(ref))
@@ -2328,9 +4556,7 @@ class AccuRev2Git(object):
 
                 # Do a diff
                 parents = None # Used to decide if we need to perform the commit. If None, don't commit, otherwise we manually set the parent chain.
-                diff = self.GitDiff(lastCommitHash, childStreamData["data_hash"])
-
-                if len(diff) == 0:
+                if self.HaveSameContents(lastCommitHash, childStreamData["data_hash"], treeHash2=childTreeHash):
                     if self.GitMergeBase(refs=[ lastChildCommitHash, lastCommitHash ], isAncestor=True):
                         # Fast-forward the child branch to here.
                         if self.UpdateAndCheckoutRef(ref='refs/heads/{branch}'.format(branch=childBranchName), commitHash=lastCommitHash, checkout=False) != True:
@@ -2395,6 +4621,35 @@ class AccuRev2Git(object):
         cmd = [u'git', u'log', u'-1', u'--format=format:{format}'.format(format=customFormat), u'--first-parent', u'--max-parents=0', ref]
         return self.TryGitCommand(cmd=cmd)
 
+    # The GetBasisCommitHash() lookup done with the basis stream's timeline instead of walking its commit_history ref with `git log`.
+    def GetBasisCommitHashFromTimeline(self, basisStream, basisBranchName, minTime, streamName, streamNumber, timelockMessage):
+        timeline = self.GetStreamTimeline(basisStream.depotName, basisStream.streamNumber)
+        firstEntry = timeline.First()
+        if firstEntry is None:
+            logger.error("Failed to retrieve first commit hash for {ref}".format(ref=self.GetStreamCommitHistoryRef(basisStream.depotName, basisStream.streamNumber)))
+            return None, None, None, None
+
+        entry = None
+        if minTime is not None and accurev.GetTimestamp(minTime) < firstEntry[0]:
+            # The timelock has been created before the creation date of the stream. We cannot return its
+            # state before this time so we must return its first known/possible state.
+            entry = firstEntry
+            logger.warning("Currently processed transaction requested its basis commit hash before its basis existed.")
+            logger.warning("  - Earliest time available: {t}.".format(t=accurev.UTCDateTimeOrNone(firstEntry[0])))
+            logger.warning("  - Time requested:          {t}.".format(t=minTime))
+            logger.warning(" Returning the earliest time available instead. TODO: What does Accurev actually do here? Should we look at the next basis in the chain?")
+        elif minTime is not None and accurev.GetTimestamp(minTime) != 0:
+            entry = timeline.Find(accurev.GetTimestamp(minTime))
+        else:
+            entry = timeline.entries[-1]
+
+        if entry is None:
+            logger.error("Failed to find the commit for {name} (id: {sn}){timelockMsg} in the timeline of {basisName} (id: {basisSN}).".format(name=streamName, sn=streamNumber, basisName=basisStream.name, basisSN=basisStream.streamNumber, timelockMsg=timelockMessage))
+            return None, None, None, None
+
+        logger.debug("GetBasisCommitHash: Basis stream {basisName} (id: {basisSN}) at commit hash {h} is the basis for stream {name} (id: {sn}){timelockMsg}. (Retrieved from timeline, tr. {trId})".format(name=streamName, sn=streamNumber, basisName=basisStream.name, basisSN=basisStream.streamNumber, timelockMsg=timelockMessage, h=self.ShortHash(entry[2]), trId=entry[1]))
+        return basisStream, basisBranchName, entry[2], minTime
+
     def GetBasisCommitHash(self, streamName, streamNumber, streamBasisNumber, streamTime, streams, streamMap, affectedStreamMap, streamCreationTime):
         # Get the current/new basis stream
         basisStream, basisBranchName, basisStreamData, basisTreeHash = self.UnpackStreamDetails(streams=streams, streamMap=streamMap, affectedStreamMap=affectedStreamMap, streamNumber=streamBasisNumber)
@@ -2436,6 +4691,9 @@ class AccuRev2Git(object):
                 timelockISO8601Str = "{datetime}Z".format(datetime=minTime.isoformat('T')) # The time is in UTC and ISO8601 requires us to specify Z for UTC.
                 timelockMessage = ", before {s}".format(s=timelockISO8601Str)
 
+            if self.streamTimelines is not None:
+                return self.GetBasisCommitHashFromTimeline(basisStream=basisStream, basisBranchName=basisBranchName, minTime=minTime, streamName=streamName, streamNumber=streamNumber, timelockMessage=timelockMessage)
+
             parentHashes = None
             earliestAllowedTimestamp = self.GetOrphanCommit(ref=basisBranchHistoryRef, customFormat='%at')
             if earliestAllowedTimestamp is None:
@@ -2473,21 +4731,28 @@ class AccuRev2Git(object):
         logger.debug("GetBasisCommitHash: Commit hash for stream {name} (id: {sn}) was not found.".format(name=streamName, sn=streamNumber))
         return None, None, None, None
 
-    # Processes a single transaction whose id is the trId (int) and which has been recorded against the streams outlined in the affectedStreamMap.
-    # affectedStreamMap is a dictionary with the following format { <key:stream_num_str>: { "state_hash": <val:state_ref_commit_hash>, "data_hash": <val:data_ref_commit_hash> } }
-    # The streamMap is used so that we can translate streams and their basis into branch names { <key:stream_num_str>: { "stream": <val:config_strem_name>, "branch": <val:config_branch_name> } }
-    def ProcessTransaction(self, streamMap, trId, affectedStreamMap, prevAffectedStreamMap):
+    # Returns the parsed streams.xml and hist.xml of the transaction \a trId as a (streams, trHist) tuple.
+    def GetTransactionInputs(self, trId, affectedStreamMap):
         # For all affected streams the streams.xml and hist.xml contents should be the same for the same transaction id so get it from any one of them.
-        arbitraryStreamNumberStr = next(iter(affectedStreamMap))
-        arbitraryStreamData = affectedStreamMap[arbitraryStreamNumberStr]
+        arbitraryStreamData = affectedStreamMap[next(iter(affectedStreamMap))]
         streamsXml, streams = self.GetStreamsInfo(ref=arbitraryStreamData["state_hash"])
         if streams is None:
             raise Exception("Couldn't get streams for transaction {tr}. Aborting!".format(tr=trId))
 
         # Get the transaction information.
         trHistXml, trHist = self.GetHistInfo(ref=arbitraryStreamData["state_hash"])
-        if trHist is None or len(trHist.transactions) == 0 is None:
+        if trHist is None or len(trHist.transactions) == 0:
             raise Exception("Couldn't get history for transaction {tr}. Aborting!".format(tr=trId))
+        return (streamsXml, streams, trHist)
+
+    # Processes a single transaction whose id is the trId (int) and which has been recorded against the streams outlined in the affectedStreamMap.
+    # affectedStreamMap is a dictionary with the following format { <key:stream_num_str>: { "state_hash": <val:state_ref_commit_hash>, "data_hash": <val:data_ref_commit_hash> } }
+    # The streamMap is used so that we can translate streams and their basis into branch names { <key:stream_num_str>: { "stream": <val:config_strem_name>, "branch": <val:config_branch_name> } }
+    # The \a streams and \a trHist are read with GetTransactionInputs() unless they are given.
+    def ProcessTransaction(self, streamMap, trId, affectedStreamMap, prevAffectedStreamMap, streams=None, trHist=None):
+        arbitraryStreamNumberStr = next(iter(affectedStreamMap))
+        if streams is None or trHist is None:
+            streamsXml, streams, trHist = self.GetTransactionInputs(trId=trId, affectedStreamMap=affectedStreamMap)
         tr = trHist.transactions[0]
 
         # Get the name and number of the stream on which this transaction had occurred.
@@ -2533,11 +4798,10 @@ class AccuRev2Git(object):
                     parents = [ lastCommitHash ]
                     targetStreams.append( (stream, branchName, streamData, treeHash, parents) )
                 else:
-                    allStreamTree = self.BuildStreamTree(streams=streams.streams)
                     keepList = list(set([ sn for sn in affectedStreamMap ]))
                     assert tr.stream.streamNumber not in keepList, "The stream must be tracked otherwise we would be in the if clause."
                     keepList.append(tr.stream.streamNumber)
-                    affectedStreamTree = self.PruneStreamTree(streamTree=allStreamTree, keepList=keepList)
+                    affectedStreamTree = self.GetStreamTree(streams=streams, keepList=keepList)
                     streamNode = affectedStreamTree[stream.streamNumber]
                     for sn in streamNode["children"]:
                         stream, branchName, streamData, treeHash = self.UnpackStreamDetails(streams=streams, streamMap=streamMap, affectedStreamMap=affectedStreamMap, streamNumber=sn)
@@ -2661,12 +4925,11 @@ class AccuRev2Git(object):
 
 
                 # Process all affected streams.
-                allStreamTree = self.BuildStreamTree(streams=streams.streams)
                 keepList = [ sn for sn in affectedStreamMap ]
                 if branchName is not None:
                     keepList.append(stream.streamNumber) # The stream on which the chstream transaction occurred will never be affected so we have to keep it in there explicitly for the MergeIntoChildren() algorithm (provided it is being processed).
                 keepList = list(set(keepList)) # Keep only unique values
-                affectedStreamTree = self.PruneStreamTree(streamTree=allStreamTree, keepList=keepList)
+                affectedStreamTree = self.GetStreamTree(streams=streams, keepList=keepList)
                 self.MergeIntoChildren(tr=tr, streamTree=affectedStreamTree, streamMap=streamMap, affectedStreamMap=affectedStreamMap, streams=streams, streamNumber=stream.streamNumber if branchName is not None else None)
 
         else:
@@ -2717,10 +4980,8 @@ class AccuRev2Git(object):
 
                 commitHash = None
                 if srcBranchName is not None and branchName is not None:
-                    # Do a git diff between the two data commits that we will be merging.
-                    diff = self.GitDiff(streamData["data_hash"], lastSrcBranchHash)
-
-                    if len(diff) == 0:
+                    # Compare the contents of the two data commits that we will be merging.
+                    if self.HaveSameContents(streamData["data_hash"], lastSrcBranchHash, treeHash1=treeHash):
                         parents = [ self.GetLastCommitHash(branchName=branchName) ]
                         isAncestor = self.GitMergeBase(refs=[ lastSrcBranchHash, parents[0] ], isAncestor=True)
                         assert isAncestor is not None, "Invariant error! Failed to determine merge base between {c1} and {c2}!".format(c1=lastSrcBranchHash, c2=parents[0])
@@ -2770,12 +5031,11 @@ class AccuRev2Git(object):
                 # ----------------------------------------------------
 
                 # Process all affected streams (which are generally the child streams of this stream).
-                allStreamTree = self.BuildStreamTree(streams=streams.streams)
                 keepList = list(set([ sn for sn in affectedStreamMap ]))
                 if srcStreamNumber is not None and srcStreamNumber in keepList:
                     keepList.remove(srcStreamNumber) # The source stream should never be in the affected streams list.
                     logger.warning("{trType} {tr}. dst stream {dst}, src stream {src}. The src stream was found in the affected child streams list which shouldn't be possible. Removing from affected child streams.".format(trType=tr.Type, tr=tr.id, dst=streamName, src=srcStreamName))
-                affectedStreamTree = self.PruneStreamTree(streamTree=allStreamTree, keepList=keepList)
+                affectedStreamTree = self.GetStreamTree(streams=streams, keepList=keepList)
                 self.MergeIntoChildren(tr=tr, streamTree=affectedStreamTree, streamMap=streamMap, affectedStreamMap=affectedStreamMap, streams=streams, streamNumber=(None if commitHash is None else streamNumber))
 
             else:
@@ -2835,6 +5095,203 @@ class AccuRev2Git(object):
                     lowestHwm = hwm["high-water-mark"]
         return lowestHwm
 
+    # Records in the \a state that the transaction \a trId was processed, along with the list of (branchName, commitHash, isCurrent) tuples in
+    # \a branchHeadList, and writes it to the \a stateRefspec so that we can restore the branches on the next restart.
+    def SaveTransactionState(self, state, stateRefspec, trId, affectedStreamMap, branchHeadList):
+        state["branch_list"] = []
+        for branchName, commitHash, isCurrent in branchHeadList:
+            brHash = OrderedDict()
+            brHash["name"] = branchName
+            brHash["commit"] = commitHash
+            brHash["is_current"] = isCurrent
+            state["branch_list"].append(brHash)
+
+        state["last_transaction"] = trId
+        state["last_affected_stream_map"] = OrderedDict([ (str(sn), streamData) for sn, streamData in affectedStreamMap.items() ])
+        for sn, streamData in affectedStreamMap.items():
+            checkpoint = state["stream_checkpoints"].setdefault(str(sn), {})
+            checkpoint["state_hash"] = streamData["state_hash"]
+            if "data_hash" in streamData:
+                checkpoint["data_hash"] = streamData["data_hash"]
+        self.FlushBranchStates() # The commit_history refs must include this transaction before the state says that it was processed.
+        if self.WriteFileRef(ref=stateRefspec, text=json.dumps(state)) != True:
+            raise Exception("Failed to write state to {ref}.".format(ref=stateRefspec))
+
+    # Returns the blob hash of the streams.xml of the info commit \a ref, whose contents are \a streamsXml. It is taken from the transaction journal
+    # if it is there and otherwise hashed the way that git does it, without running git.
+    def GetStreamsHash(self, ref, streamsXml):
+        if self.transactionJournal is not None:
+            streamsHash = self.transactionJournal.GetStreamsHash(ref)
+            if streamsHash is not None:
+                return streamsHash
+        data = streamsXml.encode('utf-8')
+        return hashlib.sha1(u'blob {0}\0'.format(len(data)).encode('utf-8') + data).hexdigest()
+
+    # Returns a (basisMap, trackedStreams) tuple for the \a streams where the basisMap maps each stream number to its basis stream number and the
+    # trackedStreams map each tracked stream number to a (key, ancestry) tuple. The key is the topmost tracked stream among the stream and its
+    # ancestors and the ancestry is the set of the stream and its ancestors. Only worked out again when the stream list changes, i.e. when the
+    # \a streamsHash of its streams.xml changes, see GetStreamsHash().
+    def GetStreamKeys(self, streams, streamsHash, streamMap):
+        if self.streamKeyCache is not None and self.streamKeyCache[0] == streamsHash:
+            return self.streamKeyCache[1]
+
+        basisMap = {}
+        for stream in streams.streams:
+            basisMap[stream.streamNumber] = stream.basisStreamNumber
+        trackedSet = set([ int(sn) for sn in streamMap ])
+        trackedStreams = {}
+        for streamNumber in trackedSet:
+            key, ancestry = streamNumber, set()
+            sn = streamNumber
+            while sn is not None and sn in basisMap and sn not in ancestry:
+                ancestry.add(sn)
+                if sn in trackedSet:
+                    key = sn
+                sn = basisMap[sn]
+            trackedStreams[streamNumber] = (key, ancestry)
+
+        self.streamKeyCache = (streamsHash, (basisMap, trackedStreams))
+        return self.streamKeyCache[1]
+
+    # Returns the set of keys, see GetStreamKeys(), of the tracked streams above and below the streams affected by the transaction since these are
+    # the branches whose heads and timelines processing it reads and writes. Transactions whose keys don't intersect can be processed at the same
+    # time. Returns None for the transactions that change the stream structure, which have to be processed on their own.
+    def GetTransactionKeys(self, streams, streamsHash, trHist, streamMap, affectedStreamMap):
+        tr = trHist.transactions[0]
+        if tr.Type in [ "mkstream", "chstream" ] or tr.stream is not None:
+            return None
+        basisMap, trackedStreams = self.GetStreamKeys(streams=streams, streamsHash=streamsHash, streamMap=streamMap)
+
+        relatedSet = set([ int(sn) for sn in affectedStreamMap ])
+        for streamName, streamNumber in [ tr.affectedStream(), trHist.fromStream() ]:
+            if streamNumber is not None:
+                relatedSet.add(int(streamNumber))
+        relatedAncestry = set()
+        for sn in relatedSet:
+            while sn is not None and sn not in relatedAncestry:
+                relatedAncestry.add(sn)
+                sn = basisMap.get(sn)
+
+        keys = set()
+        for streamNumber, (key, ancestry) in trackedStreams.items():
+            if streamNumber in relatedAncestry or not relatedSet.isdisjoint(ancestry):
+                keys.add(key)
+        return keys if len(keys) > 0 else None
+
+    # While the transaction scheduler is enabled ScheduleTransaction() processes the transactions on a thread pool instead of one at a time. Each
+    # transaction waits only for the earlier transactions that share one of its keys, see GetTransactionKeys(), so every branch still gets its
+    # commits in the same order and with the same parents as when they are processed one at a time. The state is saved strictly in transaction
+    # order by CompleteScheduledTransactions(), using the branch heads as they were after that transaction, so that the conversion can be resumed
+    # from it like before.
+    def EnableTransactionScheduler(self, threadCount, knownBranchSet):
+        self.transactionExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=threadCount)
+        self.transactionThreadCount = threadCount
+        self.scheduledTransactions = deque()
+        self.scheduledKeys = {}
+        self.committedBranchHeads = OrderedDict([ (branchName, commitHash) for branchName, commitHash, isCurrent in self.GetBranchHeadList(branchNames=knownBranchSet) ])
+
+    def DisableTransactionScheduler(self):
+        if self.transactionExecutor is None:
+            return
+        for task in self.scheduledTransactions:
+            task.future.cancel()
+        self.transactionExecutor.shutdown(wait=True)
+        if len(self.scheduledTransactions) > 0:
+            logger.warning("Discarding {n} scheduled transactions whose state wasn't saved.".format(n=len(self.scheduledTransactions)))
+        self.transactionExecutor = None
+        self.transactionThreadCount = None
+        self.scheduledTransactions = None
+        self.scheduledKeys = None
+        self.committedBranchHeads = None
+
+    # Runs on the scheduler's threads, and on this one for the transactions that have to be processed on their own. The scheduler's threads get
+    # their own git.repo the first time that they run a transaction, see gitRepo.
+    def RunScheduledTransaction(self, streamMap, task, dependencies, isSchedulerThread=False):
+        for future in dependencies:
+            future.result() # Re-raises the exception of a failed dependency so that this transaction isn't processed either.
+        if isSchedulerThread and self.mainGitRepo is not None and getattr(self.taskLocal, 'gitRepo', None) is None:
+            self.taskLocal.gitRepo = git.repo(self.mainGitRepo.path)
+        self.taskLocal.task = task
+        try:
+            self.ProcessTransaction(streamMap=streamMap, trId=task.trId, affectedStreamMap=task.affectedStreamMap, prevAffectedStreamMap=task.prevAffectedStreamMap, streams=task.streams, trHist=task.trHist)
+        finally:
+            self.taskLocal.task = None
+
+    def ScheduleTransaction(self, streamMap, trId, affectedStreamMap, prevAffectedStreamMap, state, stateRefspec, knownBranchSet):
+        # The inputs are read here since the transaction journal can only be used from this thread.
+        streamsXml, streams, trHist = self.GetTransactionInputs(trId=trId, affectedStreamMap=affectedStreamMap)
+        streamsHash = self.GetStreamsHash(ref=affectedStreamMap[next(iter(affectedStreamMap))]["state_hash"], streamsXml=streamsXml)
+        keys = self.GetTransactionKeys(streams=streams, streamsHash=streamsHash, trHist=trHist, streamMap=streamMap, affectedStreamMap=affectedStreamMap)
+        task = ScheduledTransaction(trId=trId, affectedStreamMap=affectedStreamMap, prevAffectedStreamMap=prevAffectedStreamMap, streams=streams, trHist=trHist, keys=keys)
+        if keys is None:
+            logger.debug("Transaction {tr} is processed on its own.".format(tr=trId))
+            self.CompleteScheduledTransactions(state=state, stateRefspec=stateRefspec, knownBranchSet=knownBranchSet)
+            self.RunScheduledTransaction(streamMap=streamMap, task=task, dependencies=[])
+            self.CompleteScheduledTransaction(task=task, state=state, stateRefspec=stateRefspec, knownBranchSet=knownBranchSet)
+            self.scheduledKeys = {}
+            return
+
+        dependencies = []
+        for key in keys:
+            prevTask = self.scheduledKeys.get(key)
+            if prevTask is not None and prevTask.future not in dependencies:
+                dependencies.append(prevTask.future)
+            self.scheduledKeys[key] = task
+        task.future = self.transactionExecutor.submit(self.RunScheduledTransaction, streamMap, task, dependencies, True)
+        self.scheduledTransactions.append(task)
+
+        # Save the state of the transactions that are done, in order, and don't let the rest get too far ahead.
+        maxScheduled = self.transactionThreadCount * AccuRev2Git.scheduledTransactionsPerThread
+        while len(self.scheduledTransactions) > 0 and (self.scheduledTransactions[0].future.done() or len(self.scheduledTransactions) > maxScheduled):
+            self.CompleteScheduledTransaction(task=self.scheduledTransactions.popleft(), state=state, stateRefspec=stateRefspec, knownBranchSet=knownBranchSet)
+
+    # Waits for the transaction \a task and saves the state after it. Must be called in transaction order.
+    def CompleteScheduledTransaction(self, task, state, stateRefspec, knownBranchSet):
+        if task.future is not None:
+            task.future.result()
+        for ref, commitHash in task.changedHeads.items():
+            if ref.startswith('refs/heads/') and ref[len('refs/heads/'):] in knownBranchSet:
+                self.committedBranchHeads[ref[len('refs/heads/'):]] = commitHash
+        self.branchStateBuffer.extend(task.branchStates)
+        branchHeadList = [ (branchName, self.committedBranchHeads[branchName], 'refs/heads/{0}'.format(branchName) == self.currentBranchRef) for branchName in sorted(self.committedBranchHeads) ]
+        self.SaveTransactionState(state=state, stateRefspec=stateRefspec, trId=task.trId, affectedStreamMap=task.affectedStreamMap, branchHeadList=branchHeadList)
+
+    # Waits for all of the scheduled transactions and saves the state after each of them.
+    def CompleteScheduledTransactions(self, state, stateRefspec, knownBranchSet):
+        while len(self.scheduledTransactions) > 0:
+            self.CompleteScheduledTransaction(task=self.scheduledTransactions.popleft(), state=state, stateRefspec=stateRefspec, knownBranchSet=knownBranchSet)
+
+    # Yields the transactionsMap.Items() while asking the transaction prefetcher, if there is one, to load the inputs of the transactions that follow
+    # the one being yielded. Only the transactions after \a startAfter and up to \a endTransaction are prefetched since the rest are skipped.
+    def PrefetchTransactions(self, transactionsMap, startAfter, endTransaction):
+        if self.transactionPrefetcher is None:
+            for item in transactionsMap.Items():
+                yield item
+            return
+
+        lookahead = deque()
+        items = transactionsMap.Items()
+        done = False
+        while True:
+            while not done and len(lookahead) <= self.transactionPrefetcher.depth:
+                item = next(items, None)
+                if item is None:
+                    done = True
+                else:
+                    lookahead.append(item)
+            if len(lookahead) == 0:
+                return
+            for tr, affectedStreams in lookahead:
+                if tr > endTransaction:
+                    break
+                elif tr > startAfter:
+                    stateHash = transactionsMap.FirstStateHash(affectedStreams)
+                    if self.IsInTransactionJournal(stateHash):
+                        continue # GetHistInfo() and GetStreamsInfo() won't ask for it.
+                    if not self.transactionPrefetcher.Prefetch(stateHash) and len(self.transactionPrefetcher.pending) >= self.transactionPrefetcher.depth:
+                        break
+            yield lookahead.popleft()
+
     def ProcessTransactions(self):
         depot = self.GetDepot(self.config.accurev.depot)
 
@@ -2844,6 +5301,9 @@ class AccuRev2Git(object):
         # Git refspec for the state ref in which we will store a blob.
         stateRefspec = u'{refsNS}state/depots/{depotNumber}/last'.format(refsNS=AccuRev2Git.gitRefsNamespace, depotNumber=depot.number)
 
+        # The transaction journal is used for the stream lookups below as well as for the transactions themselves. It stays open until we are done.
+        self.EnableTransactionJournal()
+
         # Load the streamMap from the current configuration file.
         streamMap = OrderedDict()
         configStreamMap = self.GetStreamMap()
@@ -2951,52 +5411,73 @@ class AccuRev2Git(object):
             state = { "depot_number": depot.number,
                       "stream_map": streamMap,
                       "last_transaction": (int(self.config.accurev.startTransaction) - 1),
-                      "branch_list": None }
+                      "branch_list": None,
+                      "stream_checkpoints": {},
+                      "last_affected_stream_map": None }
+
+        # The stream checkpoints are the last info and data commits of each stream that were processed, i.e. the ones at or before the last transaction.
+        # Only the commits after them need to be loaded since everything up to them has been processed already.
+        streamCheckpoints = state.get("stream_checkpoints")
+        if streamCheckpoints is None or state.get("last_affected_stream_map") is None:
+            streamCheckpoints = {} # The state was written by an older version, load everything.
 
         # Get the list of transactions that we are processing, and build a list of known branch names for maintaining their states between processing stages.
-        transactionsMap = {} # is a dictionary with the following format { <key:tr_num>: { <key:stream_num>: { "state_hash": <val:commit_hash>, "data_hash": <val:data_hash> } } }
+        transactionsMap = TransactionsMap()
         for streamNumberStr in state["stream_map"]:
             streamNumber = int(streamNumberStr)
 
             # Initialize the state that we load every time.
             stateRef, dataRef, hwmRef = self.GetStreamRefs(depot=state["depot_number"], streamNumber=streamNumber)
 
-            # Get the state ref's known transactions list.
-            logger.info("Getting transaction to info commit mapping for stream number {s}. Ref: {ref}".format(s=streamNumber, ref=stateRef))
-            stateMap = self.GetRefMap(ref=stateRef, mapType="tr2commit")
-            if stateMap is None:
-                raise Exception("Failed to retrieve the state map for stream {s} (id: {id}).".format(s=state["stream_map"][streamNumberStr]["stream"], id=streamNumber))
-
-            logger.info("Merging transaction to info commit mapping for stream number {s} with previous mappings. Ref: {ref}".format(s=streamNumber, ref=stateRef))
-            for tr in reversed(stateMap):
-                if tr not in transactionsMap:
-                    transactionsMap[tr] = {}
-                assert streamNumber not in transactionsMap[tr], "Invariant error! This should be the first time we are adding the stream {s} (id: {id})!".format(s=state["stream_map"][streamNumberStr]["stream"], id=streamNumber)
-                transactionsMap[tr][streamNumber] = { "state_hash": stateMap[tr] }
-            del stateMap # Make sure we free this, it could get big...
-
-            # Get the data ref's known transactions list.
-            logger.info("Getting transaction to data commit mapping for stream number {s}. Ref: {ref}".format(s=streamNumber, ref=stateRef))
-            dataMap = None
-            dataHashList = self.GetGitLogList(ref=dataRef, gitLogFormat='%H %s %T')
-            if dataHashList is None:
-                raise Exception("Couldn't get the commit hash list to process from the Accurev data ref {dataRef}.".format(dataRef=dataRef))
+            # Only resume from the checkpoint if the refs haven't been rewritten since it was made.
+            checkpoint = streamCheckpoints.get(streamNumberStr, {})
+            afterStateHash, afterDataHash = checkpoint.get("state_hash"), checkpoint.get("data_hash")
+            if afterStateHash is not None and not self.gitRepo.merge_base(commits=[ afterStateHash, stateRef ], is_ancestor=True):
+                logger.warning("The info ref {ref} doesn't contain the checkpoint {h}, loading all of its transactions.".format(ref=stateRef, h=self.ShortHash(afterStateHash)))
+                afterStateHash, afterDataHash = None, None
+            elif afterDataHash is not None and not self.gitRepo.merge_base(commits=[ afterDataHash, dataRef ], is_ancestor=True):
+                logger.warning("The data ref {ref} doesn't contain the checkpoint {h}, loading all of its transactions.".format(ref=dataRef, h=self.ShortHash(afterDataHash)))
+                afterStateHash, afterDataHash = None, None
+            if afterStateHash is None:
+                afterDataHash = None
+
+            if self.transactionJournal is not None and self.UpdateTransactionJournal(journal=self.transactionJournal, depot=state["depot_number"], streamNumber=streamNumber):
+                # The journal has all of the stream's commits so the mappings can be read from it instead of from the refs.
+                afterStateTr, afterDataTr = None, None
+                if afterStateHash is not None:
+                    afterStateTr = self.transactionJournal.GetCommitTransaction(depot=state["depot_number"], streamNumber=streamNumber, commitHash=afterStateHash)
+                if afterDataHash is not None and afterStateTr is not None:
+                    afterDataTr = self.transactionJournal.GetCommitTransaction(depot=state["depot_number"], streamNumber=streamNumber, commitHash=afterDataHash, isDataCommit=True)
+                logger.info("Getting transaction to commit mappings for stream number {s}{after} from the transaction journal.".format(s=streamNumber, after='' if afterStateTr is None else ' after tr. {tr}'.format(tr=afterStateTr)))
+                stateMap = self.transactionJournal.GetStateMap(depot=state["depot_number"], streamNumber=streamNumber, afterTr=afterStateTr)
+                dataList = self.transactionJournal.GetDataList(depot=state["depot_number"], streamNumber=streamNumber, afterTr=afterDataTr)
             else:
-                dataMap = OrderedDict()
+                # Get the state ref's known transactions list.
+                logger.info("Getting transaction to info commit mapping for stream number {s}{after}. Ref: {ref}".format(s=streamNumber, ref=stateRef, after='' if afterStateHash is None else ' after {h}'.format(h=self.ShortHash(afterStateHash))))
+                stateMap = self.GetRefMap(ref=stateRef, mapType="tr2commit", afterCommitHash=afterStateHash)
+                if stateMap is None:
+                    raise Exception("Failed to retrieve the state map for stream {s} (id: {id}).".format(s=state["stream_map"][streamNumberStr]["stream"], id=streamNumber))
+
+                # Get the data ref's known transactions list.
+                logger.info("Getting transaction to data commit mapping for stream number {s}{after}. Ref: {ref}".format(s=streamNumber, ref=dataRef, after='' if afterDataHash is None else ' after {h}'.format(h=self.ShortHash(afterDataHash))))
+                dataHashList = self.GetGitLogList(ref=dataRef, afterCommitHash=afterDataHash, gitLogFormat='%H %s %T')
+                if dataHashList is None:
+                    raise Exception("Couldn't get the commit hash list to process from the Accurev data ref {dataRef}.".format(dataRef=dataRef))
+                dataList = []
                 for line in reversed(dataHashList):
                     columns = line.split(' ')
-                    trId, commitHash, treeHash = int(columns[2]), columns[0], columns[3]
-                    dataMap[trId] = { "data_hash": commitHash, "data_tree_hash": treeHash }
-
-            if dataMap is None:
-                raise Exception("Failed to retrieve the data map for stream {s} (id: {id}).".format(s=state["stream_map"][streamNumberStr], id=streamNumber))
-
-            logger.info("Merging transaction to data commit mapping for stream number {s} with previous mappings. Ref: {ref}".format(s=streamNumber, ref=stateRef))
-            for tr in reversed(dataMap):
-                assert tr in transactionsMap and streamNumber in transactionsMap[tr], "Invariant error! The data ref should contain a subset of the state ref information, not a superset!"
-                transactionsMap[tr][streamNumber]["data_hash"] = dataMap[tr]["data_hash"]
-                transactionsMap[tr][streamNumber]["data_tree_hash"] = dataMap[tr]["data_tree_hash"]
-            del dataMap # Make sure we free this, it could get big...
+                    dataList.append( (int(columns[2]), columns[0], columns[3]) )
+                del dataHashList
+
+            logger.info("Merging transaction to commit mappings for stream number {s} with previous mappings. Ref: {ref}".format(s=streamNumber, ref=stateRef))
+            transactionsMap.AddStream(streamNumber=streamNumber, stateMap=stateMap, dataList=dataList)
+            del stateMap, dataList # Make sure we free these, they could get big...
+
+            if afterStateHash is None:
+                # Work out the checkpoint from the transactions that were loaded.
+                checkpoint = transactionsMap.Checkpoint(streamNumber=streamNumber, trId=state["last_transaction"])
+            streamCheckpoints[streamNumberStr] = checkpoint
+        state["stream_checkpoints"] = { sn: streamCheckpoints[sn] for sn in state["stream_map"] } # Drop the checkpoints of the removed streams.
                 
         # Other state variables
         endTransaction = self.GetDepotHighWaterMark(self.config.accurev.depot)
@@ -3011,36 +5492,54 @@ class AccuRev2Git(object):
         logger.info("Processing transactions for {depot} depot.".format(depot=self.config.accurev.depot))
         knownBranchSet = set([ state["stream_map"][x]["branch"] for x in state["stream_map"] ]) # Get the list of all branches that we will create.
         prevAffectedStreamMap = None
-        for tr in sorted(transactionsMap):
-            if tr <= state["last_transaction"]:
-                prevAffectedStreamMap = transactionsMap[tr]
-                del transactionsMap[tr] # ok since sorted returns a sorted list by copy.
-                continue
-            elif tr > endTransaction:
-                break
-
-            # Process the transaction!
-            self.ProcessTransaction(streamMap=state["stream_map"], trId=tr, affectedStreamMap=transactionsMap[tr], prevAffectedStreamMap=prevAffectedStreamMap)
-
-            # Store the state of the branches in the repo at this point in time so that we can restore it on next restart.
-            state["branch_list"] = []
-            for br in self.gitRepo.branch_list():
-                if br is None:
-                    logger.error("Error: git.py failed to parse a branch name! Please ensure that the git.repo.branch_list() returns a list with no None items. Non-fatal, continuing.")
+        if state.get("last_affected_stream_map") is not None:
+            prevAffectedStreamMap = OrderedDict([ (int(sn), streamData) for sn, streamData in state["last_affected_stream_map"].items() ])
+        self.EnableBranchHeads() # From here on the branches are only changed by us, see GetBranchHead().
+        self.LoadCommitGraph()
+        self.EnableStreamTimelines()
+        self.EnableBranchStateBuffer()
+        self.streamTree, self.streamTreeStreams = None, None
+        try:
+            if self.config.accurev.prefetchDepth > 0:
+                self.transactionPrefetcher = TransactionPrefetcher(gitRepoPath=self.gitRepo.path, depth=self.config.accurev.prefetchDepth, processCount=min(self.config.accurev.prefetchDepth, os.cpu_count() or 1))
+            if self.config.git.processThreads > 0:
+                logger.info("Processing independent transactions on {n} threads.".format(n=self.config.git.processThreads))
+                self.EnableTransactionScheduler(threadCount=self.config.git.processThreads, knownBranchSet=knownBranchSet)
+            prevAffectedStreams = None
+            for tr, affectedStreams in self.PrefetchTransactions(transactionsMap=transactionsMap, startAfter=state["last_transaction"], endTransaction=endTransaction):
+                if tr <= state["last_transaction"]:
+                    prevAffectedStreams = affectedStreams
                     continue
-                elif br.name in knownBranchSet:
-                    # We only care about the branches that we are processing, i.e. the branches that are in the streamMap.
-                    brHash = OrderedDict()
-                    brHash["name"] = br.name
-                    brHash["commit"] = br.shortHash
-                    brHash["is_current"] = br.isCurrent
-                    state["branch_list"].append(brHash)
+                elif tr > endTransaction:
+                    break
 
-            state["last_transaction"] = tr
-            if self.WriteFileRef(ref=stateRefspec, text=json.dumps(state)) != True:
-                raise Exception("Failed to write state to {ref}.".format(ref=stateRefspec))
+                # Process the transaction!
+                affectedStreamMap = transactionsMap.AffectedStreamMap(affectedStreams)
+                if prevAffectedStreamMap is None and prevAffectedStreams is not None:
+                    prevAffectedStreamMap = transactionsMap.AffectedStreamMap(prevAffectedStreams)
+                if self.transactionExecutor is not None:
+                    self.ScheduleTransaction(streamMap=state["stream_map"], trId=tr, affectedStreamMap=affectedStreamMap, prevAffectedStreamMap=prevAffectedStreamMap, state=state, stateRefspec=stateRefspec, knownBranchSet=knownBranchSet)
+                else:
+                    self.ProcessTransaction(streamMap=state["stream_map"], trId=tr, affectedStreamMap=affectedStreamMap, prevAffectedStreamMap=prevAffectedStreamMap)
 
-            prevAffectedStreamMap = transactionsMap[tr]
+                    # Store the state of the branches in the repo at this point in time so that we can restore it on next restart.
+                    # We only care about the branches that we are processing, i.e. the branches that are in the streamMap.
+                    self.SaveTransactionState(state=state, stateRefspec=stateRefspec, trId=tr, affectedStreamMap=affectedStreamMap, branchHeadList=self.GetBranchHeadList(branchNames=knownBranchSet))
+
+                prevAffectedStreamMap = affectedStreamMap
+            if self.transactionExecutor is not None:
+                self.CompleteScheduledTransactions(state=state, stateRefspec=stateRefspec, knownBranchSet=knownBranchSet)
+            self.SaveStreamTimelines()
+        finally:
+            self.DisableTransactionScheduler()
+            if self.transactionPrefetcher is not None:
+                self.transactionPrefetcher.Close()
+                self.transactionPrefetcher = None
+            self.DisableBranchStateBuffer()
+            self.DisableStreamTimelines()
+            self.UnloadCommitGraph()
+            self.DisableBranchHeads()
+            self.DisableTransactionJournal()
         return True
 
             
@@ -3116,6 +5615,8 @@ class AccuRev2Git(object):
         # From here on we will operate from the git repository.
         if self.config.accurev.commandCacheFilename is not None:
             self.config.accurev.commandCacheFilename = os.path.abspath(self.config.accurev.commandCacheFilename)
+        if self.config.accurev.versionStoreFilename is not None:
+            self.config.accurev.versionStoreFilename = os.path.abspath(self.config.accurev.versionStoreFilename)
         self.cwd = os.getcwd()
         os.chdir(self.config.git.repoPath)
         
@@ -3190,7 +5691,7 @@ class AccuRev2Git(object):
 
             self.gitRepo.raw_cmd([u'git', u'config', u'--local', u'gc.auto', u'0'])
 
-            if self.config.method in [ "deep-hist", "diff", "pop" ]:
+            if self.config.method in [ "deep-hist", "diff", "pop", "auto" ]:
                 logger.info("Retrieveing stream information from Accurev into hidden refs.")
                 self.RetrieveStreams()
             elif self.config.method in [ "skip" ]:
@@ -3279,6 +5780,23 @@ def DumpExampleConfigFile(outputFilename):
             start-transaction:    The conversion will start at this transaction. If interrupted the next time it starts it will continue from where it stopped.
             end-transaction:      Stop at this transaction. This can be the keword "now" if you want it to convert the repo up to the latest transaction.
             command-cache-filename: The filename which will be given to the accurev.py script to use as a local command result cache for the accurev hist, accurev diff and accurev show streams commands.
+            version-store-filename: Optional. The filename of a local store which maps each element version (eid and real version) to the git blob it was committed as. Element versions
+                                  found in the store are written straight from git during the data retrieval instead of being populated from Accurev again. When all of the
+                                  element versions changed by a transaction are in the store the new tree is built in git and Accurev isn't asked to populate anything.
+            reconstruct-verify-rate: Optional. The fraction, between 0 and 1, of the transactions whose tree could be built from the version store that are populated in full from
+                                  Accurev anyway and compared against the built tree. Defaults to 0.01.
+            pipeline-depth:       Optional. When greater than 0 the stream info and data are retrieved concurrently, with the info allowed to run at most this many transactions ahead of the data. Defaults to 0 (sequential).
+            data-shards:          Optional. When greater than 1 a long backlog of a stream's data is split into this many transaction ranges which are populated concurrently, each in its own
+                                  scratch worktree starting from a full pop, and then stitched back into a single data ref. Defaults to 0 (sequential).
+            diff-probe-threads:   Optional. The number of `accurev diff` commands that the diff and deep-hist methods run concurrently while looking for the next transaction that
+                                  changed a stream. Defaults to 1 (sequential).
+            command-threads:      Optional. When greater than 0 all accurev commands are run through an executor which runs at most this many of them at a time and retries the
+                                  ones that fail because the server is busy or locked, with an increasing delay. Defaults to 0 (commands run directly on the thread that needs them).
+            command-limits:       Optional. A comma separated list of <command>:<limit> pairs which limit how many commands of each type the executor runs at a time (e.g. "diff:4, pop:1").
+                                  Only used when command-threads is greater than 0.
+            prefetch-depth:       Optional. When greater than 0 the streams.xml and hist.xml of up to this many upcoming transactions are read from git and parsed in the background
+                                  while the current transaction is being committed. Defaults to 0 (read when needed). Transactions that are already in the
+                                  transaction journal (.git/ac2git/journal.sqlite3) aren't prefetched since it has their parsed contents.
     -->
     <accurev 
         username="joe_bloggs" 
@@ -3286,7 +5804,15 @@ def DumpExampleConfigFile(outputFilename):
         depot="Trunk" 
         start-transaction="1" 
         end-transaction="now" 
-        command-cache-filename="command_cache.sqlite3" >
+        command-cache-filename="command_cache.sqlite3"
+        version-store-filename="version_store.sqlite3"
+        reconstruct-verify-rate="0.01"
+        pipeline-depth="0"
+        data-shards="0"
+        diff-probe-threads="1"
+        command-threads="0"
+        command-limits="diff:4, pop:1"
+        prefetch-depth="0" >
         <!-- The stream-list is optional. If not given all streams are processed
                 exclude-types:   A comma separated list of stream types that are to be excluded from being automatically added. Doesn't apply to streams that were explicitly specified.
                                  The stream types have to match the stream types returned by Accurev in its command line client's XML output and a special keyword "hidden" for excluding
@@ -3319,6 +5845,14 @@ def DumpExampleConfigFile(outputFilename):
                                         it was before.
             new-basis-is-first-parent: [ "true", "false" ] - If set to true, for a chstream transaction, the new basis transaction will be made the corresponding commit's first parent, while
                                                              the previous transaction made in the stream will be the second parent. If set to false the order of the two parents is reversed.
+            empty-diff-check: [ "auto", "tree", "diff" ] - controls how the contents of two commits are compared when deciding if a promote or an affected child stream should be a merge.
+                              When set to "tree" the tree hashes of the commits are compared. When set to "diff" a `git diff` is run instead, which respects any
+                              diff attributes set in the .git/info/attributes file (e.g. to ignore differences in some files) but is much slower. When set to "auto"
+                              (the default) "diff" is used if the .git/info/attributes file exists and "tree" otherwise.
+            process-threads: Optional. When greater than 0 the "normal" merge strategy processes transactions that can't affect each other's branches on up to this
+                             many threads. Transactions are independent when none of the tracked streams above or below their affected streams share a topmost tracked
+                             ancestor, mkstream and chstream transactions always wait for everything before them. The branches end up the same as when they are
+                             processed one at a time. Defaults to 0 (one at a time).
     -->
     <git 
         repo-path="/put/the/git/repo/here" 
@@ -3327,12 +5861,14 @@ def DumpExampleConfigFile(outputFilename):
         author-is-committer="true" 
         empty-child-stream-action="merge" 
         source-stream-fast-forward="false"
-        new-basis-is-first-parent="true" > 
+        new-basis-is-first-parent="true"
+        empty-diff-check="auto"
+        process-threads="0" > 
         <!-- Optional: You can add remote elements to specify the remotes to which the converted branches will be pushed. The push-url attribute is optional. -->
         <remote name="origin" url="https://github.com/orao/ac2git.git" push-url="https://github.com/orao/ac2git.git" /> 
         <remote name="backup" url="https://github.com/orao/ac2git.git" />
     </git>
-    <method>deep-hist</method> <!-- The method specifies what approach is taken to retrieve information from Accurev. Allowed values are 'deep-hist', 'diff', 'pop' and 'skip'.
+    <method>deep-hist</method> <!-- The method specifies what approach is taken to retrieve information from Accurev. Allowed values are 'deep-hist', 'diff', 'pop', 'auto' and 'skip'.
                                      - deep-hist: Works by using the accurev.ext.deep_hist() function to return a list of transactions that could have affected the stream.
                                                   It then performs a diff between the transactions and only populates the files that have changed like the 'diff' method.
                                                   It is the quickest method but is only as reliable as the information that accurev.ext.deep_hist() provides.
@@ -3342,9 +5878,16 @@ def DumpExampleConfigFile(outputFilename):
                                              and performs the diff again. Otherwise, any files returned by the diff are deleted and an `accurev pop -R` performed which only
                                              downloads the changed files. This is slower than the 'deep-hist' method but faster than the 'pop' method by a large margin.
                                              It's reliability is directly dependent on the reliability of the `accurev diff` command.
+                                             Only the transactions which `accurev hist` shows were made on the stream or its ancestors (and all chstream and revert
+                                             transactions) are diffed one by one, the ones in between are checked with a single diff. A change that is made and then
+                                             reverted in between such transactions, and which the hist classification missed, is therefore not converted.
                                      - pop: This is the naive method which doesn't care about changes and always performs a full deletion of the whole tree and a complete
                                             `accurev pop` command. It is a lot slower than the other methods for streams with a lot of files but should work even with older
                                             accurev releases. This is the method originally implemented by Ryan LaNeve in his https://github.com/rlaneve/accurev2git repo.
+                                     - auto: Picks one of the above methods for each stream and each 5000 transaction part of its range. Servers older than 6.1 always
+                                             use 'pop'. Otherwise the last 100 transactions of the part are sampled with `accurev hist` and 'diff' is used for streams that are busy and whose
+                                             ancestors are all being converted, while 'deep-hist' is used for the rest. The chosen method is recorded in the stream's
+                                             hwm ref so that an interrupted retrieval is resumed with the same method.
                                      - skip: This will skip the querying of the Accurev server for information about the streams. It makes sense in an already converted repo
                                              for which you only want to reprocess the already retrieved information without getting anything new.
                                -->
@@ -3446,6 +5989,23 @@ def AutoConfigFile(filename, args, preserveConfig=False):
             start-transaction:    The conversion will start at this transaction. If interrupted the next time it starts it will continue from where it stopped.
             end-transaction:      Stop at this transaction. This can be the keword "now" if you want it to convert the repo up to the latest transaction.
             command-cache-filename: The filename which will be given to the accurev.py script to use as a local command result cache for the accurev hist, accurev diff and accurev show streams commands.
+            version-store-filename: Optional. The filename of a local store which maps each element version (eid and real version) to the git blob it was committed as. Element versions
+                                  found in the store are written straight from git during the data retrieval instead of being populated from Accurev again. When all of the
+                                  element versions changed by a transaction are in the store the new tree is built in git and Accurev isn't asked to populate anything.
+            reconstruct-verify-rate: Optional. The fraction, between 0 and 1, of the transactions whose tree could be built from the version store that are populated in full from
+                                  Accurev anyway and compared against the built tree. Defaults to 0.01.
+            pipeline-depth:       Optional. When greater than 0 the stream info and data are retrieved concurrently, with the info allowed to run at most this many transactions ahead of the data. Defaults to 0 (sequential).
+            data-shards:          Optional. When greater than 1 a long backlog of a stream's data is split into this many transaction ranges which are populated concurrently, each in its own
+                                  scratch worktree starting from a full pop, and then stitched back into a single data ref. Defaults to 0 (sequential).
+            diff-probe-threads:   Optional. The number of `accurev diff` commands that the diff and deep-hist methods run concurrently while looking for the next transaction that
+                                  changed a stream. Defaults to 1 (sequential).
+            command-threads:      Optional. When greater than 0 all accurev commands are run through an executor which runs at most this many of them at a time and retries the
+                                  ones that fail because the server is busy or locked, with an increasing delay. Defaults to 0 (commands run directly on the thread that needs them).
+            command-limits:       Optional. A comma separated list of <command>:<limit> pairs which limit how many commands of each type the executor runs at a time (e.g. "diff:4, pop:1").
+                                  Only used when command-threads is greater than 0.
+            prefetch-depth:       Optional. When greater than 0 the streams.xml and hist.xml of up to this many upcoming transactions are read from git and parsed in the background
+                                  while the current transaction is being committed. Defaults to 0 (read when needed). Transactions that are already in the
+                                  transaction journal (.git/ac2git/journal.sqlite3) aren't prefetched since it has their parsed contents.
     -->
     <accurev 
         username="{accurev_username}" 
@@ -3453,7 +6013,15 @@ def AutoConfigFile(filename, args, preserveConfig=False):
         depot="{accurev_depot}" 
         start-transaction="{start_transaction}" 
         end-transaction="{end_transaction}" 
-        command-cache-filename="command_cache.sqlite3" >
+        command-cache-filename="command_cache.sqlite3"
+        version-store-filename="version_store.sqlite3"
+        reconstruct-verify-rate="0.01"
+        pipeline-depth="0"
+        data-shards="0"
+        diff-probe-threads="1"
+        command-threads="0"
+        command-limits="diff:4, pop:1"
+        prefetch-depth="0" >
         <!-- The stream-list is optional. If not given all streams are processed
                 exclude-types:   A comma separated list of stream types that are to be excluded from being automatically added. Doesn't apply to streams that were explicitly specified.
                                  The stream types have to match the stream types returned by Accurev in its command line client's XML output and a special keyword "hidden" for excluding
@@ -3503,6 +6071,14 @@ def AutoConfigFile(filename, args, preserveConfig=False):
                                         it was before.
             new-basis-is-first-parent: [ "true", "false" ] - If set to true, for a chstream transaction, the new basis transaction will be made the corresponding commit's first parent, while
                                                              the previous transaction made in the stream will be the second parent. If set to false the order of the two parents is reversed.
+            empty-diff-check: [ "auto", "tree", "diff" ] - controls how the contents of two commits are compared when deciding if a promote or an affected child stream should be a merge.
+                              When set to "tree" the tree hashes of the commits are compared. When set to "diff" a `git diff` is run instead, which respects any
+                              diff attributes set in the .git/info/attributes file (e.g. to ignore differences in some files) but is much slower. When set to "auto"
+                              (the default) "diff" is used if the .git/info/attributes file exists and "tree" otherwise.
+            process-threads: Optional. When greater than 0 the "normal" merge strategy processes transactions that can't affect each other's branches on up to this
+                             many threads. Transactions are independent when none of the tracked streams above or below their affected streams share a topmost tracked
+                             ancestor, mkstream and chstream transactions always wait for everything before them. The branches end up the same as when they are
+                             processed one at a time. Defaults to 0 (one at a time).
     -->
     <git 
         repo-path="{git_repo_path}" 
@@ -3511,13 +6087,17 @@ def AutoConfigFile(filename, args, preserveConfig=False):
         author-is-committer="{author_is_committer}"
         empty-child-stream-action="{empty_child_stream_action}" 
         source-stream-fast-forward="{source_stream_fast_forward}"
-        new-basis-is-first-parent="{new_basis_is_first_parent}" >""".format(git_repo_path=config.git.repoPath,
+        new-basis-is-first-parent="{new_basis_is_first_parent}"
+        empty-diff-check="{empty_diff_check}"
+        process-threads="{process_threads}" >""".format(git_repo_path=config.git.repoPath,
                                                                             message_style=config.git.messageStyle if config.git.messageStyle is not None else 'notes',
                                                                             message_key=config.git.messageKey if config.git.messageKey is not None else 'footer',
                                                                             author_is_committer="true" if config.git.authorIsCommitter else "false",
                                                                             empty_child_stream_action=config.git.emptyChildStreamAction,
                                                                             source_stream_fast_forward="true" if config.git.sourceStreamFastForward else "false",
-                                                                            new_basis_is_first_parent="true" if config.git.newBasisIsFirstParent else "false"))
+                                                                            new_basis_is_first_parent="true" if config.git.newBasisIsFirstParent else "false",
+                                                                            empty_diff_check=config.git.emptyDiffCheck,
+                                                                            process_threads=config.git.processThreads))
         if config.git.remoteMap is not None:
             for remoteName in remoteMap:
                 remote = remoteMap[remoteName]
@@ -3715,6 +6295,8 @@ def PrintConfigSummary(config, filename):
         logger.info('    empty child stream action: {0}'.format(config.git.emptyChildStreamAction))
         logger.info('    source stream fast forward: {0}'.format(config.git.sourceStreamFastForward))
         logger.info('    new basis is first parent: {0}'.format(config.git.newBasisIsFirstParent))
+        logger.info('    empty diff check: {0}'.format(config.git.emptyDiffCheck))
+        logger.info('    process threads: {0}'.format(config.git.processThreads))
         if config.git.remoteMap is not None:
             for remoteName in config.git.remoteMap:
                 remote = config.git.remoteMap[remoteName]
@@ -3732,6 +6314,14 @@ def PrintConfigSummary(config, filename):
         logger.info('    end tran.:   #{0}'.format(config.accurev.endTransaction))
         logger.info('    username: {0}'.format(config.accurev.username))
         logger.info('    command cache: {0}'.format(config.accurev.commandCacheFilename))
+        logger.info('    version store: {0}'.format(config.accurev.versionStoreFilename))
+        logger.info('    reconstruct verify rate: {0}'.format(config.accurev.reconstructVerifyRate))
+        logger.info('    pipeline depth: {0}'.format(config.accurev.pipelineDepth))
+        logger.info('    data shards: {0}'.format(config.accurev.dataShards))
+        logger.info('    diff probe threads: {0}'.format(config.accurev.diffProbeThreads))
+        logger.info('    command threads: {0}'.format(config.accurev.commandThreads))
+        logger.info('    command limits: {0}'.format(config.accurev.commandLimits))
+        logger.info('    prefetch depth: {0}'.format(config.accurev.prefetchDepth))
         logger.info('    ignored transaction types (hard-coded): {0}'.format(", ".join(ignored_transaction_types)))
         if config.accurev.excludeStreamTypes is not None:
             logger.info('    excluded stream types: {0}'.format(", ".join(config.accurev.excludeStreamTypes)))
@@ -3771,7 +6361,7 @@ def AccuRev2GitMain(argv):
     parser.add_argument('-p', '--accurev-password',  dest='accurevPassword', metavar='<accurev-password>',  help="The password for the provided accurev username.")
     parser.add_argument('-d', '--accurev-depot', dest='accurevDepot',        metavar='<accurev-depot>',     help="The AccuRev depot in which the streams that are being converted are located. This script currently assumes only one depot is being converted at a time.")
     parser.add_argument('-g', '--git-repo-path', dest='gitRepoPath',         metavar='<git-repo-path>',     help="The system path to an existing folder where the git repository will be created.")
-    parser.add_argument('-M', '--method', dest='conversionMethod', choices=['skip', 'pop', 'diff', 'deep-hist'], metavar='<conversion-method>', help="Specifies the method which is used to perform the conversion. Can be either 'pop', 'diff' or 'deep-hist'. 'pop' specifies that every transaction is populated in full. 'diff' specifies that only the differences are populated but transactions are iterated one at a time. 'deep-hist' specifies that only the differences are populated and that only transactions that could have affected this stream are iterated.")
+    parser.add_argument('-M', '--method', dest='conversionMethod', choices=['skip', 'pop', 'diff', 'deep-hist', 'auto'], metavar='<conversion-method>', help="Specifies the method which is used to perform the conversion. Can be either 'pop', 'diff', 'deep-hist' or 'auto'. 'pop' specifies that every transaction is populated in full. 'diff' specifies that only the differences are populated and that transactions are iterated one at a time, except that the ones which couldn't have affected the stream, according to `accurev hist`, are diffed together (a change that is reverted within such a run of transactions is not converted). 'deep-hist' specifies that only the differences are populated and that only transactions that could have affected this stream are iterated. 'auto' picks one of the other methods for each stream, and each part of its transaction range, based on a sample of its history and the accurev server version.")
     parser.add_argument('-S', '--merge-strategy', dest='mergeStrategy', choices=['skip', 'normal', 'orphanage'], metavar='<merge-strategy>', help="Sets the merge strategy which dictates how the git repository branches are generated. Depending on the value chosen the branches can be orphan branches ('orphanage' strategy) or have merges where promotes have occurred with the 'normal' strategy. The 'skip' strategy forces the script to skip making the git branches and will cause it to only do the retrieving of information from accurev for use with some strategy at a later date.")
     parser.add_argument('-E', '--empty-child-stream-action', dest='emptyChildStreamAction', choices=['merge', 'cherry-pick'], metavar='<empty-child-stream-action>', help="When a promote to a parent stream affects the child stream and the result of the two commits on the two branches in git results in a git diff operation returning empty then it could be said that this was in-fact a merge (of sorts). This option controlls whether such situations are treated as cherry-picks or merges in git.")
     parser.add_argument('-K', '--source-stream-fast-forward', dest='sourceStreamFastForward', choices=['true', 'false'], metavar='<source-stream-fast-forward>', help="When both the source and destination streams are known this flag controlls whether the source branch is moved to the resulting merge commit (the destination branch is always updated/moved to this commit). This has an effect of making the history look like the letter K where the promotes come in and then branch from the merge commit instead of the previous commit which occured on the branch.")
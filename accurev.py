@@ -15,6 +15,11 @@ import xml.etree.ElementTree as ElementTree
 import datetime
 import re
 import sqlite3
+import bisect
+import concurrent.futures
+import threading
+import time
+import random
 
 # ################################################################################################ #
 # Script Globals                                                                                   #
@@ -645,8 +650,14 @@ class obj:
     
             return str
     
+        # Number of characters of the XML text that are fed to the parser at a time by fromxmlstringheaders().
+        headerParseChunkSize = 1024 * 1024
+
         @classmethod
-        def fromxmlstring(cls, xmlText):
+        def fromxmlstring(cls, xmlText, headerOnly=False):
+            if headerOnly:
+                return cls.fromxmlstringheaders(xmlText)
+
             try:
                 # Load the XML
                 xmlRoot = ElementTree.fromstring(xmlText)
@@ -674,6 +685,54 @@ class obj:
                 # Invalid XML for an AccuRev hist command response.
                 return None
 
+        # Parses only the transaction headers (id, type, time, user, comment, streams) out of the `accurev hist` XML output. The XML is parsed
+        # incrementally and every transaction is converted and dropped as soon as it is complete, while its version and move subtrees are discarded
+        # as they are parsed instead of being kept in memory. Only the first version of each transaction is kept since Transaction.affectedStream()
+        # needs it for pre 6.1 transactions, which don't have the streamName attribute.
+        @classmethod
+        def fromxmlstringheaders(cls, xmlText):
+            if xmlText is None:
+                return None
+
+            parser = ElementTree.XMLPullParser(events=('start', 'end'))
+            elementStack = []
+            xmlRoot = None
+            transactions = []
+            streams = []
+            try:
+                for i in range(0, len(xmlText), obj.History.headerParseChunkSize):
+                    parser.feed(xmlText[i:i + obj.History.headerParseChunkSize])
+                    for event, element in parser.read_events():
+                        if event == 'start':
+                            if xmlRoot is None:
+                                if element.tag != "AcResponse" or element.get("Command") != "hist":
+                                    # Invalid XML for an AccuRev hist command response.
+                                    return None
+                                xmlRoot = element
+                            elementStack.append(element)
+                            continue
+
+                        elementStack.pop()
+                        if len(elementStack) == 2 and elementStack[1].tag == 'transaction':
+                            transactionElement = elementStack[1]
+                            if element.tag == 'move' or (element.tag == 'version' and transactionElement.find('version') is not element):
+                                transactionElement.remove(element)
+                        elif len(elementStack) == 1:
+                            if element.tag == 'transaction':
+                                transactions.append(obj.Transaction.fromxmlelement(element))
+                            elif element.tag == 'streams':
+                                for streamElement in element:
+                                    streams.append(obj.Stream.fromxmlelement(streamElement))
+                            xmlRoot.remove(element)
+                parser.close()
+            except ElementTree.ParseError:
+                return None
+
+            if xmlRoot is None:
+                return None
+
+            return cls(taskId=xmlRoot.attrib.get('TaskId'), transactions=transactions, streams=streams)
+
         # Returns a list of (streamName, streamNumber) tuples that directly correspond to the
         # destination streams of the transactions. i.e. If there are 5 transactions there would
         # be 5 tuples (even if they are all for the same stream). The 4th tuple is the destination
@@ -1445,9 +1504,9 @@ class obj:
 # The raw class namespaces raw accurev commands that return text output directly from the terminal #
 # ################################################################################################ #
 class raw(object):
-    # The __lastCommand is used to access the return code that the last command had generated in most
-    # cases.
-    _lastCommand = None
+    # The last command that was run on each thread, see _getLastCommand(), is used to access the return code that the last command had
+    # generated in most cases. It is kept per thread since the commands can be run concurrently, see ext.enable_command_executor().
+    _lastCommandLocal = threading.local()
     _accurevCmd = "accurev"
     _commandCacheFilename = None
 
@@ -1511,20 +1570,101 @@ CREATE TABLE IF NOT EXISTS command_cache (
             self.Remove(cmd)
             self.Add(cmd=cmd, result=result, stdout=stdout, stderr=stderr)
  
+    # Runs accurev commands on a bounded pool of threads and returns futures for their results. At most \a maxWorkers commands run at any one
+    # time and, if given, at most commandLimits[<command>] commands of each type (e.g. { "diff": 4, "pop": 1 }). At most \a maxPending commands
+    # can be queued, further submissions block until one of them completes. The read-only retryableCommands that fail with one of the
+    # retryErrorPatterns (the server is busy or timed out) are retried up to maxRetries times with a jittered exponential backoff before their
+    # failure is returned. Other commands may have partly taken effect when they time out so their failure is returned as is.
+    # The command cache is consulted before a command is queued so cache hits complete immediately.
+    class CommandExecutor(object):
+        retryableCommands = [ 'hist', 'diff', 'show', 'stat', 'cat', 'info', 'anc', 'pop' ]
+        retryErrorPatterns = [ re.compile(r'\bbusy\b', re.IGNORECASE), re.compile(r'\btry again\b', re.IGNORECASE), re.compile(r'\btoo many\b', re.IGNORECASE), re.compile(r'\btimed? ?out\b', re.IGNORECASE) ]
+        maxRetries = 5
+        backoffSeconds = 1.0
+        maxBackoffSeconds = 30.0
+
+        def __init__(self, maxWorkers=4, commandLimits=None, maxPending=None):
+            self.maxWorkers = max(1, int(maxWorkers))
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.maxWorkers)
+            self.pending = threading.BoundedSemaphore(maxPending if maxPending is not None else self.maxWorkers * 4)
+            self.commandLimits = {}
+            if commandLimits is not None:
+                for command in commandLimits:
+                    self.commandLimits[command] = threading.BoundedSemaphore(max(1, int(commandLimits[command])))
+
+        def shutdown(self, wait=True):
+            self.executor.shutdown(wait=wait)
+
+        # Returns a concurrent.futures.Future whose result is the (output, error, subprocess.Popen) tuple of the command. On a cache hit the error and
+        # Popen object are None.
+        def submit(self, cmd, outputFilename=None, useCache=False):
+            output = raw._getCachedCommandOutput(cmd, outputFilename=outputFilename, useCache=useCache)
+            if output is not None:
+                future = concurrent.futures.Future()
+                future.set_result( (output, None, None) )
+                return future
+
+            self.pending.acquire()
+            try:
+                future = self.executor.submit(self._run, cmd, outputFilename, useCache)
+            except:
+                self.pending.release()
+                raise
+            future.add_done_callback(lambda f: self.pending.release())
+            return future
+
+        def _run(self, cmd, outputFilename, useCache):
+            limit = self.commandLimits.get(cmd[1]) if len(cmd) > 1 else None
+            if limit is not None:
+                limit.acquire()
+            try:
+                for attempt in range(0, raw.CommandExecutor.maxRetries + 1):
+                    output, error, accurevCommand = raw._executeCommand(cmd, outputFilename=outputFilename)
+                    if accurevCommand.returncode == 0 or attempt == raw.CommandExecutor.maxRetries or not self.isRetryable(cmd, error):
+                        break
+                    # Up to 50% of jitter either way so that the commands which failed together don't all retry together.
+                    time.sleep(min(raw.CommandExecutor.maxBackoffSeconds, raw.CommandExecutor.backoffSeconds * (2 ** attempt)) * random.uniform(0.5, 1.5))
+            finally:
+                if limit is not None:
+                    limit.release()
+
+            raw._addCachedCommandOutput(cmd, accurevCommand=accurevCommand, output=output, error=error, outputFilename=outputFilename, useCache=useCache)
+            return (output, error, accurevCommand)
+
+        def isRetryable(self, cmd, error):
+            if len(cmd) < 2 or cmd[1] not in raw.CommandExecutor.retryableCommands:
+                return False
+            if error is not None:
+                for pattern in raw.CommandExecutor.retryErrorPatterns:
+                    if pattern.search(error) is not None:
+                        return True
+            return False
+
+    _commandExecutor = None
+
+    # Returns the cached output of the command or None if it isn't cached or the cache can't be used.
     @staticmethod
-    def _runCommand(cmd, outputFilename=None, useCache=False):
-        outputFile = None
-        
-        # Try and see if we are able to use the command cache.
+    def _getCachedCommandOutput(cmd, outputFilename=None, useCache=False):
         if outputFilename is None and raw._commandCacheFilename is not None and useCache:
             with raw.CommandCache(raw._commandCacheFilename) as cc:
                 row = cc.Get(cmd=cmd)
                 if row is not None:
                     # Cache hit!
                     cmd, returncode, output, error = row
-                    raw._lastCommand = None
                     return output
+        return None
 
+    @staticmethod
+    def _addCachedCommandOutput(cmd, accurevCommand, output, error, outputFilename=None, useCache=False):
+        if raw._commandCacheFilename is not None and useCache:
+            with raw.CommandCache(raw._commandCacheFilename) as cc:
+               cc.Add(cmd=cmd, result=accurevCommand.returncode, stdout=output, stderr=error)
+
+    # Runs the command and returns the (output, error, subprocess.Popen) tuple. When \a outputFilename is given the output is written to that file
+    # and the returned output is a message saying so.
+    @staticmethod
+    def _executeCommand(cmd, outputFilename=None):
+        outputFile = None
         if outputFilename is not None:
             outputFile = open(outputFilename, "w")
             accurevCommand = subprocess.Popen(cmd, stdout=outputFile, stdin=subprocess.PIPE, universal_newlines=False)
@@ -1536,22 +1676,57 @@ CREATE TABLE IF NOT EXISTS command_cache (
         accurevCommand.poll()
         while accurevCommand.returncode is None:
             stdoutdata, stderrdata = accurevCommand.communicate()
-            error += stderrdata.decode('utf8', 'strict')
+            if stderrdata is not None:
+                error += stderrdata.decode('utf8', 'strict')
             if outputFile is None:
                 output += stdoutdata.decode('utf8', 'strict')
             accurevCommand.poll()
-        
-        raw._lastCommand = accurevCommand
 
-        if raw._commandCacheFilename is not None and useCache:
-            with raw.CommandCache(raw._commandCacheFilename) as cc:
-               cc.Add(cmd=cmd, result=accurevCommand.returncode, stdout=output, stderr=error)
-        
-        if outputFile is None:
-            return output
-        else:
+        if outputFile is not None:
             outputFile.close()
-            return 'Written to ' + outputFilename
+            output = 'Written to ' + outputFilename
+
+        return output, error, accurevCommand
+
+    # Submits the command to the command executor, see ext.enable_command_executor(), and returns a concurrent.futures.Future whose result is the
+    # (output, error, subprocess.Popen) tuple. If the executor isn't enabled the command is run on the calling thread and a completed future is returned.
+    @staticmethod
+    def _submitCommand(cmd, outputFilename=None, useCache=False):
+        executor = raw._commandExecutor
+        if executor is not None:
+            return executor.submit(cmd, outputFilename=outputFilename, useCache=useCache)
+
+        future = concurrent.futures.Future()
+        output = raw._getCachedCommandOutput(cmd, outputFilename=outputFilename, useCache=useCache)
+        if output is not None:
+            future.set_result( (output, None, None) )
+        else:
+            output, error, accurevCommand = raw._executeCommand(cmd, outputFilename=outputFilename)
+            raw._addCachedCommandOutput(cmd, accurevCommand=accurevCommand, output=output, error=error, outputFilename=outputFilename, useCache=useCache)
+            future.set_result( (output, error, accurevCommand) )
+        return future
+
+    # Records the subprocess.Popen object and the stderr output of the last command that was run on this thread. Both are None for cache hits.
+    @staticmethod
+    def _setLastCommand(accurevCommand, error=None):
+        raw._lastCommandLocal.command = accurevCommand
+        raw._lastCommandLocal.error = error
+
+    # Returns the subprocess.Popen object of the last command that was run on this thread or None.
+    @staticmethod
+    def _getLastCommand():
+        return getattr(raw._lastCommandLocal, 'command', None)
+
+    # Returns the stderr output of the last command that was run on this thread or None.
+    @staticmethod
+    def _getLastError():
+        return getattr(raw._lastCommandLocal, 'error', None)
+
+    @staticmethod
+    def _runCommand(cmd, outputFilename=None, useCache=False):
+        output, error, accurevCommand = raw._submitCommand(cmd, outputFilename=outputFilename, useCache=useCache).result()
+        raw._setLastCommand(accurevCommand, error)
+        return output
 
     @staticmethod
     def getAcSync():
@@ -1587,7 +1762,7 @@ CREATE TABLE IF NOT EXISTS command_cache (
                     error  += stderrdata
                 accurevCommand.poll()
             
-            raw._lastCommand = accurevCommand
+            raw._setLastCommand(accurevCommand, error)
             
             return obj.Login(errorMessage=error)
         
@@ -1598,7 +1773,7 @@ CREATE TABLE IF NOT EXISTS command_cache (
         accurevCommand = subprocess.Popen([ "accurev", "logout" ], universal_newlines=True)
         accurevCommand.wait()
         
-        raw._lastCommand = accurevCommand
+        raw._setLastCommand(accurevCommand)
         
         return (accurevCommand.returncode == 0)
 
@@ -2173,7 +2348,7 @@ def stat(all=False, inBackingStream=False, dispBackingChain=False, defaultGroupO
         , underlapedElementsOnly=underlapedElementsOnly, pendingElementsOnly=pendingElementsOnly, dontOptimizeSearch=dontOptimizeSearch
         , directoryTreePath=directoryTreePath, stream=stream, externalOnly=externalOnly, showExcluded=showExcluded
         , timeSpec=timeSpec, ignorePatternsList=ignorePatternsList, listFile=listFile, elementList=elementList, outputFilename=outputFilename)
-    if raw._lastCommand.returncode == 0:
+    if raw._getLastCommand().returncode == 0:
         return obj.Stat.fromxmlstring(outputXml)
     else:
         return None
@@ -2182,12 +2357,14 @@ def stat(all=False, inBackingStream=False, dispBackingChain=False, defaultGroupO
 def hist( depot=None, stream=None, timeSpec=None, listFile=None, isListFileXml=False, elementList=None
         , allElementsFlag=False, elementId=None, transactionKind=None, commentString=None, username=None
         , expandedMode=True, showIssues=False, verboseMode=False, listMode=False, showStatus=False, transactionMode=False
-        , outputFilename=None, useCache=False):
+        , outputFilename=None, useCache=False, headerOnly=False):
     xmlOutput = raw.hist(depot=depot, stream=stream, timeSpec=timeSpec, listFile=listFile, isListFileXml=isListFileXml, elementList=elementList
         , allElementsFlag=allElementsFlag, elementId=elementId, transactionKind=transactionKind, commentString=commentString, username=username
         , expandedMode=expandedMode, showIssues=showIssues, verboseMode=verboseMode, listMode=listMode, showStatus=showStatus, transactionMode=transactionMode
         , isXmlOutput=True, outputFilename=outputFilename, useCache=useCache)
-    return obj.History.fromxmlstring(xmlOutput)
+    history = obj.History.fromxmlstring(xmlOutput, headerOnly=headerOnly)
+    ext.index_transactions(depot=depot, history=history)
+    return history
 
 # AccuRev diff command
 def diff(verSpec1=None, verSpec2=None, transactionRange=None, toBacking=False, toOtherBasisVersion=False, toPrevious=False
@@ -2208,22 +2385,22 @@ def pop(isRecursive=False, isOverride=False, verSpec=None, location=None, dontBu
 # AccuRev checkout command
 def co(comment=None, selectAllModified=False, verSpec=None, isRecursive=False, transactionNumber=None, elementId=None, listFile=None, elementList=None):
     output = raw.oo(comment=comment, selectAllModified=selectAllModified, verSpec=verSpec, isRecursive=isRecursive, transactionNumber=transactionNumber, elementId=elementId, listFile=listFile, elementList=elementList)
-    if raw._lastCommand is not None:
-        return (raw._lastCommand.returncode == 0)
+    if raw._getLastCommand() is not None:
+        return (raw._getLastCommand().returncode == 0)
     return None
 
 def cat(elementId=None, element=None, depotName=None, verSpec=None, outputFilename=None, useCache=False):
     if useCache:
         useCache = useCache and outputFilename is None
     output = raw.cat(elementId=elementId, element=element, depotName=depotName, verSpec=verSpec, outputFilename=outputFilename, useCache=useCache)
-    if raw._lastCommand is not None:
+    if raw._getLastCommand() is not None:
         return output
     return None
 
 def purge(comment=None, stream=None, issueNumber=None, elementList=None, listFile=None, elementId=None):
     output = raw.purge(comment=comment, stream=stream, issueNumber=issueNumber, elementList=elementList, listFile=listFile, elementId=elementId)
-    if raw._lastCommand is not None:
-        return (raw._lastCommand.returncode == 0)
+    if raw._getLastCommand() is not None:
+        return (raw._getLastCommand().returncode == 0)
     return None
 
 # AccuRev ancestor command
@@ -2233,14 +2410,14 @@ def anc(element, commonAncestor=False, versionId=None, basisVersion=False, commo
     
 def chstream(stream, newBackingStream=None, timeSpec=None, newName=None):
     raw.chstream(stream=stream, newBackingStream=newBackingStream, timeSpec=timeSpec, newName=newName)
-    if raw._lastCommand is not None:
-        return (raw._lastCommand.returncode == 0)
+    if raw._getLastCommand() is not None:
+        return (raw._getLastCommand().returncode == 0)
     return None
     
 def chws(workspace, newBackingStream=None, newLocation=None, newMachine=None, kind=None, eolType=None, isMyWorkspace=True, newName=None):
     raw.chws(workspace=workspace, newBackingStream=newBackingStream, newLocation=newLocation, newMachine=newMachine, kind=kind, eolType=eolType, isMyWorkspace=isMyWorkspace, newName=newName)
-    if raw._lastCommand is not None:
-        return (raw._lastCommand.returncode == 0)
+    if raw._getLastCommand() is not None:
+        return (raw._getLastCommand().returncode == 0)
     return None
         
 def update(refTree=None, doPreview=False, transactionNumber=None, mergeOnUpdate=False, isOverride=False, outputFilename=None):
@@ -2296,8 +2473,8 @@ class replica(object):
     @staticmethod
     def sync():
         raw.replica.sync()
-        if raw._lastCommand is not None:
-            return (raw._lastCommand.returncode == 0)
+        if raw._getLastCommand() is not None:
+            return (raw._getLastCommand().returncode == 0)
         return None
         
 # ################################################################################################ #
@@ -2318,7 +2495,115 @@ class ext(object):
     def disable_command_cache():
         raw._commandCacheFilename = None
 
+    # Routes all accurev commands through a raw.CommandExecutor which runs at most \a maxWorkers of them concurrently, and at most
+    # commandLimits[<command>] of each type, and retries the ones which fail because the server is busy.
+    @staticmethod
+    def enable_command_executor(maxWorkers, commandLimits=None):
+        ext.disable_command_executor()
+        raw._commandExecutor = raw.CommandExecutor(maxWorkers=maxWorkers, commandLimits=commandLimits)
+
+    @staticmethod
+    def disable_command_executor():
+        if raw._commandExecutor is not None:
+            raw._commandExecutor.shutdown(wait=True)
+            raw._commandExecutor = None
+
+    # A depot level index of the transaction times which is built from the history that is retrieved with the hist() function. It is used to
+    # find the transaction that was current at a given time without querying accurev. While transaction times increase with transaction numbers
+    # the transaction current at time t is known once transaction n, with time <= t, and transaction n + 1, with time > t, have both been seen.
+    # Transaction times aren't guaranteed to increase though (e.g. the server clock was changed) and once a transaction that is older than an
+    # earlier transaction is seen the index can't tell which one is current so it stops answering and the caller queries accurev instead.
+    # The history is retrieved on several threads so the index is only used under its lock, find() sorts it in place.
+    class TransactionTimeIndex(object):
+        def __init__(self):
+            self.times = {}        # transaction number -> timestamp
+            self.sortedTimes = []  # sorted list of (timestamp, transaction number) tuples
+            self.isSorted = True
+            self.isMonotonic = True
+            self.lock = threading.Lock()
+
+        def add(self, transactionId, time):
+            with self.lock:
+                if transactionId not in self.times:
+                    timestamp = GetTimestamp(time)
+                    self.times[transactionId] = timestamp
+                    self.sortedTimes.append( (timestamp, transactionId) )
+                    self.isSorted = False
+
+        # Returns the number of the last transaction whose time is less than or equal to the \a time or None if it isn't known. If \a highestId
+        # is given it is taken to be the last transaction in the depot.
+        def find(self, time, highestId=None):
+            with self.lock:
+                return self._find(time=time, highestId=highestId)
+
+        def _find(self, time, highestId):
+            if not self.isMonotonic:
+                return None
+            if not self.isSorted:
+                self.sortedTimes.sort() # The history is added in sorted runs which timsort merges quickly.
+                self.isSorted = True
+                # When sorted by time the transaction numbers must be sorted as well, otherwise the transaction times have an inversion.
+                for i in range(1, len(self.sortedTimes)):
+                    if self.sortedTimes[i - 1][1] > self.sortedTimes[i][1]:
+                        self.isMonotonic = False
+                        return None
+            timestamp = GetTimestamp(time)
+            i = bisect.bisect_right(self.sortedTimes, (timestamp, float('inf')))
+            if i == 0:
+                return None
+            transactionId = self.sortedTimes[i - 1][1]
+            nextTimestamp = self.times.get(transactionId + 1)
+            if (nextTimestamp is not None and nextTimestamp > timestamp) or (highestId is not None and transactionId == highestId):
+                return transactionId
+            return None
+
+    # The resolved time-spec keywords and times, keyed by (depot, keyword/time), and the transaction time indices keyed by depot. The keywords
+    # highest and now are only resolved once per run, or until reset_timespec_index() is called, so that a run sees a consistent depot.
+    # Both are only used under the _timeSpecLock.
+    _resolvedTimeSpecParts = {}
+    _transactionTimeIndices = {}
+    _timeSpecLock = threading.Lock()
+
+    @staticmethod
+    def reset_timespec_index():
+        with ext._timeSpecLock:
+            ext._resolvedTimeSpecParts = {}
+            ext._transactionTimeIndices = {}
+
+    # Adds the transactions in the obj.History \a history to the transaction time index of the \a depot.
+    @staticmethod
+    def index_transactions(depot, history):
+        if depot is None or history is None or history.transactions is None:
+            return
+        with ext._timeSpecLock:
+            index = ext._transactionTimeIndices.get(depot)
+            if index is None:
+                index = ext._transactionTimeIndices[depot] = ext.TransactionTimeIndex()
+        for tr in history.transactions:
+            if tr is not None and tr.id is not None and tr.time is not None:
+                index.add(tr.id, tr.time)
 
+    # Converts a single time-spec part, which is either a keyword (highest or now) or a datetime, into a transaction number for the \a depot.
+    # Transaction numbers are returned as is. The keywords are resolved once per run and datetimes are looked up in the transaction time index
+    # before falling back to querying accurev.
+    @staticmethod
+    def resolve_timespec_part(depot, timeSpecPart):
+        if timeSpecPart is None or isinstance(timeSpecPart, int):
+            return timeSpecPart
+
+        key = (depot, timeSpecPart)
+        with ext._timeSpecLock:
+            transactionId = ext._resolvedTimeSpecParts.get(key)
+            index = ext._transactionTimeIndices.get(depot)
+            highestId = ext._resolvedTimeSpecParts.get((depot, 'highest'))
+        if transactionId is None and isinstance(timeSpecPart, datetime.datetime) and index is not None:
+            transactionId = index.find(timeSpecPart, highestId=highestId)
+        if transactionId is None:
+            transactionId = hist(depot=depot, timeSpec=timeSpecPart, useCache=False, headerOnly=True).transactions[0].id
+        with ext._timeSpecLock:
+            # If another thread resolved it first keep its answer so that the keywords stay consistent for the rest of the run.
+            transactionId = ext._resolvedTimeSpecParts.setdefault(key, transactionId)
+        return transactionId
 
     # Get the mkstream transaction for the stream. This can sometimes be a non-trivial operation depending on how old the depot is (version of accurev).
     @staticmethod
@@ -2337,12 +2622,12 @@ class ext(object):
             #   - The depot name matches the root stream name
             #   - The root stream number is always 1.
             #   - There is no mkstream transaction for the root stream.
-            firstTr = hist(depot=depot, timeSpec="1", useCache=useCache)
+            firstTr = hist(depot=depot, timeSpec="1", useCache=useCache, headerOnly=True)
             if firstTr is None or len(firstTr.transactions) == 0:
                 raise Exception("Error: assumption that the root stream has the same name as the depot doesn't hold. Aborting...")
             mkstreamTr = firstTr.transactions[0]
         else:
-            mkstream = hist(stream=stream, transactionKind="mkstream", timeSpec="highest", useCache=useCache)
+            mkstream = hist(stream=stream, transactionKind="mkstream", timeSpec="highest", useCache=useCache, headerOnly=True)
             if mkstream is None or len(mkstream.transactions) == 0:
                 # Warning: if you are unlucky enough to hit this path, it is really, really slow... Probably can be optimized but doesn't happen often enough for me to do it.
 
@@ -2358,7 +2643,7 @@ class ext(object):
                 # transaction corresponds to this stream.
 
                 # Get the stream's information just before the first chstream transaction for this stream, which will by assumption have the `startTime` for the mkstream transaction.
-                chstreams = hist(depot=depot, timeSpec="highest-1", stream=streamInfo.name, transactionKind="chstream", useCache=useCache) # chstreams are rare so this should be quicker than looking for everything.
+                chstreams = hist(depot=depot, timeSpec="highest-1", stream=streamInfo.name, transactionKind="chstream", useCache=useCache, headerOnly=True) # chstreams are rare so this should be quicker than looking for everything.
                 mkstreamsTimeSpecStr = "highest-1"
                 if chstreams is not None and len(chstreams.transactions) > 0:
                     firstChstreamTr = chstreams.transactions[-1]
@@ -2367,7 +2652,7 @@ class ext(object):
                     mkstreamsTimeSpecStr = "{trId}-1".format(trId=firstChstreamTr.id - 1)
 
                 # Get all the mkstream transactions before the first transaction on this stream.
-                mkstreams = hist(depot=depot, timeSpec=mkstreamsTimeSpecStr, transactionKind="mkstream", useCache=useCache)
+                mkstreams = hist(depot=depot, timeSpec=mkstreamsTimeSpecStr, transactionKind="mkstream", useCache=useCache, headerOnly=True)
 
                 mkstreamTrList = []
                 for t in mkstreams.transactions:
@@ -2405,12 +2690,12 @@ class ext(object):
         # Streams and workspaces created after installing 4.7.2 will display this additional stream information 
         # as part of the hist command.
         timeSpec = '{0}-1.1'.format(transaction)
-        history = hist(stream=stream, timeSpec=timeSpec, transactionKind='chstream', useCache=useCache)
+        history = hist(stream=stream, timeSpec=timeSpec, transactionKind='chstream', useCache=useCache, headerOnly=True)
         
         if history is not None and history.transactions is not None and len(history.transactions) > 0:
             return history.transactions[0]
         
-        history = hist(stream=stream, timeSpec=timeSpec, transactionKind='mkstream', useCache=useCache)
+        history = hist(stream=stream, timeSpec=timeSpec, transactionKind='mkstream', useCache=useCache, headerOnly=True)
 
         if history is not None and history.transactions is not None and len(history.transactions) > 0:
             return history.transactions[0]
@@ -2471,10 +2756,8 @@ class ext(object):
         #   1. Change the accurev keywords (e.g. highest, now) and dates into transaction numbers:
         #      Note: The keywords highest/now are translated w.r.t. the depot and not the stream.
         #            Otherwise we might miss later promotes to parent streams...
-        if not isinstance(ts.start, int) and ts.start is not None:
-            ts.start = hist(depot=depot, timeSpec=ts.start, useCache=False).transactions[0].id
-        if not isinstance(ts.end, int) and ts.end is not None:
-            ts.end = hist(depot=depot, timeSpec=ts.end, useCache=False).transactions[0].id
+        ts.start = ext.resolve_timespec_part(depot=depot, timeSpecPart=ts.start)
+        ts.end = ext.resolve_timespec_part(depot=depot, timeSpecPart=ts.end)
         #   2. If there is a limit set on the number of transactions convert it into a start and end without a limit...
         if ts.start is not None and ts.end is not None and ts.limit is not None:
             if ts.end is None or abs(ts.end - ts.start + 1) > ts.limit:
@@ -2517,11 +2800,11 @@ class ext(object):
                         # Make descending
                         timeSpec = timeSpec.reversed()
                     # Get the transaction number at the given time.
-                    preLockTr = hist(depot=depot, timeSpec=UTCDateTimeOrNone(timelock)).transactions[0]
-                    if timeSpec.start > preLockTr.id + 1:
+                    preLockTrId = ext.resolve_timespec_part(depot=depot, timeSpecPart=UTCDateTimeOrNone(timelock))
+                    if timeSpec.start > preLockTrId + 1:
                         return None
-                    elif timeSpec.end > preLockTr.id:
-                        timeSpec.end = preLockTr.id
+                    elif timeSpec.end > preLockTrId:
+                        timeSpec.end = preLockTrId
 
                     if not isAsc:
                         timeSpec = timeSpec.reversed()
@@ -2536,7 +2819,7 @@ class ext(object):
         # ==================
         if stream is None:
             # When the stream is not specified then we just want all the depot transactions for the given time-spec.
-            return hist(depot=depot, timeSpec=timeSpec, useCache=useCache)
+            return hist(depot=depot, timeSpec=timeSpec, useCache=useCache, headerOnly=True)
 
         if isinstance(timeSpec, obj.TimeSpec):
             ts = timeSpec
@@ -2565,7 +2848,7 @@ class ext(object):
             #   - The depot name matches the root stream name
             #   - The root stream number is always 1.
             #   - There is no mkstream transaction for the root stream.
-            firstTr = hist(depot=depot, timeSpec="1", useCache=useCache)
+            firstTr = hist(depot=depot, timeSpec="1", useCache=useCache, headerOnly=True)
             if firstTr is None or len(firstTr.transactions) == 0:
                 raise Exception("Error: assumption that the root stream has the same name as the depot doesn't hold. Aborting...")
             mkstreamTr = firstTr.transactions[0]
@@ -2605,7 +2888,7 @@ class ext(object):
         trList = []
 
         # Get the history for the requested stream in the requested transaction range _ts_.
-        history = hist(depot=depot, stream=stream, timeSpec=str(ts), useCache=useCache)
+        history = hist(depot=depot, stream=stream, timeSpec=str(ts), useCache=useCache, headerOnly=True)
 
         # This is the core algorithm. Here we look for `chstream` transactions and _timelocks_ which affect
         # the result of a deep history inspection.
@@ -2669,45 +2952,109 @@ class ext(object):
 
         return rv
 
+    # Transaction types that can change the stream structure, after which affected_streams_range() has to get the streams again.
+    streamStructureTransactionTypes = [ "mkstream", "chstream", "mkws", "chws", "mksnap", "defcomp" ]
+
+    # Returns a dictionary where the keys are the stream names and the values are the lists of names of the streams (or workspaces) whose basis
+    # is that stream. The \a streamDict is the dictionary returned by stream_dict().
+    @staticmethod
+    def stream_children_dict(streamDict):
+        childrenDict = {}
+        for name in streamDict:
+            basis = streamDict[name].basis
+            if basis is not None:
+                childrenDict.setdefault(basis, []).append(name)
+        return childrenDict
+
     @staticmethod
     # Returns a list of streams which are affected by the given transaction.
     # The transaction must be of type obj.Transaction which is obtained from the obj.History.transactions
     # which is returned by the hist() function.
-    def affected_streams(depot, transaction, includeWorkspaces=True, ignoreTimelocks=False, doDiffs=False, useCache=False):
+    # If \a doDiffs is set, the diffs of the child streams at each level are run on up to \a maxDiffWorkers threads.
+    def affected_streams(depot, transaction, includeWorkspaces=True, ignoreTimelocks=False, doDiffs=False, useCache=False, maxDiffWorkers=4):
         if not isinstance(transaction, obj.Transaction):
-            transaction = hist(depot=depot, timeSpec=str(transaction), useCache=useCache).transactions[0]
-        
-        rv = None
+            transaction = hist(depot=depot, timeSpec=str(transaction), useCache=useCache, headerOnly=True).transactions[0]
+
+        streamMap = ext.stream_dict(depot=depot, transaction=transaction.id, useCache=useCache)
+        return ext._affected_streams(depot=depot, transaction=transaction, streamMap=streamMap, childrenMap=ext.stream_children_dict(streamMap), includeWorkspaces=includeWorkspaces, ignoreTimelocks=ignoreTimelocks, doDiffs=doDiffs, useCache=useCache, maxDiffWorkers=maxDiffWorkers)
 
+    @staticmethod
+    # Batch version of affected_streams() for all of the transactions in the \a timeSpec range. The history for the range is retrieved with a
+    # single `accurev hist` command and the streams are only retrieved again after transactions that can change the stream structure.
+    # Returns a list of (obj.Transaction, [ obj.Stream ]) tuples in the order in which the hist command returned the transactions.
+    def affected_streams_range(depot, timeSpec, includeWorkspaces=True, ignoreTimelocks=False, doDiffs=False, useCache=False, maxDiffWorkers=4):
+        history = hist(depot=depot, timeSpec=timeSpec, useCache=useCache, headerOnly=True)
+        if history is None or history.transactions is None:
+            return None
+
+        rv = []
+        streamMap, childrenMap = None, None
+        for transaction in sorted(history.transactions, key=lambda tr: tr.id):
+            if streamMap is None or transaction.Type in ext.streamStructureTransactionTypes:
+                streamMap = ext.stream_dict(depot=depot, transaction=transaction.id, useCache=useCache)
+                childrenMap = ext.stream_children_dict(streamMap)
+            rv.append( (transaction, ext._affected_streams(depot=depot, transaction=transaction, streamMap=streamMap, childrenMap=childrenMap, includeWorkspaces=includeWorkspaces, ignoreTimelocks=ignoreTimelocks, doDiffs=doDiffs, useCache=useCache, maxDiffWorkers=maxDiffWorkers)) )
+
+        if len(history.transactions) > 1 and history.transactions[0].id > history.transactions[-1].id:
+            rv.reverse() # Keep the order of the time-spec.
+        return rv
+
+    # Expands the set of affected streams breadth-first from the stream on which the \a transaction was performed, using the \a childrenMap
+    # returned by stream_children_dict() for the \a streamMap.
+    @staticmethod
+    def _affected_streams(depot, transaction, streamMap, childrenMap, includeWorkspaces, ignoreTimelocks, doDiffs, useCache, maxDiffWorkers):
         destStreamNum = transaction.affectedStream()[1]
-        destStream = show.streams(depot=depot, stream=destStreamNum, timeSpec=transaction.id, useCache=useCache).streams[0].name
-
-        if destStream is not None:
-            streamMap = ext.stream_dict(depot=depot, transaction=transaction.id, useCache=useCache)
-
-            childrenSet = set()
-            newChildrenSet = set()
-
-            newChildrenSet.add(destStream)
-            while len(newChildrenSet) > 0:
-                childrenSet |= newChildrenSet
-                newChildrenSet = set()
-
-                for stream in streamMap:
-                    if streamMap[stream].basis in childrenSet and stream not in childrenSet:
-                        if includeWorkspaces or streamMap[stream].Type.lower() != "workspace":
-                            if ignoreTimelocks or streamMap[stream].time is None or streamMap[stream].time >= transaction.time:
-                                if doDiffs and transaction.id > 1:
-                                    diffResult = diff(all=True, informationOnly=True, verSpec1=stream, verSpec2=stream, transactionRange="{0}-{1}".format(transaction.id, transaction.id - 1), useCache=useCache)
-                                    if len(diffResult.elements) != 0:
-                                        newChildrenSet.add(stream)
-                                else:
-                                    newChildrenSet.add(stream)
-            
-            rv = []
-            for stream in childrenSet:
-                rv.append(streamMap[stream])
-            
+        destStream = None
+        if streamMap is not None:
+            for name in streamMap:
+                if streamMap[name].streamNumber == destStreamNum:
+                    destStream = name
+                    break
+        if destStream is None:
+            destStream = show.streams(depot=depot, stream=destStreamNum, timeSpec=transaction.id, useCache=useCache).streams[0].name
+
+        if destStream is None:
+            return None
+
+        def hasDiff(stream):
+            diffResult = diff(all=True, informationOnly=True, verSpec1=stream, verSpec2=stream, transactionRange="{0}-{1}".format(transaction.id, transaction.id - 1), useCache=useCache)
+            return len(diffResult.elements) != 0
+
+        childrenSet = set([ destStream ])
+        level = [ destStream ]
+        executor = None
+        try:
+            while len(level) > 0:
+                candidates = []
+                for basis in level:
+                    for stream in childrenMap.get(basis, []):
+                        if stream not in childrenSet:
+                            if includeWorkspaces or streamMap[stream].Type.lower() != "workspace":
+                                if ignoreTimelocks or streamMap[stream].time is None or streamMap[stream].time >= transaction.time:
+                                    candidates.append(stream)
+
+                if doDiffs and transaction.id > 1 and len(candidates) > 0:
+                    if maxDiffWorkers > 1 and len(candidates) > 1:
+                        if executor is None:
+                            executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxDiffWorkers)
+                        diffResults = list(executor.map(hasDiff, candidates))
+                    else:
+                        diffResults = [ hasDiff(stream) for stream in candidates ]
+                    candidates = [ stream for stream, changed in zip(candidates, diffResults) if changed ]
+
+                level = []
+                for stream in candidates:
+                    if stream not in childrenSet:
+                        childrenSet.add(stream)
+                        level.append(stream)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+        rv = []
+        for stream in childrenSet:
+            rv.append(streamMap[stream])
+
         return rv
 
 # ################################################################################################ #
@@ -2728,7 +3075,20 @@ def clDeepHist(args):
         return 1
 
 def clAffectedStreams(args):
-    streams = ext.affected_streams(depot=args.depot, transaction=args.transaction, includeWorkspaces=args.includeWorkspaces, ignoreTimelocks=args.ignoreTimelocks, doDiffs=args.diffCheck, useCache=(args.cacheFile is not None))
+    ts = obj.TimeSpec.fromstring(args.transaction)
+    if ts is not None and ts.end is not None:
+        # A transaction range was given, print the affected streams for each of its transactions.
+        result = ext.affected_streams_range(depot=args.depot, timeSpec=args.transaction, includeWorkspaces=args.includeWorkspaces, ignoreTimelocks=args.ignoreTimelocks, doDiffs=args.diffCheck, useCache=(args.cacheFile is not None), maxDiffWorkers=args.diffThreads)
+        if result is None or len(result) == 0:
+            print("No transactions")
+            return 1
+        print("transaction; stream name; stream id; stream type;")
+        for tr, streams in result:
+            for s in (streams if streams is not None else []):
+                print("{trId}; {streamName}; {streamId}; {Type};".format(trId=tr.id, streamName=s.name, streamId=s.streamNumber, Type=s.Type))
+        return 0
+
+    streams = ext.affected_streams(depot=args.depot, transaction=args.transaction, includeWorkspaces=args.includeWorkspaces, ignoreTimelocks=args.ignoreTimelocks, doDiffs=args.diffCheck, useCache=(args.cacheFile is not None), maxDiffWorkers=args.diffThreads)
     if streams is not None and len(streams) > 0:
         print("stream name; stream id; stream type;")
         for s in streams:
@@ -2770,10 +3130,11 @@ if __name__ == "__main__":
     affectedStreamsParser = subparsers.add_parser('affected-streams', help='Shows all the transactions that could have affected the current stream.')
     affectedStreamsParser.description = 'Shows all the transactions that could have affected the current stream.'
     affectedStreamsParser.add_argument('-p', '--depot',     dest='depot',    required=True, help='The name of the depot in which the transaction occurred')
-    affectedStreamsParser.add_argument('-t', '--transaction', dest='transaction', required=True, help='The accurev transaction number for which we want to know the affected streams.')
+    affectedStreamsParser.add_argument('-t', '--transaction', dest='transaction', required=True, help='The accurev transaction number for which we want to know the affected streams. A transaction range (e.g. 100-200) lists the affected streams of every transaction in the range.')
     affectedStreamsParser.add_argument('-w', '--include-workspaces', dest='includeWorkspaces', action='store_true', default=False, help='The returned set of streams will include workspaces if this option is specified.')
     affectedStreamsParser.add_argument('-i', '--ignore-timelocks', dest='ignoreTimelocks', action='store_true', default=False, help='The returned set of streams will include streams whose timelocks would have otherwise prevented this stream from affecting them.')
     affectedStreamsParser.add_argument('-d', '--diff-check', dest='diffCheck', action='store_true', default=False, help='The returned set of streams will not include streams whose diffs to previous transaction return empty.')
+    affectedStreamsParser.add_argument('-j', '--diff-threads', dest='diffThreads', type=int, default=4, help='The maximum number of diffs that are run concurrently when the --diff-check option is specified.')
     affectedStreamsParser.add_argument('-c', '--cache', dest='cacheFile', help='Specifies the command cacne filename to use for caching of accurev commands.')
 
     affectedStreamsParser.set_defaults(func=clAffectedStreams)
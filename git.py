@@ -420,6 +420,14 @@ def set_author_or_committer_environment(who="author", name=None, email=None, dat
             env[k.format(who=who)] = newEnv[k]
     return env
 
+def set_index_file_environment(indexFile=None, env=None):
+    if indexFile is None:
+        return env
+    if env is None:
+        env = os.environ.copy()
+    env['GIT_INDEX_FILE'] = indexFile
+    return env
+
 class repo(object):
     def __init__(self, path):
         if not isinstance(path, str):
@@ -433,14 +441,20 @@ class repo(object):
         # Private
         self._lastCommand = None
     
-    def _docmd(self, cmd, env=None):
-        process = subprocess.Popen(args=cmd, cwd=self.path, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=False)
+    def _docmd(self, cmd, env=None, input=None):
+        stdin = None
+        if input is not None:
+            stdin = subprocess.PIPE
+            if isinstance(input, str):
+                input = input.encode('utf-8')
+        process = subprocess.Popen(args=cmd, cwd=self.path, env=env, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=False)
 
         output = ''
         error  = ''
         process.poll()
         while process.returncode is None:
-            stdoutdata, stderrdata = process.communicate()
+            stdoutdata, stderrdata = process.communicate(input=input)
+            input = None
             output += decode_proc_output( stdoutdata )
             error  += decode_proc_output( stderrdata )
             process.poll()
@@ -463,8 +477,8 @@ class repo(object):
         else:
             return None
 
-    def raw_cmd(self, cmd):
-        return self._docmd(cmd)
+    def raw_cmd(self, cmd, input=None):
+        return self._docmd(cmd, input=input)
 
     def empty_tree(self, write=False):
         cmd = [ gitCmd, u'hash-object', '-t', 'tree' ]
@@ -477,6 +491,195 @@ class repo(object):
             return rv.strip()
         return rv
         
+    # Writes the given files into the object database and returns the list of blob hashes in the same order as the fileList.
+    # If input is given it is hashed instead of the files (via --stdin) and a single hash is returned in the list.
+    def hash_object(self, fileList=[], objType=None, write=False, input=None):
+        cmd = [ gitCmd, u'hash-object' ]
+
+        if objType is not None:
+            cmd.extend([ u'-t', objType ])
+        if write:
+            cmd.append(u'-w')
+
+        if input is not None:
+            cmd.append(u'--stdin')
+        else:
+            cmd.append(u'--')
+            cmd.extend(fileList)
+
+        output = self._docmd(cmd, input=input)
+        if output is not None:
+            return output.split()
+        return None
+
+    # Creates a tree object from the given list of (mode, type, hash, name) tuples and returns its hash.
+    # Only a single level of the tree is written, the sub-trees must already exist in the object database.
+    def mktree(self, entries=[], missing=False):
+        cmd = [ gitCmd, u'mktree', u'-z' ]
+
+        if missing:
+            cmd.append(u'--missing')
+
+        treeInput = u''
+        for mode, objType, objHash, name in entries:
+            treeInput += u'{mode} {type} {hash}\t{name}\0'.format(mode=mode, type=objType, hash=objHash, name=name)
+
+        output = self._docmd(cmd, input=treeInput)
+        if output is not None:
+            return output.strip()
+        return None
+
+    # Lists the entries of the given tree-ish and returns them as a list of (mode, type, hash, name) tuples.
+    def ls_tree(self, treeish, paths=[], recursive=False):
+        cmd = [ gitCmd, u'ls-tree', u'-z' ]
+
+        if recursive:
+            cmd.append(u'-r')
+
+        cmd.append(treeish)
+        if len(paths) > 0:
+            cmd.append(u'--')
+            cmd.extend(paths)
+
+        output = self._docmd(cmd)
+        if output is None:
+            return None
+
+        entries = []
+        for entry in output.split('\0'):
+            if len(entry) == 0:
+                continue
+            info, name = entry.split('\t', 1)
+            mode, objType, objHash = info.split(' ')
+            entries.append((mode, objType, objHash, name))
+        return entries
+
+    # Returns a list of (refname, objectHash, peeledHash) tuples for the refs matching the \a patterns (e.g. refs/heads). The peeledHash is the hash
+    # of the object that an annotated tag points to and None for all other refs.
+    def for_each_ref(self, patterns=[]):
+        cmd = [ gitCmd, u'for-each-ref', u'--format=%(objectname) %(*objectname) %(refname)' ]
+        cmd.extend(patterns)
+
+        output = self._docmd(cmd)
+        if output is None:
+            return None
+
+        refs = []
+        for line in output.split('\n'):
+            if len(line.strip()) == 0:
+                continue
+            objHash, peeledHash, refname = line.split(' ', 2)
+            refs.append((refname, objHash, peeledHash if len(peeledHash) > 0 else None))
+        return refs
+
+    # Resolves all of the given object names (e.g. <commit>^{tree}) with a single `git cat-file --batch-check` call. Returns a list of
+    # (objectHash, objectType) tuples in the same order as \a objects where the tuple is None for names that couldn't be resolved.
+    def cat_file_batch_check(self, objects=[]):
+        if len(objects) == 0:
+            return []
+
+        cmd = [ gitCmd, u'cat-file', u'--batch-check=%(objectname) %(objecttype)' ]
+        output = self._docmd(cmd, input=u''.join([ u'{0}\n'.format(x) for x in objects ]))
+        if output is None:
+            return None
+
+        lines = [ x for x in output.split('\n') if len(x.strip()) > 0 ]
+        if len(lines) != len(objects):
+            return None
+
+        results = []
+        for line in lines:
+            if line.endswith(u' missing'):
+                results.append(None)
+            else:
+                objHash, objType = line.split(' ', 1)
+                results.append((objHash, objType))
+        return results
+
+    # Returns the contents of the given objects (hashes or <rev>:<path> specs) as a list of strings in the same order as \a objects. Missing
+    # objects are returned as None. Returns None if the command failed.
+    def cat_file_batch(self, objects=[]):
+        if len(objects) == 0:
+            return []
+
+        cmd = [ gitCmd, u'cat-file', u'--batch' ]
+        process = subprocess.Popen(args=cmd, cwd=self.path, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=False)
+        stdoutdata, stderrdata = process.communicate(input=u''.join([ u'{0}\n'.format(x) for x in objects ]).encode('utf-8'))
+        self.lastStderr = decode_proc_output(stderrdata)
+        self.lastReturnCode = process.returncode
+        if process.returncode != 0:
+            return None
+
+        # Each object is output as a "<hash> <type> <size>" header line followed by <size> bytes of contents and a newline.
+        results = []
+        pos = 0
+        for x in objects:
+            end = stdoutdata.find(b'\n', pos)
+            if end < 0:
+                return None
+            header = stdoutdata[pos:end].decode('utf-8')
+            pos = end + 1
+            if header.endswith(u' missing'):
+                results.append(None)
+                continue
+            size = int(header.split(' ')[2])
+            results.append(decode_proc_output(stdoutdata[pos:pos + size]))
+            pos += size + 1
+        return results
+
+    # Returns the raw contents of the object \a obj as bytes, without decoding them or normalizing their newlines, or None if the command failed.
+    # If \a objType is given the object is peeled to that type, e.g. 'commit' or 'tree'.
+    def cat_file(self, obj, objType=None):
+        cmd = [ gitCmd, u'cat-file', objType if objType is not None else u'-p', obj ]
+        process = subprocess.Popen(args=cmd, cwd=self.path, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=False)
+        stdoutdata, stderrdata = process.communicate()
+        self.lastStderr = decode_proc_output(stderrdata)
+        self.lastReturnCode = process.returncode
+        if process.returncode != 0:
+            return None
+        return stdoutdata
+
+    # Returns the ref that the symbolic ref \a name (e.g. HEAD) points to or None if it isn't a symbolic ref (e.g. a detached HEAD).
+    def symbolic_ref(self, name=u'HEAD'):
+        output = self._docmd([ gitCmd, u'symbolic-ref', u'-q', name ])
+        if output is None:
+            return None
+        output = output.strip()
+        return output if len(output) > 0 else None
+
+    # Adds the given list of (mode, hash, path) tuples to the index without touching the worktree.
+    # A mode of 0 removes the path from the index instead.
+    def update_index(self, indexInfo=[], indexFile=None):
+        cmd = [ gitCmd, u'update-index', u'-z', u'--add', u'--index-info' ]
+
+        indexInput = u''
+        for mode, objHash, path in indexInfo:
+            indexInput += u'{mode} {hash}\t{path}\0'.format(mode=mode, hash=objHash, path=path)
+
+        return self._docmd(cmd, env=set_index_file_environment(indexFile), input=indexInput)
+
+    def read_tree(self, treeish, update=False, reset=False, indexFile=None):
+        cmd = [ gitCmd, u'read-tree' ]
+
+        if reset:
+            cmd.append(u'--reset')
+        if update:
+            cmd.append(u'-u')
+
+        cmd.append(treeish)
+
+        return self._docmd(cmd, env=set_index_file_environment(indexFile))
+
+    # Writes the given files from the index into the worktree.
+    def checkout_index(self, fileList=[], force=False):
+        cmd = [ gitCmd, u'checkout-index', u'-z' ]
+
+        if force:
+            cmd.append(u'-f')
+        cmd.append(u'--stdin')
+
+        return self._docmd(cmd, input=u''.join([ u'{0}\0'.format(x) for x in fileList ]))
+
     def checkout(self, branchName=None, isNewBranch=False, isOrphan=False):
         cmd = [ gitCmd, u'checkout' ]
         
@@ -539,7 +742,7 @@ class repo(object):
         
         return (output is not None)
     
-    def write_tree(self, missingOk=False, prefix=None, git_opts=[]):
+    def write_tree(self, missingOk=False, prefix=None, git_opts=[], indexFile=None):
         cmd = [ gitCmd ]
         
         if git_opts is not None and len(git_opts) > 0:
@@ -553,7 +756,7 @@ class repo(object):
             cmd.append(u'--prefix={prefix}'.format(prefix=prefix))
 
         # Execute the command
-        output = self._docmd(cmd)
+        output = self._docmd(cmd, env=set_index_file_environment(indexFile))
 
         return output
 
@@ -819,6 +1022,35 @@ class repo(object):
         
         return self._docmd(cmd)
 
+    def worktree_add(self, path, commitish=None, detach=False, noCheckout=False):
+        cmd = [ gitCmd, u'worktree', u'add' ]
+
+        if detach:
+            cmd.append(u'--detach')
+        if noCheckout:
+            cmd.append(u'--no-checkout')
+
+        cmd.append(path)
+        if commitish is not None:
+            cmd.append(commitish)
+
+        return self._docmd(cmd)
+
+    def worktree_prune(self):
+        cmd = [ gitCmd, u'worktree', u'prune' ]
+        return self._docmd(cmd)
+
+    # Runs `git fast-import` on the given \a stream of commands. If \a exportMarksFile is given the marks are written to it once the import is done.
+    def fast_import(self, stream, exportMarksFile=None, force=False, quiet=True):
+        cmd = [ gitCmd, u'fast-import' ]
+        if quiet:
+            cmd.append(u'--quiet')
+        if force:
+            cmd.append(u'--force')
+        if exportMarksFile is not None:
+            cmd.append(u'--export-marks={0}'.format(exportMarksFile))
+        return self._docmd(cmd, input=stream)
+
     class notes(object):
         def __init__(self, repo):
             self.repo = repo
@@ -903,6 +1135,22 @@ class repo(object):
                 return None
         return output
     
+    # Returns a list of (commitHash, [parentHashes]) tuples for the commits reachable from \a revs, parents before their children.
+    def rev_list_parents(self, revs=[]):
+        cmd = [ gitCmd, u'rev-list', u'--parents', u'--topo-order', u'--reverse' ]
+        cmd.extend(revs)
+
+        output = self._docmd(cmd)
+        if output is None:
+            return None
+
+        commits = []
+        for line in output.split('\n'):
+            hashes = line.split()
+            if len(hashes) > 0:
+                commits.append((hashes[0], hashes[1:]))
+        return commits
+
     def rev_parse(self, args=[], verify=False):
         cmd = [u'git', u'rev-parse']
         if verify:
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+# Checks that accurev.ext._affected_streams(), which expands the affected streams breadth-first over a basis -> children map, finds the same streams as
+# the scan over the whole stream dictionary that ext.affected_streams() used to repeat until no more streams were added.
+# Run with: python3 -m unittest discover -s tests
+
+import os
+import sys
+import zlib
+import types
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import accurev
+
+# The streams affected by the transaction as they used to be found, given the stream dictionary instead of querying accurev for it.
+def AffectedStreamsByScan(transaction, streamMap, includeWorkspaces, ignoreTimelocks, doDiffs):
+    destStreamNum = transaction.affectedStream()[1]
+    destStream = [ name for name in streamMap if streamMap[name].streamNumber == destStreamNum ][0]
+
+    childrenSet = set()
+    newChildrenSet = set()
+
+    newChildrenSet.add(destStream)
+    while len(newChildrenSet) > 0:
+        childrenSet |= newChildrenSet
+        newChildrenSet = set()
+
+        for stream in streamMap:
+            if streamMap[stream].basis in childrenSet and stream not in childrenSet:
+                if includeWorkspaces or streamMap[stream].Type.lower() != "workspace":
+                    if ignoreTimelocks or streamMap[stream].time is None or streamMap[stream].time >= transaction.time:
+                        if doDiffs and transaction.id > 1:
+                            diffResult = accurev.diff(all=True, informationOnly=True, verSpec1=stream, verSpec2=stream, transactionRange="{0}-{1}".format(transaction.id, transaction.id - 1), useCache=False)
+                            if len(diffResult.elements) != 0:
+                                newChildrenSet.add(stream)
+                        else:
+                            newChildrenSet.add(stream)
+
+    rv = []
+    for stream in childrenSet:
+        rv.append(streamMap[stream])
+    return rv
+
+# Returns a stream dictionary, see ext.stream_dict(), of \a count streams and workspaces where stream 1 is the root and every other stream has a
+# lower numbered basis. Some of them are timelocked.
+def MakeRandomStreamMap(rng, count):
+    streamMap = {}
+    for sn in range(1, count + 1):
+        basisNumber = rng.randint(1, sn - 1) if sn > 1 else None
+        Type = 'workspace' if sn > 1 and rng.random() < 0.3 else 'normal'
+        time = 1400000000 + rng.randint(0, 1000) if rng.random() < 0.2 else None
+        stream = accurev.obj.Stream(name='stream{0}'.format(sn), streamNumber=sn, depotName='depot', Type=Type, basis=None if basisNumber is None else 'stream{0}'.format(basisNumber), basisStreamNumber=basisNumber, time=time)
+        streamMap[stream.name] = stream
+    return streamMap
+
+class TestAffectedStreams(unittest.TestCase):
+    def setUp(self):
+        self.diff = accurev.diff
+        # Whether a stream changed in a transaction is decided by a hash instead of asking accurev.
+        def diff(all, informationOnly, verSpec1, verSpec2, transactionRange, useCache):
+            changed = zlib.crc32('{0} {1}'.format(verSpec1, transactionRange).encode('utf-8')) % 3 != 0
+            return types.SimpleNamespace(elements=[ verSpec1 ] if changed else [])
+        accurev.diff = diff
+
+    def tearDown(self):
+        accurev.diff = self.diff
+
+    def test_matches_scan(self):
+        rng = random.Random(37)
+        for i in range(0, 300):
+            streamMap = MakeRandomStreamMap(rng, rng.randint(1, 40))
+            childrenMap = accurev.ext.stream_children_dict(streamMap)
+            dest = rng.choice(list(streamMap.values()))
+            transaction = accurev.obj.Transaction(id=rng.randint(1, 100), Type='promote', time=1400000000 + rng.randint(0, 1000), user='joe', comment=None, streamName=dest.name, streamNumber=dest.streamNumber)
+            includeWorkspaces, ignoreTimelocks, doDiffs = rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.5
+            maxDiffWorkers = rng.choice([ 1, 4 ])
+
+            expected = AffectedStreamsByScan(transaction, streamMap, includeWorkspaces=includeWorkspaces, ignoreTimelocks=ignoreTimelocks, doDiffs=doDiffs)
+            actual = accurev.ext._affected_streams(depot='depot', transaction=transaction, streamMap=streamMap, childrenMap=childrenMap, includeWorkspaces=includeWorkspaces, ignoreTimelocks=ignoreTimelocks, doDiffs=doDiffs, useCache=False, maxDiffWorkers=maxDiffWorkers)
+            self.assertEqual(sorted([ s.streamNumber for s in expected ]), sorted([ s.streamNumber for s in actual ]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+# Checks that the CommitGraph, which GitMergeBase(isAncestor=True) uses while it is loaded, gives the same answers as a plain reachability search
+# and as `git merge-base --is-ancestor` on a real repository.
+# Run with: python3 -m unittest discover -s tests
+
+import os
+import sys
+import logging
+import random
+import shutil
+import tempfile
+import threading
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import git
+import ac2git
+
+ac2git.logger = logging.getLogger('ac2git') # Normally set up by InitializeLogging().
+
+# Returns a list of (commit, parents) tuples, parents first, for a random history of \a count commits with a few roots and merges.
+def MakeRandomHistory(rng, count):
+    history = []
+    for i in range(0, count):
+        commitHash = 'c{0}'.format(i)
+        if i == 0 or rng.random() < 0.05:
+            parents = []
+        else:
+            parents = rng.sample(range(0, i), min(i, rng.choice([ 1, 1, 1, 2, 3 ])))
+            parents = [ 'c{0}'.format(x) for x in parents ]
+        history.append( (commitHash, parents) )
+    return history
+
+# The reference answer, a search over all the parents without any generation cut-off.
+def IsReachable(parentsMap, ancestor, commitHash):
+    visited = set()
+    stack = [ commitHash ]
+    while len(stack) > 0:
+        c = stack.pop()
+        if c == ancestor:
+            return True
+        if c not in visited:
+            visited.add(c)
+            stack.extend(parentsMap[c])
+    return False
+
+class TestCommitGraph(unittest.TestCase):
+    def test_is_ancestor_matches_reachability(self):
+        rng = random.Random(42)
+        for i in range(0, 50):
+            history = MakeRandomHistory(rng, rng.randint(1, 60))
+            graph = ac2git.CommitGraph()
+            for commitHash, parents in history:
+                graph.Add(commitHash, parents)
+            parentsMap = dict(history)
+            for j in range(0, 100):
+                ancestor, commitHash = rng.choice(history)[0], rng.choice(history)[0]
+                self.assertEqual(IsReachable(parentsMap, ancestor, commitHash), graph.IsAncestor(ancestor, commitHash))
+
+    def test_unknown_commits_are_left_to_git(self):
+        graph = ac2git.CommitGraph()
+        graph.Add('a', [])
+        graph.Add('b', [ 'a' ])
+        graph.Add('d', [ 'c' ]) # The parent c isn't in the graph, e.g. it isn't on any branch.
+        graph.Add('e', [ 'd' ])
+        self.assertTrue(graph.IsAncestor('a', 'b'))
+        self.assertFalse(graph.IsAncestor('b', 'a'))
+        self.assertIsNone(graph.IsAncestor('a', 'e'))
+        self.assertIsNone(graph.IsAncestor('x', 'b'))
+        self.assertIsNone(graph.IsAncestor('x', 'x'))
+
+    def test_git_merge_base_matches_git(self):
+        rng = random.Random(4242)
+        repoPath = tempfile.mkdtemp(prefix='ac2git_test_')
+        try:
+            gitCmd = [ 'git', '-c', 'user.name=test', '-c', 'user.email=test@example.com' ]
+            subprocess.check_output(gitCmd + [ 'init', '-q', repoPath ])
+            emptyTree = subprocess.check_output(gitCmd + [ 'hash-object', '-w', '-t', 'tree', '--stdin' ], cwd=repoPath, input=b'').decode('utf-8').strip()
+
+            commits = []
+            for i, (name, parents) in enumerate(MakeRandomHistory(rng, 40)):
+                cmd = gitCmd + [ 'commit-tree', emptyTree, '-m', name ]
+                for p in parents:
+                    cmd.extend([ '-p', commits[int(p[1:])] ])
+                commits.append(subprocess.check_output(cmd, cwd=repoPath).decode('utf-8').strip())
+                subprocess.check_output(gitCmd + [ 'update-ref', 'refs/heads/b{0}'.format(i), commits[-1] ], cwd=repoPath)
+
+            converter = ac2git.AccuRev2Git.__new__(ac2git.AccuRev2Git)
+            converter.gitRepo = git.open(repoPath)
+            converter.commitCacheLock = threading.Lock()
+            converter.LoadCommitGraph()
+            self.assertEqual(len(commits), len(converter.commitGraph))
+            for j in range(0, 60):
+                ancestor, commitHash = rng.choice(commits), rng.choice(commits)
+                self.assertEqual(converter.gitRepo.merge_base(commits=[ ancestor, commitHash ], is_ancestor=True), converter.GitMergeBase(refs=[ ancestor, commitHash ], isAncestor=True))
+        finally:
+            shutil.rmtree(repoPath, ignore_errors=True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+# Checks that parsing only the transaction headers of `accurev hist` output, obj.History.fromxmlstring(headerOnly=True), gives the same transactions
+# as the full parse apart from the versions and moves that it drops.
+# Run with: python3 -m unittest discover -s tests
+
+import os
+import sys
+import random
+import unittest
+from xml.sax.saxutils import quoteattr, escape
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import accurev
+
+# Returns the XML of an `accurev hist` response with \a count random transactions, newest first like accurev lists them.
+def MakeRandomHistXml(rng, count):
+    lines = [ '<?xml version="1.0" encoding="utf-8"?>', '<AcResponse Command="hist" TaskId="{0}">'.format(rng.randint(1, 1000)) ]
+    for trId in range(count, 0, -1):
+        Type = rng.choice([ 'promote', 'keep', 'chstream', 'mkstream', 'defunct', 'purge' ])
+        attribs = { 'id': trId, 'type': Type, 'time': 1400000000 + trId * 60, 'user': rng.choice([ 'joe', 'ann' ]) }
+        if rng.random() < 0.7: # Transactions from before accurev 6.1 don't have the stream attributes.
+            attribs['streamName'], attribs['streamNumber'] = 'stream{0}'.format(trId % 5), trId % 5 + 1
+            if Type == 'promote':
+                attribs['fromStreamName'], attribs['fromStreamNumber'] = 'ws{0}'.format(trId % 3), trId % 3 + 10
+        lines.append('  <transaction {0}>'.format(' '.join([ '{0}={1}'.format(k, quoteattr(str(v))) for k, v in attribs.items() ])))
+        if rng.random() < 0.8:
+            lines.append('    <comment>{0}</comment>'.format(escape(rng.choice([ 'fix', 'a < b & c', 'multi\nline' ]))))
+        for i in range(0, rng.randint(0, 5)):
+            lines.append('    <version path="/./dir/file{0}" eid="{1}" virtual="{2}/{3}" real="{4}/{3}" virtualNamedVersion="stream{2}/{3}" realNamedVersion="ws{4}/{3}"/>'.format(i, rng.randint(1, 100), trId % 5 + 1, rng.randint(1, 9), trId % 3 + 10))
+        for i in range(0, rng.randint(0, 2)):
+            lines.append('    <move dest="/./dir/new{0}" source="/./dir/old{0}"/>'.format(i))
+        if Type in [ 'chstream', 'mkstream' ]:
+            lines.append('    <stream name="stream{0}" streamNumber="{1}" depotName="depot" type="normal" basis="root" basisStreamNumber="1"/>'.format(trId % 5, trId % 5 + 1))
+        lines.append('  </transaction>')
+    if rng.random() < 0.5:
+        lines.append('  <streams>')
+        lines.append('    <stream name="stream1" streamNumber="2" depotName="depot" type="normal" basis="root" basisStreamNumber="1"/>')
+        lines.append('  </streams>')
+    lines.append('</AcResponse>')
+    return '\n'.join(lines)
+
+class TestHistoryHeaders(unittest.TestCase):
+    def setUp(self):
+        self.headerParseChunkSize = accurev.obj.History.headerParseChunkSize
+
+    def tearDown(self):
+        accurev.obj.History.headerParseChunkSize = self.headerParseChunkSize
+
+    def assertSameHeaders(self, full, headers):
+        self.assertEqual(full.taskId, headers.taskId)
+        self.assertEqual(len(full.transactions), len(headers.transactions))
+        for fullTr, tr in zip(full.transactions, headers.transactions):
+            for attr in [ 'id', 'Type', 'time', 'user', 'comment', 'streamName', 'streamNumber', 'fromStreamName', 'fromStreamNumber' ]:
+                self.assertEqual(getattr(fullTr, attr), getattr(tr, attr), attr)
+            self.assertEqual(fullTr.affectedStream(), tr.affectedStream())
+            self.assertEqual(fullTr.fromStream(), tr.fromStream())
+            self.assertEqual(repr(fullTr.stream), repr(tr.stream))
+            self.assertEqual(repr(fullTr.versions[:1]), repr(tr.versions))
+            self.assertEqual([], tr.moves)
+        self.assertEqual(repr(full.streams), repr(headers.streams))
+        if len(full.transactions) == 1:
+            self.assertEqual(full.fromStream(), headers.fromStream())
+
+    def test_headers_match_full_parse(self):
+        rng = random.Random(35)
+        for i in range(0, 100):
+            xmlText = MakeRandomHistXml(rng, rng.randint(0, 20))
+            # Small chunks so that elements are split between the chunks that are fed to the parser.
+            accurev.obj.History.headerParseChunkSize = rng.choice([ 1, 7, 64, 1024 * 1024 ])
+            self.assertSameHeaders(accurev.obj.History.fromxmlstring(xmlText), accurev.obj.History.fromxmlstring(xmlText, headerOnly=True))
+
+    def test_invalid_xml(self):
+        for xmlText in [ 'garbage', '<AcResponse Command="show"></AcResponse>', '<AcResponse Command="hist"><transaction' ]:
+            self.assertIsNone(accurev.obj.History.fromxmlstring(xmlText))
+            self.assertIsNone(accurev.obj.History.fromxmlstring(xmlText, headerOnly=True))
+
+if __name__ == '__main__':
+    unittest.main()
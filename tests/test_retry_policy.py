@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+# Checks the RetryPolicy that the Try* wrappers share: the jittered exponential backoff, which failures are retried, and the circuit breaker that
+# pauses every caller until the probe succeeds.
+# Run with: python3 -m unittest discover -s tests
+
+import os
+import sys
+import time
+import random
+import logging
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ac2git
+
+ac2git.logger = logging.getLogger('ac2git') # Normally set up by InitializeLogging().
+ac2git.logger.addHandler(logging.NullHandler()) # The retries are logged as warnings, keep them out of the test output.
+
+# Returns a function which returns the given \a results one after the other, and the list of the results that it has returned.
+def MakeCommand(results):
+    results = list(results)
+    returned = []
+    def command():
+        returned.append(results.pop(0))
+        return returned[-1]
+    return command, returned
+
+def Run(policy, command):
+    return policy.Run('test', command, isSuccess=lambda x: x == 'ok', getError=lambda x: x, isExpected=lambda x: x == 'expected')
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_backoff(self):
+        random.seed(43)
+        policy = ac2git.RetryPolicy(baseSeconds=0.5, maxSeconds=5.0)
+        for retry in range(0, 8):
+            delay = min(5.0, 0.5 * (2 ** retry))
+            delays = [ policy.GetDelay(retry) for i in range(0, 200) ]
+            self.assertTrue(all([ delay * 0.5 <= x <= delay * 1.5 for x in delays ]))
+            self.assertNotEqual(1, len(set(delays))) # Jittered.
+
+    def test_retries_until_success(self):
+        policy = ac2git.RetryPolicy(attempts=5, baseSeconds=0.001)
+        command, returned = MakeCommand([ 'server busy', 'timed out', 'ok', 'ok' ])
+        self.assertEqual('ok', Run(policy, command))
+        self.assertEqual(3, len(returned))
+        self.assertEqual(2, policy.retryCount)
+        self.assertEqual(0, policy.consecutiveFailures)
+
+    def test_gives_up_after_the_attempts(self):
+        policy = ac2git.RetryPolicy(attempts=3, baseSeconds=0.001)
+        command, returned = MakeCommand([ 'busy' ] * 5)
+        self.assertEqual('busy', Run(policy, command))
+        self.assertEqual(3, len(returned))
+        self.assertEqual(2, policy.retryCount)
+
+    def test_fatal_and_expected_failures_are_not_retried(self):
+        policy = ac2git.RetryPolicy(attempts=5, baseSeconds=0.001)
+        command, returned = MakeCommand([ 'Not authorized to do that', 'ok' ])
+        self.assertEqual('Not authorized to do that', Run(policy, command))
+        self.assertEqual(1, len(returned))
+        self.assertEqual(1, policy.fatalCount)
+
+        command, returned = MakeCommand([ 'expected', 'ok' ])
+        self.assertEqual('expected', Run(policy, command))
+        self.assertEqual(1, len(returned))
+        self.assertEqual(0, policy.retryCount)
+        self.assertEqual(0, policy.consecutiveFailures)
+
+    def test_breaker_pauses_until_the_probe_succeeds(self):
+        probeResults = [ False, False, True ]
+        trips = []
+        policy = ac2git.RetryPolicy(attempts=1, baseSeconds=0.001, breakerThreshold=3, breakerPauseSeconds=0.001, probe=lambda: probeResults.pop(0))
+        policy.onTrip = lambda: trips.append(True)
+        command, returned = MakeCommand([ 'busy' ] * 3 + [ 'ok' ])
+        for i in range(0, 3):
+            self.assertEqual('busy', Run(policy, command))
+        self.assertEqual([ True ], trips)
+        self.assertEqual([], probeResults)
+        self.assertEqual(1, policy.breakerTrips)
+        self.assertEqual(0, policy.consecutiveFailures)
+        self.assertTrue(policy.closedEvent.is_set())
+        self.assertEqual('ok', Run(policy, command))
+
+    def test_breaker_blocks_other_callers(self):
+        serverAvailable = threading.Event()
+        policy = ac2git.RetryPolicy(attempts=1, baseSeconds=0.001, breakerThreshold=1, breakerPauseSeconds=0.001, probe=serverAvailable.is_set)
+        failing, failingReturned = MakeCommand([ 'busy' ])
+        waiting, waitingReturned = MakeCommand([ 'ok' ])
+        failingThread = threading.Thread(target=Run, args=(policy, failing))
+        failingThread.start()
+        while policy.closedEvent.is_set():
+            time.sleep(0.001)
+        waitingThread = threading.Thread(target=Run, args=(policy, waiting))
+        waitingThread.start()
+        time.sleep(0.05)
+        self.assertEqual([], waitingReturned)
+        serverAvailable.set()
+        failingThread.join()
+        waitingThread.join()
+        self.assertEqual([ 'ok' ], waitingReturned)
+
+    def test_breaker_gives_up(self):
+        policy = ac2git.RetryPolicy(attempts=1, baseSeconds=0.001, breakerThreshold=1, breakerPauseSeconds=0.001, breakerMaxPauseSeconds=0.005, probe=lambda: False)
+        command, returned = MakeCommand([ 'busy' ])
+        self.assertRaises(Exception, Run, policy, command)
+        self.assertTrue(policy.closedEvent.is_set())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+# Checks that StreamTimeline.Find() returns the same entry as walking the commit_history ref with `git log -1 --first-parent --before=<timestamp>`,
+# i.e. the latest entry whose timestamp isn't after the given one, even when the transaction times aren't monotonic.
+# Run with: python3 -m unittest discover -s tests
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ac2git
+
+# The reference answer, the first entry that `git log --first-parent` would list (newest first) whose timestamp isn't after the given one.
+def FindByScan(entries, timestamp):
+    for entry in reversed(entries):
+        if entry[0] <= timestamp:
+            return entry
+    return None
+
+# Returns \a count (timestamp, transaction, commit) entries whose timestamps mostly increase but occasionally go back in time.
+def MakeRandomEntries(rng, count, inversionRate):
+    entries = []
+    timestamp = 1000
+    for trId in range(1, count + 1):
+        if rng.random() < inversionRate:
+            timestamp -= rng.randint(1, 50)
+        else:
+            timestamp += rng.randint(0, 10)
+        entries.append( (timestamp, trId, 'commit{0}'.format(trId)) )
+    return entries
+
+class TestStreamTimeline(unittest.TestCase):
+    def assertFindMatchesScan(self, rng, timeline, entries):
+        for timestamp in range(entries[0][0] - 60, entries[-1][0] + 60) if len(entries) > 0 else [ 0 ]:
+            self.assertEqual(FindByScan(entries, timestamp), timeline.Find(timestamp))
+        for i in range(0, 50):
+            timestamp = rng.choice(entries)[0] if len(entries) > 0 else 0
+            self.assertEqual(FindByScan(entries, timestamp), timeline.Find(timestamp))
+
+    def test_find_monotonic(self):
+        rng = random.Random(44)
+        for i in range(0, 50):
+            entries = MakeRandomEntries(rng, rng.randint(0, 100), inversionRate=0.0)
+            self.assertFindMatchesScan(rng, ac2git.StreamTimeline(entries=entries), entries)
+
+    def test_find_with_inversions(self):
+        rng = random.Random(4444)
+        for i in range(0, 200):
+            entries = MakeRandomEntries(rng, rng.randint(1, 100), inversionRate=0.2)
+            self.assertFindMatchesScan(rng, ac2git.StreamTimeline(entries=entries), entries)
+
+    def test_find_while_appending(self):
+        rng = random.Random(444)
+        entries = MakeRandomEntries(rng, 300, inversionRate=0.1)
+        timeline = ac2git.StreamTimeline()
+        for i, entry in enumerate(entries):
+            timeline.Append(*entry)
+            if i % 10 == 0:
+                self.assertFindMatchesScan(rng, timeline, entries[:i + 1])
+
+    def test_json_round_trip(self):
+        rng = random.Random(44444)
+        entries = MakeRandomEntries(rng, 100, inversionRate=0.2)
+        timeline = ac2git.StreamTimeline(head='head', entries=entries)
+        loaded = ac2git.StreamTimeline.fromjson(timeline.tojson())
+        self.assertEqual('head', loaded.head)
+        self.assertEqual(len(timeline), len(loaded))
+        self.assertFindMatchesScan(rng, loaded, entries)
+
+if __name__ == '__main__':
+    unittest.main()
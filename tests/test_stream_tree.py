@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+# Checks that the StreamTree, which ProcessTransactions() keeps between transactions, gives the same pruned trees as building and pruning the
+# whole tree from scratch for every transaction (the BuildStreamTree() and PruneStreamTree() functions that it replaced).
+# Run with: python3 -m unittest discover -s tests
+
+import os
+import sys
+import random
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import accurev
+import ac2git
+
+# The tree as it used to be built, and pruned, for every transaction.
+def BuildStreamTree(streams):
+    rv = {}
+    for s in streams:
+        rv[s.streamNumber] = { "parent": s.basisStreamNumber, "children": [], "self": s }
+    for s in streams:
+        if s.basisStreamNumber is None:
+            continue
+        if s.basisStreamNumber not in rv:
+            raise Exception("Incomplete set of streams given! Stream {s} is missing from the streams list, cannot build tree!".format(s=s.basisStreamNumber))
+        rv[s.basisStreamNumber]["children"].append(s.streamNumber)
+    return rv
+
+def PruneStreamTree(streamTree, keepList):
+    rv = None
+    if streamTree is not None:
+        if keepList is None:
+            return streamTree
+        elif len(keepList) == 1:
+            return { keepList[0]: { "parent": None, "children": [], "self": streamTree[keepList[0]]["self"] } }
+        rv = streamTree.copy()
+        # Remove all the streams that are not in the keepList and take their children and add them to the parent stream.
+        for s in streamTree:
+            if s not in keepList:
+                # Find the next parent that we are keeping.
+                p = streamTree[s]["parent"]
+                while p is not None and p not in keepList:
+                    p = streamTree[p]["parent"]
+                # If we found the parent then append our children to his/hers.
+                if p is not None:
+                    c = streamTree[s]["children"]
+                    rv[p]["children"].extend(c)
+                del rv[s]
+                # Set the parent for all the children to either None or the actual parent.
+                for c in streamTree[s]["children"]:
+                    if c in rv:
+                        rv[c]["parent"] = p
+        # Remove all the streams that are not in the keepList from each streams children list.
+        for s in rv:
+            children = []
+            for c in rv[s]["children"]:
+                if c in keepList:
+                    children.append(c)  # subset of children
+            rv[s]["children"] = children
+
+    return rv
+
+def MakeStream(streamNumber, basisStreamNumber):
+    return accurev.obj.Stream(name='stream{0}'.format(streamNumber), streamNumber=streamNumber, depotName='depot', Type='normal', basis=None if basisStreamNumber is None else 'stream{0}'.format(basisStreamNumber), basisStreamNumber=basisStreamNumber)
+
+# Returns a list of \a count streams, in a random order, where stream 1 is the root and every other stream has a lower numbered basis.
+def MakeRandomStreams(rng, count):
+    streams = [ MakeStream(1, None) ] + [ MakeStream(sn, rng.randint(1, sn - 1)) for sn in range(2, count + 1) ]
+    rng.shuffle(streams)
+    return streams
+
+# Returns a copy of the \a streams in which \a changeCount randomly chosen streams were moved under a new basis that isn't one of their descendants.
+def ChangeRandomBases(rng, streams, changeCount):
+    bases = { s.streamNumber: s.basisStreamNumber for s in streams }
+    for i in range(0, changeCount):
+        sn = rng.choice([ x for x in bases if bases[x] is not None ])
+        descendants = set([ sn ])
+        changed = True
+        while changed:
+            changed = False
+            for x in bases:
+                if x not in descendants and bases[x] in descendants:
+                    descendants.add(x)
+                    changed = True
+        bases[sn] = rng.choice([ x for x in bases if x not in descendants ])
+    return [ MakeStream(s.streamNumber, bases[s.streamNumber]) for s in streams ]
+
+class TestStreamTree(unittest.TestCase):
+    def assertSameTree(self, expected, actual):
+        self.assertEqual(sorted(expected.keys()), sorted(actual.keys()))
+        for sn in expected:
+            self.assertEqual(expected[sn]["parent"], actual[sn]["parent"])
+            self.assertEqual(sorted(expected[sn]["children"]), sorted(actual[sn]["children"]))
+            self.assertIs(expected[sn]["self"], actual[sn]["self"])
+
+    def RandomKeepList(self, rng, streams):
+        return list(set([ s.streamNumber for s in rng.sample(streams, rng.randint(1, len(streams))) ]))
+
+    def test_prune_matches_rebuild(self):
+        rng = random.Random(45)
+        for i in range(0, 500):
+            streams = MakeRandomStreams(rng, rng.randint(1, 30))
+            tree = ac2git.StreamTree(streams)
+            for j in range(0, 5):
+                keepList = self.RandomKeepList(rng, streams)
+                self.assertSameTree(PruneStreamTree(BuildStreamTree(streams), keepList), tree.Prune(keepList=keepList))
+
+    def test_update_matches_rebuild(self):
+        rng = random.Random(4545)
+        for i in range(0, 500):
+            streams = MakeRandomStreams(rng, rng.randint(2, 30))
+            tree = ac2git.StreamTree(streams)
+            for j in range(0, 5):
+                streams = ChangeRandomBases(rng, streams, rng.randint(1, 3))
+                self.assertTrue(tree.Update(streams))
+                keepList = self.RandomKeepList(rng, streams)
+                self.assertSameTree(PruneStreamTree(BuildStreamTree(streams), keepList), tree.Prune(keepList=keepList))
+
+    def test_update_refuses_added_streams(self):
+        streams = [ MakeStream(1, None), MakeStream(2, 1) ]
+        tree = ac2git.StreamTree(streams)
+        self.assertFalse(tree.Update(streams + [ MakeStream(3, 2) ]))
+        self.assertFalse(tree.Update([ MakeStream(1, None), MakeStream(3, 1) ]))
+
+    # A basis can change in a transaction that isn't processed, the next stream list that is seen has to bring the tree up to date anyway.
+    def test_get_stream_tree_sees_skipped_basis_changes(self):
+        rng = random.Random(450)
+        converter = ac2git.AccuRev2Git.__new__(ac2git.AccuRev2Git)
+        converter.streamTree, converter.streamTreeStreams, converter.streamTreeLock = None, None, threading.Lock()
+        streams = MakeRandomStreams(rng, 20)
+        for i in range(0, 200):
+            streams = ChangeRandomBases(rng, streams, rng.randint(1, 3))
+            if rng.random() < 0.5:
+                continue # The transaction that made the change wasn't processed.
+            keepList = self.RandomKeepList(rng, streams)
+            actual = converter.GetStreamTree(streams=accurev.obj.Show.Streams(streams=streams), keepList=keepList)
+            self.assertSameTree(PruneStreamTree(BuildStreamTree(streams), keepList), actual)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+# Checks the keys that the transaction scheduler orders the transactions by, see AccuRev2Git.GetTransactionKeys(). Every tracked stream above or
+# below a stream that the transaction affects has to be represented by its key, so that two transactions which touch the same branch always wait
+# for each other, and the transactions that change the stream structure have to be processed on their own.
+# Run with: python3 -m unittest discover -s tests
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import accurev
+import ac2git
+
+def MakeStream(streamNumber, basisStreamNumber):
+    return accurev.obj.Stream(name='stream{0}'.format(streamNumber), streamNumber=streamNumber, depotName='depot', Type='normal', basis=None if basisStreamNumber is None else 'stream{0}'.format(basisStreamNumber), basisStreamNumber=basisStreamNumber)
+
+def MakeHistory(trId, Type, streamNumber, fromStreamNumber=None, stream=None):
+    tr = accurev.obj.Transaction(id=trId, Type=Type, time=1400000000 + trId, user='joe', comment=None, streamName='stream{0}'.format(streamNumber), streamNumber=streamNumber, fromStreamName=None if fromStreamNumber is None else 'stream{0}'.format(fromStreamNumber), fromStreamNumber=fromStreamNumber, stream=stream)
+    return accurev.obj.History(transactions=[ tr ], streams=[])
+
+# Returns the stream and its ancestors.
+def Ancestry(bases, streamNumber):
+    ancestry = []
+    while streamNumber is not None:
+        ancestry.append(streamNumber)
+        streamNumber = bases[streamNumber]
+    return ancestry
+
+# The tracked streams whose branches processing the transaction can read or write, i.e. the ones above or below one of its related streams.
+def TouchedStreams(bases, tracked, relatedStreams):
+    touched = set()
+    for sn in tracked:
+        for related in relatedStreams:
+            if sn in Ancestry(bases, related) or related in Ancestry(bases, sn):
+                touched.add(sn)
+    return touched
+
+# The key of a tracked stream, its topmost tracked ancestor (or itself).
+def StreamKey(bases, tracked, streamNumber):
+    return [ sn for sn in Ancestry(bases, streamNumber) if sn in tracked ][-1]
+
+class TestTransactionKeys(unittest.TestCase):
+    def MakeConverter(self):
+        converter = ac2git.AccuRev2Git.__new__(ac2git.AccuRev2Git)
+        converter.streamKeyCache = None
+        return converter
+
+    def test_keys_cover_the_touched_streams(self):
+        rng = random.Random(50)
+        for i in range(0, 100):
+            count = rng.randint(2, 30)
+            bases = { 1: None }
+            for sn in range(2, count + 1):
+                bases[sn] = rng.randint(1, sn - 1)
+            streams = accurev.obj.Show.Streams(streams=[ MakeStream(sn, bases[sn]) for sn in bases ])
+            tracked = set(rng.sample(sorted(bases), rng.randint(1, count)))
+            streamMap = { str(sn): {} for sn in tracked }
+            converter = self.MakeConverter()
+
+            transactions = []
+            for j in range(0, 20):
+                destNumber = rng.choice(sorted(bases))
+                fromNumber = rng.choice(sorted(bases)) if rng.random() < 0.5 else None
+                affectedStreamMap = { sn: {} for sn in tracked if destNumber in Ancestry(bases, sn) and rng.random() < 0.7 }
+                trHist = MakeHistory(j + 1, 'promote', destNumber, fromStreamNumber=fromNumber)
+                keys = converter.GetTransactionKeys(streams=streams, streamsHash='hash{0}'.format(i), trHist=trHist, streamMap=streamMap, affectedStreamMap=affectedStreamMap)
+
+                relatedStreams = set(affectedStreamMap.keys()) | set([ destNumber ]) | (set([ fromNumber ]) if fromNumber is not None else set())
+                touched = TouchedStreams(bases, tracked, relatedStreams)
+                expected = set([ StreamKey(bases, tracked, sn) for sn in touched ])
+                self.assertEqual(expected if len(expected) > 0 else None, keys)
+                transactions.append( (touched, keys if keys is not None else set()) )
+
+            # Transactions that touch the same branch must share a key so that the scheduler runs them in order.
+            for touched1, keys1 in transactions:
+                for touched2, keys2 in transactions:
+                    if not touched1.isdisjoint(touched2):
+                        self.assertFalse(keys1.isdisjoint(keys2))
+
+    def test_stream_structure_changes_run_alone(self):
+        streams = accurev.obj.Show.Streams(streams=[ MakeStream(1, None), MakeStream(2, 1) ])
+        streamMap = { '1': {}, '2': {} }
+        converter = self.MakeConverter()
+        for trHist in [ MakeHistory(1, 'mkstream', 2), MakeHistory(2, 'chstream', 2), MakeHistory(3, 'defcomp', 2, stream=MakeStream(2, 1)) ]:
+            self.assertIsNone(converter.GetTransactionKeys(streams=streams, streamsHash='hash', trHist=trHist, streamMap=streamMap, affectedStreamMap={ 2: {} }))
+
+    def test_keys_follow_the_stream_list(self):
+        # Stream 3 is under stream 2 and then moved under stream 4. The keys are worked out again when the hash of the stream list changes.
+        streamMap = { '2': {}, '3': {}, '4': {} }
+        converter = self.MakeConverter()
+        streams = accurev.obj.Show.Streams(streams=[ MakeStream(1, None), MakeStream(2, 1), MakeStream(3, 2), MakeStream(4, 1) ])
+        self.assertEqual(set([ 2 ]), converter.GetTransactionKeys(streams=streams, streamsHash='hash1', trHist=MakeHistory(1, 'promote', 3), streamMap=streamMap, affectedStreamMap={ 3: {} }))
+        streams = accurev.obj.Show.Streams(streams=[ MakeStream(1, None), MakeStream(2, 1), MakeStream(3, 4), MakeStream(4, 1) ])
+        self.assertEqual(set([ 4 ]), converter.GetTransactionKeys(streams=streams, streamsHash='hash2', trHist=MakeHistory(2, 'promote', 3), streamMap=streamMap, affectedStreamMap={ 3: {} }))
+        # A promote to the untracked root touches every tracked stream.
+        self.assertEqual(set([ 2, 4 ]), converter.GetTransactionKeys(streams=streams, streamsHash='hash2', trHist=MakeHistory(3, 'promote', 1), streamMap=streamMap, affectedStreamMap={ 2: {}, 3: {}, 4: {} }))
+
+if __name__ == '__main__':
+    unittest.main()
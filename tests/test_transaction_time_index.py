@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+
+# Checks that accurev.ext.TransactionTimeIndex.find() only answers when the index knows which transaction was current at the given time, that its
+# answers match a scan of the transaction times, and that it stops answering once the transaction times go backwards.
+# Run with: python3 -m unittest discover -s tests
+
+import os
+import sys
+import random
+import datetime
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import accurev
+
+def MakeTime(timestamp):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=timestamp)
+
+# The reference answer for a depot whose transaction times never decrease: the last transaction at or before the time, if the transaction after it
+# is known to be after the time (or it is the \a highestId).
+def FindByScan(times, timestamp, highestId=None):
+    candidates = [ trId for trId in times if times[trId] <= timestamp ]
+    if len(candidates) == 0:
+        return None
+    trId = max(candidates)
+    nextTime = times.get(trId + 1)
+    if (nextTime is not None and nextTime > timestamp) or (highestId is not None and trId == highestId):
+        return trId
+    return None
+
+class TestTransactionTimeIndex(unittest.TestCase):
+    def test_find_matches_scan(self):
+        rng = random.Random(36)
+        for i in range(0, 50):
+            count = rng.randint(1, 80)
+            times, timestamp = {}, 1000
+            for trId in range(1, count + 1):
+                timestamp += rng.choice([ 0, 0, 1, 5, 30 ]) # Several transactions can have the same time.
+                times[trId] = timestamp
+            known = rng.sample(sorted(times), rng.randint(1, count)) # Only part of the history has been retrieved.
+            index = accurev.ext.TransactionTimeIndex()
+            for trId in known:
+                index.add(trId, MakeTime(times[trId]))
+            knownTimes = { trId: times[trId] for trId in known }
+            highestId = count if rng.random() < 0.5 else None
+            for t in range(999, timestamp + 2):
+                expected = FindByScan(knownTimes, t, highestId=highestId)
+                self.assertEqual(expected, index.find(MakeTime(t), highestId=highestId))
+                if expected is not None:
+                    self.assertEqual(FindByScan(times, t, highestId=count), expected)
+
+    def test_find_stops_answering_after_an_inversion(self):
+        index = accurev.ext.TransactionTimeIndex()
+        for trId, timestamp in [ (1, 10), (2, 20), (3, 20), (4, 30) ]:
+            index.add(trId, MakeTime(timestamp))
+        self.assertEqual(3, index.find(MakeTime(25)))
+        self.assertEqual(3, index.find(MakeTime(20)))
+        self.assertIsNone(index.find(MakeTime(5)))
+        self.assertIsNone(index.find(MakeTime(31)))
+        self.assertEqual(4, index.find(MakeTime(31), highestId=4))
+
+        index.add(5, MakeTime(15)) # The server clock went back.
+        self.assertIsNone(index.find(MakeTime(25)))
+        self.assertFalse(index.isMonotonic)
+        index.add(6, MakeTime(40))
+        self.assertIsNone(index.find(MakeTime(35)))
+
+    def test_concurrent_add_and_find(self):
+        index = accurev.ext.TransactionTimeIndex()
+        errors = []
+
+        def adder(offset):
+            for trId in range(offset, 4000, 4):
+                index.add(trId, MakeTime(trId * 10))
+
+        def finder(seed):
+            rng = random.Random(seed)
+            for i in range(0, 4000):
+                try:
+                    trId = index.find(MakeTime(rng.randint(0, 40000)))
+                    if trId is not None and not isinstance(trId, int):
+                        errors.append(trId)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [ threading.Thread(target=adder, args=(i,)) for i in range(1, 5) ] + [ threading.Thread(target=finder, args=(i,)) for i in range(0, 3) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        self.assertTrue(index.isMonotonic)
+        self.assertEqual(555, index.find(MakeTime(5555)))
+
+if __name__ == '__main__':
+    unittest.main()